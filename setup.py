@@ -21,7 +21,7 @@ setup(name='tsharvest',
 		author="F. Dan O'Neill",
 		author_email='fdfoneill@gmail.com',
 		license='MIT',
-		packages=['tsharvest'],
+		packages=['tsharvest', 'tsharvest.benchmark'],
 		include_package_data=True,
 		# third-party dependencies
 		install_requires=[
@@ -32,6 +32,9 @@ setup(name='tsharvest',
 			'pyproj',
 			'rasterio'
 			],
+		extras_require={
+			'columnar': ['pyarrow']
+			},
 		# classifiers
 		classifiers=[
 			"License :: OSI Approved :: MIT License",
@@ -48,7 +51,8 @@ setup(name='tsharvest',
 		# console scripts
 		entry_points = {
 			'console_scripts': [
-				'tsharvest=tsharvest.command_line:main'
+				'tsharvest=tsharvest.command_line:main',
+				'tsharvest-worker=tsharvest.executor:main'
 				],
 			}
 		)
\ No newline at end of file
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip("rasterio")
+from rasterio.transform import from_origin
+
+
+SIZE = 64
+BLOCK = 16
+ZONE_NODATA = 0
+# a zone whose data pixels are all nodata
+EMPTY_ZONE = 99
+
+
+def write_raster(path, array, nodata = None, block:int = BLOCK, overviews:list = None, sparse:bool = False) -> str:
+	"""Writes a tiled single band GeoTIFF on the shared test grid,
+	with nearest-neighbour overviews at each factor of overviews"""
+	from rasterio.enums import Resampling
+	profile = dict(driver="GTiff", width=array.shape[1], height=array.shape[0], count=1, dtype=array.dtype, crs="EPSG:4326", transform=from_origin(0, array.shape[0], 1, 1), nodata=nodata, tiled=True, blockxsize=block, blockysize=block)
+	if sparse:
+		profile["sparse_ok"] = True
+	with rasterio.open(path, 'w', **profile) as dst:
+		if sparse:
+			# only write blocks that have data, so the rest stay out of the file
+			for row in range(0, array.shape[0], block):
+				for col in range(0, array.shape[1], block):
+					tile = array[row:row + block, col:col + block]
+					if (tile != nodata).any():
+						dst.write(tile, 1, window=rasterio.windows.Window(col, row, tile.shape[1], tile.shape[0]))
+		else:
+			dst.write(array, 1)
+		if overviews:
+			dst.build_overviews(overviews, Resampling.nearest)
+	return str(path)
+
+
+def zone_array() -> np.ndarray:
+	"""Zones of irregular sizes that cross window edges, with an
+	unzoned border and one zone without any data"""
+	rows, cols = np.mgrid[0:SIZE, 0:SIZE]
+	zones = (1 + (rows // 20) * 4 + (cols // 23)).astype('int16')
+	zones[:3, :] = ZONE_NODATA
+	zones[:, -2:] = ZONE_NODATA
+	zones[40:44, 5:9] = EMPTY_ZONE
+	return zones
+
+
+def data_array(dtype:str, nodata, seed:int = 0) -> np.ndarray:
+	"""Random data, with scattered nodata and none at all in EMPTY_ZONE"""
+	rng = np.random.default_rng(seed)
+	if np.issubdtype(np.dtype(dtype), np.integer):
+		data = rng.integers(-2000, 10000, size=(SIZE, SIZE)).astype(dtype)
+	else:
+		data = (rng.random((SIZE, SIZE)) * 300 - 50).astype(dtype)
+	data[rng.random((SIZE, SIZE)) < 0.1] = nodata
+	data[zone_array() == EMPTY_ZONE] = nodata
+	return data
+
+
+def mask_array(seed:int = 1) -> np.ndarray:
+	rng = np.random.default_rng(seed)
+	return (rng.random((SIZE, SIZE)) < 0.6).astype('uint8')
+
+
+@pytest.fixture
+def zone_raster(tmp_path):
+	return write_raster(tmp_path / "zones.tif", zone_array(), ZONE_NODATA)
+
+
+@pytest.fixture
+def mask_raster(tmp_path):
+	return write_raster(tmp_path / "mask.tif", mask_array())
+
+
+@pytest.fixture(params=[("int16", -3000), ("float32", -9999.0)], ids=["int16", "float32"])
+def product(request, tmp_path):
+	"""(data_raster, data, nodata) of an integer and a float product"""
+	dtype, nodata = request.param
+	data = data_array(dtype, nodata)
+	return write_raster(tmp_path / f"data_{dtype}.tif", data, nodata), data, nodata
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+	"""A product archive with overviews, a crop mask and a zone
+	shapefile with a zone too small for the first overview, set up
+	as command_line's archive, catalog, cache and scratch directories
+
+	Returns {"zones":shapefile_path, "product":name, "dates":[...]}
+	"""
+	gpd = pytest.importorskip("geopandas")
+	from shapely.geometry import box
+	import tsharvest.command_line as command_line
+	product_dir = tmp_path / "products"
+	(product_dir / "MOD09Q1").mkdir(parents=True)
+	mask_dir = tmp_path / "masks"
+	mask_dir.mkdir()
+	temp_dir = tmp_path / "temp"
+	temp_dir.mkdir()
+	dates = {"2020.001":"2020-01-01", "2020.009":"2020-01-09"}
+	for seed, date in enumerate(dates):
+		write_raster(product_dir / "MOD09Q1" / f"MOD09Q1.{date}.tif", data_array("int16", -3000, seed), -3000, overviews=[2])
+	write_raster(mask_dir / "MOD09Q1.maize.tif", mask_array())
+	# on the grid of write_raster, one unit per pixel; zone 4 covers 2 by 2 pixels
+	zones = gpd.GeoDataFrame({"ADM_CODE":[1, 2, 3, 4]}, geometry=[box(0, 0, 30, 40), box(30, 0, 64, 40), box(5, 42, 60, 60), box(40, 41, 42, 43)], crs="EPSG:4326")
+	zones_path = str(tmp_path / "zones.shp")
+	zones.to_file(zones_path)
+	monkeypatch.setattr(command_line, "PRODUCT_DIR", str(product_dir))
+	monkeypatch.setattr(command_line, "MASK_DIR", str(mask_dir))
+	monkeypatch.setattr(command_line, "CATALOG_PATH", str(tmp_path / "catalog.sqlite"))
+	monkeypatch.setattr(command_line, "CACHE_DIR", str(tmp_path / "cache"))
+	monkeypatch.setattr(command_line, "TEMP_DIR", str(temp_dir))
+	return {"zones":zones_path, "product":"MOD09Q1", "dates":list(dates.values()), "temp_dir":str(temp_dir)}
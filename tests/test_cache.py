@@ -0,0 +1,114 @@
+import logging
+import os
+
+import pytest
+
+from conftest import write_raster, data_array
+from tsharvest import cache, command_line
+from tsharvest.cache import DiskCache, ResultCache, zone_layer_key
+from tsharvest.command_line import multi_zonal_stats
+
+
+class Interrupted(Exception):
+	pass
+
+
+class Burned(Exception):
+	pass
+
+
+class InterruptingWriter:
+	"""Stands in for a statistics writer, stopping the run at its first date"""
+	group_columns = []
+
+	def write(self, date, zone_stats, **groups):
+		raise Interrupted(date)
+
+
+def run(archive, **kwargs) -> dict:
+	return multi_zonal_stats(archive["zones"], archive["product"], "maize", full_archive=True, zone_field="ADM_CODE", executor="thread", n_cores=1, block_scale_factor=1, **kwargs)
+
+
+def result_entries(tmp_path) -> list:
+	return os.listdir(tmp_path / "cache" / "results")
+
+
+def test_results_are_reused_until_data_changes(archive, tmp_path, caplog):
+	caplog.set_level(logging.INFO)
+	with pytest.raises(Interrupted):
+		run(archive, writer=InterruptingWriter())
+	# the first date was stored before it was written
+	assert len(result_entries(tmp_path)) == 1
+	caplog.clear()
+	assert run(archive) == run(archive, use_cache=False)
+	assert "Reusing 1 cached results" in caplog.text
+	assert len(result_entries(tmp_path)) == 2
+
+	# rewriting a data file changes its mtime, so its result is computed again
+	first_date = tmp_path / "products" / archive["product"] / f"{archive['product']}.2020.001.tif"
+	write_raster(first_date, data_array("int16", -3000, 7), -3000, overviews=[2])
+	caplog.clear()
+	result = run(archive)
+	assert "Reusing 1 cached results" in caplog.text
+	assert len(result_entries(tmp_path)) == 3
+	assert result == run(archive, use_cache=False)
+
+
+def test_default_cache_dir_follows_cache_dir(tmp_path, monkeypatch):
+	monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+	result_cache = ResultCache()
+	result_cache.put("key", {1:{"value":1.5, "pixels":2}})
+	assert os.listdir(tmp_path / "cache" / "results") == ["key"]
+	assert result_cache.get("key") == {1:{"value":1.5, "pixels":2}}
+
+
+def source_file(tmp_path, name:str, size:int) -> str:
+	path = tmp_path / name
+	path.write_bytes(b"x" * size)
+	return str(path)
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+	disk_cache = DiskCache(str(tmp_path / "cache"), 250)
+	for age, key in enumerate(["b", "a"]):
+		entry = disk_cache.put(key, {"data":source_file(tmp_path, key, 100)})
+		# older entries by whole seconds, whatever the filesystem's mtime resolution
+		os.utime(entry, (1000 - age, 1000 - age))
+	# reading a refreshes it, leaving b the least recently used
+	assert disk_cache.get("a") == str(tmp_path / "cache" / "a")
+	disk_cache.put("c", {"data":source_file(tmp_path, "c", 100)})
+	assert disk_cache.get("b") is None
+	assert sorted(os.listdir(tmp_path / "cache")) == ["a", "c"]
+	assert not os.path.exists(tmp_path / "c")
+	# an entry too large for the cache on its own is evicted along with the rest
+	disk_cache.put("d", {"data":source_file(tmp_path, "d", 300)})
+	assert os.listdir(tmp_path / "cache") == []
+
+
+def test_zone_layer_cache_hit(archive, tmp_path, monkeypatch):
+	model_raster = str(tmp_path / "products" / archive["product"] / f"{archive['product']}.2020.001.tif")
+	zone_raster = command_line.burn_zone_layer(archive["zones"], model_raster, "ADM_CODE")
+	assert os.path.dirname(zone_raster) == str(tmp_path / "cache" / "zones" / zone_layer_key(archive["zones"], model_raster, "ADM_CODE"))
+	def burn(*args, **kwargs):
+		raise Burned()
+	monkeypatch.setattr(command_line, "shapefile_toRaster", burn)
+	assert command_line.burn_zone_layer(archive["zones"], model_raster, "ADM_CODE") == zone_raster
+	# another overview level of the same raster is another layer
+	with pytest.raises(Burned):
+		command_line.burn_zone_layer(archive["zones"], model_raster, "ADM_CODE", overview_level=0)
+	assert os.listdir(archive["temp_dir"]) == []
+
+
+def test_zone_layer_key(archive, tmp_path):
+	products = tmp_path / "products" / archive["product"]
+	model_raster = str(products / f"{archive['product']}.2020.001.tif")
+	key = zone_layer_key(archive["zones"], model_raster, "ADM_CODE")
+	# another date on the same grid shares the layer
+	assert zone_layer_key(archive["zones"], str(products / f"{archive['product']}.2020.009.tif"), "ADM_CODE") == key
+	# anything else that changes the burned layer changes the key
+	other_grid = write_raster(tmp_path / "small.tif", data_array("int16", -3000)[:32], -3000)
+	assert len(set([key, zone_layer_key(archive["zones"], model_raster, None), zone_layer_key(archive["zones"], model_raster, "ADM_CODE", clip=False), zone_layer_key(archive["zones"], model_raster, "ADM_CODE", overview_level=0), zone_layer_key(archive["zones"], other_grid, "ADM_CODE")])) == 5
+	# including the contents of the shapefile
+	with open(archive["zones"].replace(".shp", ".dbf"), 'ab') as af:
+		af.write(b" ")
+	assert zone_layer_key(archive["zones"], model_raster, "ADM_CODE") != key
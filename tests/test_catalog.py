@@ -0,0 +1,59 @@
+import os
+from datetime import date
+
+import numpy as np
+
+from conftest import write_raster, data_array
+from tsharvest.catalog import ArchiveCatalog
+
+
+PRODUCT = "MOD09Q1"
+
+
+def add_file(directory, name:str, seed:int = 0) -> str:
+	return write_raster(directory / f"{PRODUCT}.{name}.tif", data_array("int16", -3000, seed), -3000)
+
+
+def set_mtime(path, mtime:float) -> None:
+	os.utime(path, (mtime, mtime))
+
+
+def test_refresh_picks_up_new_files(tmp_path):
+	directory = tmp_path / "products" / PRODUCT
+	directory.mkdir(parents=True)
+	for seed, name in enumerate(["2020.001", "2020.009"]):
+		add_file(directory, name, seed)
+	mtime = os.stat(directory).st_mtime
+	with ArchiveCatalog(str(tmp_path / "catalog.sqlite"), str(tmp_path / "products"), str(tmp_path / "external")) as catalog:
+		assert list(catalog.files(PRODUCT, date(2020, 1, 5), date(2020, 1, 31))) == ["2020-01-09"]
+		assert not catalog.refresh(PRODUCT)
+		# a file added without the directory's mtime changing is not listed...
+		new_path = add_file(directory, "2020.017", 2)
+		set_mtime(directory, mtime)
+		assert not catalog.refresh(PRODUCT)
+		assert list(catalog.files(PRODUCT, date(2020, 1, 5), date(2020, 1, 31))) == ["2020-01-09"]
+		# ...until it does
+		set_mtime(directory, mtime + 10)
+		assert catalog.refresh(PRODUCT)
+		assert catalog.files(PRODUCT, date(2020, 1, 5), date(2020, 1, 31)) == {"2020-01-09":str(directory / f"{PRODUCT}.2020.009.tif"), "2020-01-17":new_path}
+		assert list(catalog.files(PRODUCT, end_date = date(2020, 1, 9))) == ["2020-01-01", "2020-01-09"]
+	# entries persist between catalogs
+	with ArchiveCatalog(str(tmp_path / "catalog.sqlite"), str(tmp_path / "products"), str(tmp_path / "external")) as catalog:
+		assert list(catalog.files(PRODUCT, refresh = False)) == ["2020-01-01", "2020-01-09", "2020-01-17"]
+
+
+def test_grid_is_read_again_when_raster_changes(tmp_path):
+	raster = write_raster(tmp_path / "grid.tif", data_array("int16", -3000), -3000)
+	mtime = os.stat(raster).st_mtime
+	with ArchiveCatalog(str(tmp_path / "catalog.sqlite"), str(tmp_path), str(tmp_path)) as catalog:
+		grid = catalog.grid(raster)
+		assert (grid["width"], grid["height"], grid["dtype"], grid["nodata"]) == (64, 64, "int16", -3000)
+		assert (grid["block_width"], grid["block_height"]) == (16, 16)
+		assert grid["transform"] == (1.0, 0.0, 0.0, 0.0, -1.0, 64.0)
+		# rewritten with its old mtime, the raster's cached grid is returned
+		write_raster(raster, np.zeros((32, 48), dtype='float32'), -9999.0)
+		set_mtime(raster, mtime)
+		assert catalog.grid(raster) == grid
+		set_mtime(raster, mtime + 10)
+		grid = catalog.grid(raster)
+		assert (grid["width"], grid["height"], grid["dtype"], grid["nodata"]) == (48, 32, "float32", -9999.0)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from conftest import write_raster, data_array
+from tsharvest.cube import StatsCube
+from tsharvest.exceptions import BadInputError
+from tsharvest.output import open_stats_writer, iter_stats_rows
+from tsharvest.zonal import multi_date_zonal_stats
+
+
+STATISTICS = ["mean", "pixels", "sum", "min"]
+
+
+def stats(mean, pixels, total, minimum) -> dict:
+	return {"value":mean, "pixels":pixels, "sum":total, "min":minimum}
+
+
+def stats_dictionary() -> dict:
+	"""Two dates of integer data, with a zone that has no pixels on the second"""
+	return {
+		"2020-01-01":{1:stats(2.5, 2, 5, 1.0), 7:stats(4.0, 1, 4, 4.0), 3:stats(-1.0, 3, -3, -2.0)},
+		"2020-01-09":{1:stats(3.0, 1, 3, 3.0), 7:stats(np.nan, 0, np.nan, np.nan), 3:stats(0.5, 2, 1, 0.0)},
+		}
+
+
+def test_round_trip():
+	original = stats_dictionary()
+	cube = StatsCube.from_stats(original, STATISTICS)
+	assert cube.integer_sums
+	assert cube.zones.tolist() == [1, 3, 7]
+	assert cube["sum"].dtype == np.int64
+	assert cube.valid().tolist() == [[True, True, True], [True, True, False]]
+	result = cube.to_dict()
+	for date, zone_stats in original.items():
+		for zone, expected in zone_stats.items():
+			for key, value in expected.items():
+				if isinstance(value, float) and np.isnan(value):
+					assert np.isnan(result[date][zone][key])
+				else:
+					assert result[date][zone][key] == value
+
+
+def test_memory_mapped_cube_reopens(tmp_path):
+	cube = StatsCube.from_stats(stats_dictionary(), STATISTICS, path=str(tmp_path / "cube"))
+	cube.flush()
+	reopened = StatsCube.open(str(tmp_path / "cube"))
+	assert reopened.dates == cube.dates
+	assert reopened.zones.tolist() == cube.zones.tolist()
+	for stat in STATISTICS:
+		np.testing.assert_array_equal(reopened[stat], cube[stat])
+
+
+def test_merge_takes_other_zones_from_other():
+	first = StatsCube.from_stats(stats_dictionary(), STATISTICS)
+	second = StatsCube.from_stats({"2020-01-09":{7:stats(9.0, 2, 18, 8.0), 11:stats(1.0, 1, 1, 1.0)}, "2020-01-17":{1:stats(6.0, 1, 6, 6.0)}}, STATISTICS)
+	merged = first.merge(second)
+	assert merged.dates == ["2020-01-01", "2020-01-09", "2020-01-17"]
+	assert merged.zones.tolist() == [1, 3, 7, 11]
+	result = merged.to_dict()
+	assert result["2020-01-09"][7] == stats(9.0, 2, 18, 8.0)
+	assert result["2020-01-09"][3] == stats(0.5, 2, 1, 0.0)
+	# zone 1 is one of other's zones, without pixels on this date
+	assert result["2020-01-09"][1]["pixels"] == 0
+	assert result["2020-01-01"][3] == stats(-1.0, 3, -3, -2.0)
+	# zones missing from a date's cube have no valid pixels
+	assert result["2020-01-01"][11]["pixels"] == 0
+	assert np.isnan(result["2020-01-01"][11]["value"])
+	assert result["2020-01-17"][3]["pixels"] == 0
+
+
+def test_select_and_merge_errors():
+	cube = StatsCube.from_stats(stats_dictionary(), STATISTICS)
+	assert cube.select([7, 1]).to_stats("2020-01-01") == {7:stats(4.0, 1, 4, 4.0), 1:stats(2.5, 2, 5, 1.0)}
+	with pytest.raises(BadInputError):
+		cube.select([2])
+	with pytest.raises(BadInputError):
+		cube.merge(StatsCube.from_stats(stats_dictionary(), ["mean", "pixels"]))
+
+
+@pytest.mark.parametrize("extension", ["csv", "parquet", "arrow"])
+def test_write_cube_matches_write(tmp_path, extension):
+	if extension != "csv":
+		pytest.importorskip("pyarrow")
+	cube = StatsCube.from_stats(stats_dictionary(), STATISTICS)
+	# a name with a comma, and one with quotes, are quoted in csv
+	zone_names = {1:"north", 3:"Nord, Kivu", 7:'"east"'}
+	paths = {}
+	for how in ["rows", "cube"]:
+		paths[how] = str(tmp_path / f"{how}.{extension}")
+		with open_stats_writer(paths[how], zone_names, STATISTICS, ["mask"]) as writer:
+			if how == "cube":
+				writer.write_cube(cube, mask="maize")
+			else:
+				for date in cube.dates:
+					writer.write(date, cube.to_stats(date), mask="maize")
+	if extension == "csv":
+		with open(paths["rows"]) as rows, open(paths["cube"]) as cubes:
+			assert cubes.read() == rows.read()
+	rows, cubes = [list(iter_stats_rows(paths[how])) for how in ["rows", "cube"]]
+	assert len(cubes) == len(rows) == 6
+	assert [row[2] for row in cubes[:3]] == ["north", "Nord, Kivu", '"east"']
+	for cube_row, row in zip(cubes, rows):
+		assert cube_row[:3] == row[:3]
+		np.testing.assert_array_equal(np.array(cube_row[3:], dtype='float64'), np.array(row[3:], dtype='float64'))
+
+
+def test_zonal_cube_matches_dictionaries(tmp_path, zone_raster, mask_raster):
+	rasters = {f"2020-01-0{seed + 1}":write_raster(tmp_path / f"date{seed}.tif", data_array("int16", -3000, seed), -3000) for seed in range(3)}
+	masks = {"crop":mask_raster, "none":None}
+	expected = multi_date_zonal_stats(zone_raster, rasters, masks, block_scale_factor=1, statistics=STATISTICS, executor="thread")
+	for path in [True, str(tmp_path / "cube")]:
+		cubes = multi_date_zonal_stats(zone_raster, rasters, masks, block_scale_factor=1, statistics=STATISTICS, executor="thread", cube=path)
+		for name, cube in cubes.items():
+			assert cube.dates == list(rasters)
+			for date in cube.dates:
+				result = cube.to_stats(date)
+				for zone, zone_stats in expected[date][name].items():
+					np.testing.assert_equal(result[zone], zone_stats)
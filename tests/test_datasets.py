@@ -0,0 +1,53 @@
+import threading
+import numpy as np
+import pytest
+from rasterio.errors import RasterioIOError
+
+from conftest import SIZE, ZONE_NODATA, write_raster, zone_array
+from tsharvest import datasets
+from tsharvest.zonal import zonal_stats, multi_date_zonal_stats
+
+
+def test_thread_runs_do_not_keep_handles(zone_raster, product):
+	data_raster, data, nodata = product
+	for prefetch_depth in [0, 2, 0, 2]:
+		zonal_stats(zone_raster, data_raster, block_scale_factor=1, n_cores=3, executor="thread", prefetch_depth=prefetch_depth)
+		# only this thread's own state, if it opened anything, is left
+		assert set(datasets._states) <= {threading.get_ident()}
+
+
+def test_exited_threads_are_pruned(product):
+	data_raster, data, nodata = product
+	handles = []
+	thread = threading.Thread(target=lambda: handles.append(datasets.open_dataset(data_raster)))
+	thread.start()
+	thread.join()
+	assert not handles[0].closed
+	# registering another thread closes the handles of the one that exited
+	other = threading.Thread(target=datasets.open_dataset, args=(data_raster,))
+	other.start()
+	other.join()
+	assert handles[0].closed
+
+
+def test_rewritten_zone_raster_is_preloaded_again(tmp_path, product):
+	data_raster, data, nodata = product
+	zone_raster = write_raster(tmp_path / "zones.tif", zone_array(), ZONE_NODATA)
+	zonal_stats(zone_raster, data_raster, block_scale_factor=1, executor="thread")
+	# the run's layers are unmapped along with their scratch files
+	assert datasets._layers == {}
+	write_raster(zone_raster, np.full((SIZE, SIZE), 7, dtype='int16'), ZONE_NODATA)
+	for executor in ["thread", "process"]:
+		result = zonal_stats(zone_raster, data_raster, block_scale_factor=1, executor=executor)
+		assert sorted(result) == [7]
+
+
+@pytest.mark.parametrize("prefetch_depth", [0, 2])
+def test_failed_thread_runs_do_not_keep_handles(tmp_path, zone_raster, product, prefetch_depth):
+	data_raster, data, nodata = product
+	broken_raster = tmp_path / "broken.tif"
+	broken_raster.write_bytes(b"not a raster")
+	rasters = {"2020-01-01":data_raster, "2020-01-09":str(broken_raster)}
+	with pytest.raises(RasterioIOError):
+		multi_date_zonal_stats(zone_raster, rasters, block_scale_factor=1, n_cores=3, executor="thread", prefetch_depth=prefetch_depth)
+	assert set(datasets._states) <= {threading.get_ident()}
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from conftest import BLOCK
+from tsharvest.executor import DistributedExecutor
+from tsharvest.zonal import zonal_stats, get_windows, build_zone_index
+
+
+STATISTICS = ["mean", "pixels", "sum", "std", "min", "max"]
+
+
+def assert_same_stats(result:dict, expected:dict) -> None:
+	assert sorted(result) == sorted(expected)
+	for zone, stats in expected.items():
+		assert result[zone].keys() == stats.keys()
+		for key, value in stats.items():
+			if np.isnan(value):
+				assert np.isnan(result[zone][key]), (zone, key)
+			else:
+				# shards may come back, and be merged, in any order
+				assert result[zone][key] == pytest.approx(value, rel=1e-9), (zone, key)
+
+
+@pytest.mark.parametrize("prefetch_depth", [0, 2])
+def test_distributed_matches_process(zone_raster, mask_raster, product, prefetch_depth):
+	data_raster, data, nodata = product
+	masks = {"crop":mask_raster, "none":None}
+	expected = zonal_stats(zone_raster, data_raster, masks, n_cores=2, block_scale_factor=1, statistics=STATISTICS, executor="process", prefetch_depth=prefetch_depth)
+	# one task per shard, so results come back from both workers
+	result = zonal_stats(zone_raster, data_raster, masks, n_cores=2, block_scale_factor=1, statistics=STATISTICS, executor="distributed", executor_options={"shard_size":1}, prefetch_depth=prefetch_depth)
+	for name in masks:
+		assert_same_stats(result[name], expected[name])
+
+
+def test_distributed_queue_dir_matches_process(tmp_path, zone_raster, product):
+	data_raster, data, nodata = product
+	expected = zonal_stats(zone_raster, data_raster, block_scale_factor=1, statistics=STATISTICS, executor="process")
+	queue_dir = tmp_path / "queue"
+	# layers are not preloaded for a queue other nodes may serve
+	result = zonal_stats(zone_raster, data_raster, block_scale_factor=1, statistics=STATISTICS, executor="distributed", executor_options={"queue_dir":str(queue_dir), "local_workers":2})
+	assert_same_stats(result, expected)
+	assert sorted(p.name for p in queue_dir.iterdir()) == ["claimed", "init.pkl", "results", "stop", "tasks"]
+
+
+def test_distributed_map_keeps_order(zone_raster):
+	windows = get_windows(zone_raster, 1, BLOCK, zone_raster)
+	expected = build_zone_index(zone_raster, windows)
+	with DistributedExecutor(2, shard_size = 1) as p:
+		assert p.map(abs, range(-5, 5)) == [abs(i) for i in range(-5, 5)]
+		index = build_zone_index(zone_raster, windows, pool = p)
+	assert [(w, counts) for w, counts in index] == expected
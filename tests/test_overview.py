@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+
+from tsharvest.command_line import multi_zonal_stats, _with_fallback
+
+
+def run(archive, **kwargs) -> dict:
+	return multi_zonal_stats(archive["zones"], archive["product"], "maize", full_archive=True, zone_field="ADM_CODE", use_cache=False, executor="thread", block_scale_factor=1, **kwargs)
+
+
+def test_with_fallback_replaces_only_small_zones():
+	overview = {1:{"value":1.0, "pixels":10}, 2:{"value":2.0, "pixels":1}}
+	full = {1:{"value":1.5, "pixels":40}, 2:{"value":2.5, "pixels":4}}
+	assert _with_fallback(overview, full, {2}, False) == {1:overview[1], 2:full[2]}
+	by_mask = _with_fallback({"maize":overview, "none":overview}, {"maize":full, "none":{}}, {2}, True)
+	assert by_mask == {"maize":{1:overview[1], 2:full[2]}, "none":{1:overview[1]}}
+
+
+def test_small_zones_fall_back_to_full_resolution(archive):
+	full = run(archive)
+	overview = run(archive, overview_level=0, overview_min_pixels=4)
+	assert list(overview) == list(full) == archive["dates"]
+	for date in archive["dates"]:
+		assert sorted(overview[date]) == sorted(full[date])
+		for zone, stats in full[date].items():
+			if stats["pixels"] < 4:
+				# too small for the overview, so identical to a full resolution run
+				assert overview[date][zone] == stats
+			else:
+				# overview pixels cover 2 by 2 full resolution pixels
+				assert 0.15 < overview[date][zone]["pixels"] / stats["pixels"] < 0.35
+	# resampled masks and burned zones are scratch files of the run
+	assert os.listdir(archive["temp_dir"]) == []
+
+
+def test_fallback_cube_matches_dictionaries(archive):
+	expected = run(archive, overview_level=0)
+	cube = run(archive, overview_level=0, cube=True)
+	assert list(cube.dates) == archive["dates"]
+	for d, date in enumerate(cube.dates):
+		for z, zone in enumerate(cube.zones.tolist()):
+			assert cube["pixels"][d, z] == expected[date][zone]["pixels"]
+			assert cube["mean"][d, z] == pytest.approx(expected[date][zone]["value"], rel=1e-12)
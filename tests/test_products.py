@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from conftest import write_raster, data_array, mask_array
+from tsharvest import command_line
+from tsharvest.command_line import multi_zonal_stats, run_zonal_stats, product_output_path
+from tsharvest.output import iter_stats_rows
+
+
+OTHER = "MOD13Q1"
+
+
+@pytest.fixture
+def two_products(archive, tmp_path):
+	"""The archive, with a second product on the same grid and dates"""
+	(tmp_path / "products" / OTHER).mkdir()
+	for seed, date in enumerate(["2020.001", "2020.009"]):
+		write_raster(tmp_path / "products" / OTHER / f"{OTHER}.{date}.tif", data_array("float32", -9999.0, seed + 10), -9999.0)
+	write_raster(tmp_path / "masks" / f"{OTHER}.maize.tif", mask_array(seed=2))
+	return archive
+
+
+def run(archive, product, **kwargs):
+	return multi_zonal_stats(archive["zones"], product, "maize", full_archive=True, zone_field="ADM_CODE", use_cache=False, executor="thread", block_scale_factor=1, **kwargs)
+
+
+def test_products_share_one_pass(two_products, monkeypatch):
+	burns = []
+	shapefile_toRaster = command_line.shapefile_toRaster
+	def burn(*args, **kwargs):
+		burns.append(args)
+		return shapefile_toRaster(*args, **kwargs)
+	monkeypatch.setattr(command_line, "shapefile_toRaster", burn)
+	result = run(two_products, [two_products["product"], OTHER])
+	# both products are on one grid, so the zones are burned once
+	assert len(burns) == 1
+	assert list(result) == [two_products["product"], OTHER]
+	for product in result:
+		assert result[product] == run(two_products, product)
+
+
+def test_product_column(two_products, tmp_path):
+	products = [two_products["product"], OTHER]
+	output_path = str(tmp_path / "out.csv")
+	kwargs = dict(full_archive=True, use_cache=False, zone_field="ADM_CODE", executor="thread", block_scale_factor=1)
+	assert run_zonal_stats(two_products["zones"], products, output_path, "maize", **kwargs) == {p:two_products["dates"] for p in products}
+	with open(output_path) as rf:
+		assert rf.readline() == "date,product,zone,mean,pixels\n"
+	rows = list(iter_stats_rows(output_path))
+	for product in products:
+		single_path = str(tmp_path / f"{product}.csv")
+		run_zonal_stats(two_products["zones"], product, single_path, "maize", **kwargs)
+		expected = [(date, product, *rest) for date, *rest in iter_stats_rows(single_path)]
+		assert [row for row in rows if row[1] == product] == expected
+	# or one file per product, without the column
+	split_path = str(tmp_path / "split.csv")
+	run_zonal_stats(two_products["zones"], products, split_path, "maize", split_products=True, **kwargs)
+	assert not os.path.exists(split_path)
+	for product in products:
+		assert list(iter_stats_rows(product_output_path(split_path, product))) == list(iter_stats_rows(str(tmp_path / f"{product}.csv")))
@@ -0,0 +1,68 @@
+import json, os
+
+import pytest
+
+from conftest import SIZE
+from tsharvest import profiling
+from tsharvest.profiling import profile, span, add_span, Profiler, summarize_spans
+from tsharvest.zonal import zonal_stats
+
+
+def test_trace_and_summary():
+	spans = [
+		("read", "task", "node:1", "worker", 100.0, 0.5, {"key":"2020-01-01", "pixels":2000000, "bytes":4000000}),
+		("read", "task", "node:2", "worker", 100.25, 1.5, {"key":"2020-01-09", "pixels":2000000, "bytes":4000000}),
+		("merge", "task", "node:1", "MainThread", 101.0, 0.25, {"key":"2020-01-01", "zones":3}),
+		("zonal", "stage", "node:1", "MainThread", 100.0, 2.0, {}),
+		]
+	profiler = Profiler(spans)
+	trace = profiler.trace()
+	complete = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+	assert [(e["name"], e["ts"], e["dur"], e["pid"], e["tid"]) for e in complete] == [("read", 0.0, 500000.0, 1, 1), ("read", 250000.0, 1500000.0, 2, 2), ("merge", 1000000.0, 250000.0, 1, 3), ("zonal", 0.0, 2000000.0, 1, 3)]
+	names = {(e["name"], e["pid"], e["tid"]):e["args"]["name"] for e in trace["traceEvents"] if e["ph"] == "M"}
+	assert names == {("process_name", 1, 0):"node:1", ("process_name", 2, 0):"node:2", ("thread_name", 1, 1):"worker", ("thread_name", 2, 2):"worker", ("thread_name", 1, 3):"MainThread"}
+
+	read, merge, zonal = profiler.summary()
+	assert (read["name"], read["count"], read["seconds"], read["pixels"]) == ("read", 2, 2.0, 4000000)
+	assert (read["mpix_per_second"], read["mb_per_second"]) == (2.0, 4.0)
+	assert (merge["zones"], zonal["mpix_per_second"]) == (3, 0.0)
+	# spans without the arg are left out
+	assert [row["key"] for row in summarize_spans(spans, ["key"])] == ["2020-01-01", "2020-01-09"]
+	stages, keys = profiler.format_summary().split("\n\n")
+	assert [line.split()[0] for line in stages.splitlines()] == ["name", "read", "merge", "zonal"]
+	assert [line.split()[:3] for line in keys.splitlines()[1:]] == [["2020-01-01", "read", "1"], ["2020-01-01", "merge", "1"], ["2020-01-09", "read", "1"]]
+
+
+def test_spans_are_only_recorded_while_profiling():
+	with span("outside"):
+		pass
+	with profile() as profiler:
+		with span("inside", pixels = 10) as args:
+			args["zones"] = 2
+		add_span("added", "task", 0.0, 1.0)
+	assert not profiling.profiling_enabled()
+	assert [(s[0], s[6]) for s in profiler.spans] == [("inside", {"pixels":10, "zones":2}), ("added", {})]
+	assert profiling.collect_spans() == []
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_run_is_profiled(tmp_path, zone_raster, product, executor):
+	data_raster, data, nodata = product
+	with profile() as profiler:
+		zonal_stats(zone_raster, data_raster, block_scale_factor=1, n_cores=2, executor=executor)
+	names = set(s[0] for s in profiler.spans)
+	assert {"tune", "zone_index", "zonal", "read", "reduce", "merge", "finalize"} <= names
+	reads = [s for s in profiler.spans if s[0] == "read"]
+	# every window of the zone raster has zones, and each is read once
+	assert sum(s[6]["pixels"] for s in reads) == SIZE * SIZE
+	assert set(s[6]["key"] for s in reads) == {data_raster}
+	workers = set(s[2] for s in reads)
+	if executor == "process":
+		# worker spans are sent back from the pool's processes
+		assert "pickle" in names
+		assert f"{profiling._host}:{os.getpid()}" not in workers
+	trace_path = profiler.write_trace(str(tmp_path / "trace.json"))
+	with open(trace_path) as rf:
+		trace = json.load(rf)
+	assert len([e for e in trace["traceEvents"] if e["ph"] == "X"]) == len(profiler.spans)
+	assert "read" in profiler.format_summary()
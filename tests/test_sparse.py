@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from rasterio.windows import Window
+
+from conftest import BLOCK, write_raster, zone_array, data_array
+from tsharvest.datasets import open_dataset, window_is_empty
+from tsharvest.zonal import _read_window, zonal_stats
+
+
+NODATA = -3000
+
+
+def sparse_data() -> np.ndarray:
+	"""Data whose right half, and one block on the left, is all nodata"""
+	data = data_array("int16", NODATA)
+	data[:, 32:] = NODATA
+	data[:BLOCK, :BLOCK] = NODATA
+	return data
+
+
+@pytest.fixture
+def sparse_raster(tmp_path):
+	return write_raster(tmp_path / "sparse.tif", sparse_data(), NODATA, sparse=True)
+
+
+def test_window_is_empty(sparse_raster, tmp_path):
+	handle = open_dataset(sparse_raster)
+	assert window_is_empty(handle, Window(32, 0, 32, 64))
+	assert window_is_empty(handle, Window(0, 0, BLOCK, BLOCK))
+	# any block with data makes the window non-empty
+	assert not window_is_empty(handle, Window(0, 0, 2 * BLOCK, BLOCK))
+	assert not window_is_empty(handle, Window(24, 20, 16, 16))
+	# blocks written to a dense file are there even if they hold only nodata
+	dense = open_dataset(write_raster(tmp_path / "dense.tif", sparse_data(), NODATA))
+	assert not window_is_empty(dense, Window(32, 0, 32, 64))
+	# without a nodata value, missing blocks read as 0, which may be data
+	no_nodata = open_dataset(write_raster(tmp_path / "no_nodata.tif", sparse_data(), None, sparse=True))
+	assert not window_is_empty(no_nodata, Window(32, 0, 32, 64))
+
+
+def test_empty_windows_are_not_read(sparse_raster, zone_raster):
+	args = (Window(32, 0, 32, 32), sparse_raster, zone_raster, (None,), ["mean", "pixels"], None, (0, 0), None)
+	product_data, product_noDataVal, shape_data, shape_noDataVal, mask_data, empty = _read_window(args)
+	assert empty
+	assert product_data.shape == (32, 32)
+	assert (product_data == NODATA).all()
+	assert mask_data == [None]
+
+
+@pytest.mark.parametrize("prefetch_depth", [0, 2])
+def test_sparse_file_matches_dense(sparse_raster, zone_raster, mask_raster, tmp_path, prefetch_depth):
+	dense_raster = write_raster(tmp_path / "dense.tif", sparse_data(), NODATA)
+	masks = {"crop":mask_raster, "none":None}
+	sparse = zonal_stats(zone_raster, sparse_raster, masks, block_scale_factor=1, statistics=["mean", "pixels", "min", "max"], executor="thread", prefetch_depth=prefetch_depth)
+	dense = zonal_stats(zone_raster, dense_raster, masks, block_scale_factor=1, statistics=["mean", "pixels", "min", "max"], executor="thread", prefetch_depth=prefetch_depth)
+	assert sparse.keys() == dense.keys()
+	for name in masks:
+		assert sparse[name].keys() == dense[name].keys()
+		for zone, stats in dense[name].items():
+			if stats["pixels"] == 0:
+				# zones entirely in empty blocks are reported without data
+				assert sparse[name][zone]["pixels"] == 0
+				assert np.isnan(sparse[name][zone]["value"])
+			else:
+				assert sparse[name][zone] == stats
+	zones = zone_array()
+	assert all(dense["none"][zone]["pixels"] == 0 for zone in np.unique(zones[:, 32:]) if zone not in zones[:, :32])
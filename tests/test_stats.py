@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from conftest import write_raster, zone_array, data_array
+from tsharvest.exceptions import BadInputError
+from tsharvest.stats import validate_statistics, default_histogram, window_columns, empty_columns, merge_columns, finalize_columns
+from tsharvest.zonal import zonal_stats
+
+
+STATISTICS = ["mean", "pixels", "sum", "min", "max", "std", "median", "p10", "p90"]
+
+PERCENTILES = {"median":50, "p10":10, "p90":90}
+
+
+def assert_stats(result:dict, values, bin_width:float) -> None:
+	values = np.sort(np.asarray(values, dtype='float64'))
+	assert result["pixels"] == values.size
+	expected = {"mean":values.mean(), "sum":values.sum(), "min":values.min(), "max":values.max(), "std":values.std()}
+	for stat, value in expected.items():
+		assert result[stat] == pytest.approx(value, rel=1e-9), stat
+	for stat, q in PERCENTILES.items():
+		# interpolated within the histogram bin of the value at that rank
+		rank = int(np.ceil(q / 100 * values.size))
+		low, high = values[max(0, rank - 2)], values[min(values.size - 1, rank)]
+		assert low - bin_width <= result[stat] <= high + bin_width, stat
+
+
+@pytest.mark.parametrize("dtype", ["int16", "uint8", "float32"])
+def test_merged_windows_match_whole(dtype):
+	rng = np.random.default_rng(2)
+	n_zones = 5
+	values = (rng.integers(0, 250, 3000) if dtype != "float32" else rng.random(3000) * 250).astype(dtype)
+	zone_index = rng.integers(0, n_zones, values.size)
+	histogram = (0.0, 256.0, 256) if dtype != "float32" else (0.0, 250.0, 500)
+	# an empty window, then two halves that share most zones but not all
+	zone_index[:values.size // 2][zone_index[:values.size // 2] == 0] = 1
+	stored = None
+	for part in [slice(0, 0), slice(0, values.size // 2), slice(values.size // 2, None)]:
+		zones = np.unique(zone_index[part])
+		columns = window_columns(np.searchsorted(zones, zone_index[part]), values[part], zones.size, STATISTICS, histogram)
+		if stored is None:
+			stored = empty_columns(n_zones, columns)
+		merge_columns(stored, columns, zones)
+	out = finalize_columns(stored, STATISTICS, histogram)
+	for z in range(n_zones):
+		assert_stats({stat:out[stat][z] for stat in STATISTICS}, values[zone_index == z], histogram[1] / histogram[2])
+
+
+def test_integer_sums_stay_integers():
+	values = np.array([30000, 30000, -5, 7], dtype='int16')
+	columns = window_columns(np.array([0, 0, 1, 1]), values, 2, ["sum", "std"])
+	assert columns["sum"].dtype == np.int64
+	assert columns["sum"].tolist() == [60000, 2]
+	assert columns["m2"].tolist() == [0.0, 72.0]
+	out = finalize_columns(columns, ["sum", "std"])
+	assert out["std"].tolist() == [0.0, 6.0]
+
+
+def test_std_of_values_far_from_zero():
+	rng = np.random.default_rng(3)
+	# a sum of squares would lose every digit of this spread
+	values = 1e9 + rng.random(4000)
+	zone_index = rng.integers(0, 3, values.size)
+	stored = None
+	for part in np.array_split(np.arange(values.size), 7):
+		columns = window_columns(zone_index[part], values[part], 3, ["std"])
+		if stored is None:
+			stored = empty_columns(3, columns)
+		merge_columns(stored, columns, np.arange(3))
+	out = finalize_columns(stored, ["std"])
+	for z in range(3):
+		assert out["std"][z] == pytest.approx(values[zone_index == z].std(), rel=1e-6)
+
+
+def test_zones_without_pixels_are_nan():
+	columns = empty_columns(2, window_columns(np.array([0]), np.array([3], dtype='int16'), 1, STATISTICS, (0.0, 10.0, 10)))
+	merge_columns(columns, window_columns(np.array([0]), np.array([3], dtype='int16'), 1, STATISTICS, (0.0, 10.0, 10)), np.array([0]))
+	out = finalize_columns(columns, STATISTICS, (0.0, 10.0, 10))
+	assert out["pixels"].tolist() == [1, 0]
+	for stat in ["mean", "min", "max", "std", "median", "p10"]:
+		assert np.isnan(out[stat][1]), stat
+	# integer sums stay int64 and are masked by pixels == 0
+	assert out["sum"].tolist() == [3, 0]
+
+
+@pytest.mark.parametrize("dtype,nodata,histogram_range", [("int16", -3000, None), ("float32", -9999.0, (-50, 250))])
+def test_zonal_statistics_in_one_pass(tmp_path, zone_raster, dtype, nodata, histogram_range):
+	data = data_array(dtype, nodata)
+	data_raster = write_raster(tmp_path / "data.tif", data, nodata)
+	result = zonal_stats(zone_raster, data_raster, block_scale_factor=1, statistics=STATISTICS, histogram_range=histogram_range, histogram_bins=1000, executor="thread")
+	zones = zone_array()
+	low, high = histogram_range if histogram_range else (np.iinfo(dtype).min, np.iinfo(dtype).max + 1)
+	for zone, stats in result.items():
+		values = data[(zones == zone) & (data != nodata)]
+		if values.size == 0:
+			continue
+		assert_stats({**stats, "mean":stats["value"]}, values, (high - low) / 1000)
+
+
+def test_validate_statistics():
+	assert validate_statistics(None) == ["mean", "pixels"]
+	assert validate_statistics("mean,p97.5") == ["mean", "p97.5"]
+	for bad in [["mode"], ["p101"], ["p"]]:
+		with pytest.raises(BadInputError):
+			validate_statistics(bad)
+
+
+def test_default_histogram():
+	assert default_histogram("int16", ["mean"]) is None
+	assert default_histogram("uint8", ["median"], 100) == (0.0, 256.0, 100)
+	with pytest.raises(BadInputError):
+		default_histogram("float32", ["p10"])
@@ -0,0 +1,77 @@
+import logging
+
+import numpy as np
+import pytest
+
+from conftest import write_raster
+from tsharvest import tuning
+from tsharvest.tuning import tune, parse_bytes
+from tsharvest.zonal import zonal_stats
+
+
+# 16 by 16 blocks of 16 pixels
+SIZE = 256
+
+
+@pytest.fixture
+def rasters(tmp_path, monkeypatch):
+	"""(data_raster, zone_raster, corner_zone_raster) on a grid of
+	16 by 16 blocks, with zones everywhere or in one corner block,
+	tuned for 4 cores"""
+	monkeypatch.setattr(tuning, "available_cores", lambda: 4)
+	rng = np.random.default_rng(0)
+	data_raster = write_raster(tmp_path / "data.tif", rng.integers(0, 100, size=(SIZE, SIZE)).astype('int16'), -1)
+	zones = np.ones((SIZE, SIZE), dtype='uint8')
+	zone_raster = write_raster(tmp_path / "zones.tif", zones, 0)
+	corner = np.zeros((SIZE, SIZE), dtype='uint8')
+	corner[:16, :16] = 1
+	corner_raster = write_raster(tmp_path / "corner.tif", corner, 0)
+	return data_raster, zone_raster, corner_raster
+
+
+def decision(rasters, zones:int = 1, **kwargs) -> tuple:
+	result = tune(rasters[0], rasters[zones], memory_budget=kwargs.pop("memory_budget", "64G"), **kwargs)
+	return result["block_scale_factor"], result["n_cores"]
+
+
+def test_largest_windows_that_keep_every_core_busy(rasters):
+	# 4 by 4 windows of 64 pixels give 4 cores 4 tasks each
+	assert decision(rasters) == (4, 4)
+	result = tune(rasters[0], rasters[1], memory_budget="64G")
+	assert (result["window_size"], result["windows"], result["zone_windows"], result["tasks"]) == (64, 16, 16, 16)
+	# more dates allow larger windows
+	assert decision(rasters, n_keys=8) == (8, 4)
+	# zones in one block are one task per date whatever the window size,
+	# so the largest windows are used, on as many cores as there are tasks
+	assert decision(rasters, zones=2) == (16, 1)
+	assert decision(rasters, zones=2, n_keys=16) == (16, 4)
+
+
+def test_fixed_values_are_kept(rasters):
+	assert decision(rasters, block_scale_factor=2) == (2, 4)
+	assert decision(rasters, block_scale_factor=16) == (16, 1)
+	assert decision(rasters, n_cores=2) == (4, 2)
+	assert decision(rasters, n_cores=2, block_scale_factor=1) == (1, 2)
+
+
+def test_memory_budget_limits_workers(rasters, caplog):
+	# room for two idle worker processes, but not three
+	budget = 2 * tuning.WORKER_OVERHEAD_BYTES + parse_bytes("20M")
+	result = tune(rasters[0], rasters[1], memory_budget=budget)
+	assert (result["block_scale_factor"], result["n_cores"], result["max_workers_memory"]) == (4, 2, 2)
+	assert result["estimated_bytes"] <= budget
+	# threads share one process
+	assert decision(rasters, memory_budget=budget, executor="thread") == (4, 4)
+	with caplog.at_level(logging.WARNING):
+		assert decision(rasters, memory_budget="1M") == (1, 1)
+	assert "No window size fits" in caplog.text
+
+
+def test_auto_run_matches_fixed_run(rasters, caplog):
+	data_raster, zone_raster, corner_raster = rasters
+	expected = zonal_stats(zone_raster, data_raster, n_cores=1, block_scale_factor=1, statistics=["mean", "pixels"], executor="thread")
+	with caplog.at_level(logging.INFO):
+		result = zonal_stats(zone_raster, data_raster, n_cores="auto", block_scale_factor="auto", statistics=["mean", "pixels"], executor="thread", memory_budget="64G")
+	assert "To reproduce: --block_scale_factor 4 --cores 4" in caplog.text
+	assert result[1]["pixels"] == expected[1]["pixels"] == SIZE * SIZE
+	assert result[1]["value"] == pytest.approx(expected[1]["value"], rel=1e-12)
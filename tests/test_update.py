@@ -0,0 +1,57 @@
+import os
+import pytest
+
+from tsharvest.command_line import run_zonal_stats, read_manifest
+from tsharvest.output import iter_stats_rows
+
+
+def run(archive, output_path:str, update:bool = False, zones:str = None, zone_field:str = "ADM_CODE") -> list:
+	return run_zonal_stats(zones or archive["zones"], archive["product"], output_path, "maize", full_archive=True, use_cache=False, update=update, zone_field=zone_field, executor="thread", block_scale_factor=1)
+
+
+def test_update_computes_only_new_dates(archive, tmp_path):
+	output_path = str(tmp_path / "out.csv")
+	assert run(archive, output_path) == archive["dates"]
+	with open(output_path) as rf:
+		expected = rf.read()
+	assert run(archive, output_path, update=True) == []
+	with open(output_path) as rf:
+		assert rf.read() == expected
+
+
+def test_update_without_manifest_reuses_written_dates(archive, tmp_path, caplog):
+	output_path = str(tmp_path / "out.csv")
+	run(archive, output_path)
+	with open(output_path) as rf:
+		expected = rf.read()
+	# an output from before manifests, missing its last date
+	os.remove(f"{output_path}.manifest.json")
+	with open(output_path, 'w') as wf:
+		wf.write("".join(line for line in expected.splitlines(keepends=True) if not line.startswith(archive["dates"][-1])))
+	assert run(archive, output_path, update=True) == archive["dates"][-1:]
+	assert "has no manifest" in caplog.text
+	with open(output_path) as rf:
+		assert rf.read() == expected
+	# the reused dates are tracked from now on
+	assert sorted(read_manifest(output_path)) == archive["dates"]
+
+
+def test_update_keeps_quoted_zone_names(archive, tmp_path):
+	gpd = pytest.importorskip("geopandas")
+	zones = gpd.read_file(archive["zones"])
+	zones["NAME"] = ["Nord, Kivu", "Sud-Kivu", 'Kinshasa "ville"', "Ituri"]
+	zones_path = str(tmp_path / "named_zones.shp")
+	zones.to_file(zones_path)
+	output_path = str(tmp_path / "out.csv")
+	run(archive, output_path, zones=zones_path, zone_field="NAME")
+	with open(output_path) as rf:
+		expected = rf.read()
+	assert '"Nord, Kivu"' in expected
+	rows = list(iter_stats_rows(output_path))
+	assert sorted(set(row[1] for row in rows)) == sorted(zones["NAME"])
+	# drop the last date, so the update rewrites the others from the file
+	with open(output_path, 'w') as wf:
+		wf.write("".join(line for line in expected.splitlines(keepends=True) if not line.startswith(archive["dates"][-1])))
+	assert run(archive, output_path, update=True, zones=zones_path, zone_field="NAME") == archive["dates"][-1:]
+	with open(output_path) as rf:
+		assert rf.read() == expected
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from conftest import BLOCK, SIZE, write_raster, data_array
+from tsharvest.exceptions import BadInputError
+from tsharvest.util import zone_window, shapefile_toRaster, grid_offset
+from tsharvest.zonal import zonal_stats
+
+gpd = pytest.importorskip("geopandas")
+from shapely.geometry import box
+
+
+NODATA = -3000
+
+
+def write_zones(path, boxes:dict) -> str:
+	"""Writes a shapefile of {zone_code:(left, bottom, right, top)} on the grid of write_raster"""
+	zones = gpd.GeoDataFrame({"CODE":list(boxes)}, geometry=[box(*bounds) for bounds in boxes.values()], crs="EPSG:4326")
+	zones.to_file(str(path))
+	return str(path)
+
+
+@pytest.fixture
+def model_raster(tmp_path):
+	return write_raster(tmp_path / "model.tif", data_array("int16", NODATA), NODATA, overviews=[2])
+
+
+def test_zone_window_snaps_to_blocks_and_clips(tmp_path, model_raster):
+	# 2 by 2 pixels at rows 21-22, columns 40-41
+	small = write_zones(tmp_path / "small.shp", {1:(40, 41, 42, 43)})
+	assert zone_window(small, model_raster) == Window(2 * BLOCK, BLOCK, BLOCK, BLOCK)
+	# running off the bottom right of the raster
+	edge = write_zones(tmp_path / "edge.shp", {1:(50, -10, 80, 10)})
+	assert zone_window(edge, model_raster) == Window(3 * BLOCK, 3 * BLOCK, BLOCK, BLOCK)
+	# the overview is a single block
+	assert zone_window(small, model_raster, overview_level=0) == Window(0, 0, SIZE // 2, SIZE // 2)
+	outside = write_zones(tmp_path / "outside.shp", {1:(100, 100, 110, 110)})
+	with pytest.raises(BadInputError):
+		zone_window(outside, model_raster)
+
+
+def test_clipped_zones_are_offset_into_the_archive_grid(tmp_path, model_raster):
+	shapefile = write_zones(tmp_path / "zones.shp", {1:(40, 41, 42, 43), 2:(33, 30, 37, 34)})
+	zone_raster = shapefile_toRaster(shapefile, model_raster, str(tmp_path / "zones.tif"), zone_field="CODE")
+	assert grid_offset(zone_raster, model_raster) == (2 * BLOCK, BLOCK)
+	# statistics of the clipped zones are those of the same pixels of the full grid
+	data = data_array("int16", NODATA).astype('float64')
+	result = zonal_stats(zone_raster, model_raster, block_scale_factor=1, statistics=["mean", "pixels"], executor="thread")
+	# zones are burned as their row number in the shapefile
+	assert sorted(result) == [0, 1]
+	for zone, (rows, cols) in {0:(slice(21, 23), slice(40, 42)), 1:(slice(30, 34), slice(33, 37))}.items():
+		pixels = data[rows, cols][data[rows, cols] != NODATA]
+		assert result[zone]["pixels"] == pixels.size
+		assert result[zone]["value"] == pytest.approx(pixels.mean(), rel=1e-12)
+
+
+def test_grid_offset_rejects_other_grids(tmp_path, model_raster):
+	data = data_array("int16", NODATA)
+	def write_grid(name:str, transform) -> str:
+		import rasterio
+		path = str(tmp_path / name)
+		with rasterio.open(path, 'w', driver="GTiff", width=16, height=16, count=1, dtype="int16", crs="EPSG:4326", transform=transform) as dst:
+			dst.write(data[:16, :16], 1)
+		return path
+	assert grid_offset(write_grid("inside.tif", from_origin(8, 60, 1, 1)), model_raster) == (8, 4)
+	with pytest.raises(BadInputError):
+		grid_offset(write_grid("coarse.tif", from_origin(8, 60, 2, 2)), model_raster)
+	with pytest.raises(BadInputError):
+		grid_offset(write_grid("shifted.tif", from_origin(8.5, 60, 1, 1)), model_raster)
+	# on the overview, which has pixels of 2 by 2 units
+	assert grid_offset(write_grid("overview.tif", from_origin(8, 60, 2, 2)), model_raster, overview_level=0) == (4, 2)
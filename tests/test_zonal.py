@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from conftest import ZONE_NODATA, EMPTY_ZONE, write_raster, zone_array, data_array, mask_array
+from tsharvest.zonal import zonal_stats, multi_date_zonal_stats
+
+
+def baseline_zonal_stats(zones, data, nodata, mask = None) -> dict:
+	"""The original per-zone loop: one boolean selection per zone code"""
+	if mask is None:
+		mask = np.ones(zones.shape, dtype='uint8')
+	out = {}
+	for zone_code in np.unique(zones[zones != ZONE_NODATA]):
+		selected = data[(data != nodata) & (zones == zone_code) & (mask == 1)].astype('float64')
+		out[int(zone_code)] = {"value":(selected.mean() if selected.size > 0 else np.nan), "pixels":int(selected.size)}
+	return out
+
+
+def assert_matches_baseline(result:dict, expected:dict) -> None:
+	assert sorted(result) == sorted(expected)
+	for zone, stats in expected.items():
+		assert result[zone]["pixels"] == stats["pixels"], zone
+		if stats["pixels"] == 0:
+			assert np.isnan(result[zone]["value"]), zone
+		else:
+			assert result[zone]["value"] == pytest.approx(stats["value"], rel=1e-9), zone
+
+
+@pytest.mark.parametrize("block_scale_factor", [1, 8], ids=["16_windows", "1_window"])
+@pytest.mark.parametrize("masked", [False, True], ids=["unmasked", "masked"])
+def test_bincount_reduction_matches_baseline(zone_raster, mask_raster, product, block_scale_factor, masked):
+	data_raster, data, nodata = product
+	result = zonal_stats(zone_raster, data_raster, (mask_raster if masked else None), block_scale_factor=block_scale_factor, executor="thread")
+	assert_matches_baseline(result, baseline_zonal_stats(zone_array(), data, nodata, (mask_array() if masked else None)))
+
+
+def test_zone_without_data_has_no_mean(zone_raster, product):
+	data_raster, data, nodata = product
+	result = zonal_stats(zone_raster, data_raster, block_scale_factor=1, executor="thread")
+	assert result[EMPTY_ZONE]["pixels"] == 0
+	assert np.isnan(result[EMPTY_ZONE]["value"])
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_executors_agree(zone_raster, mask_raster, product, executor):
+	data_raster, data, nodata = product
+	result = zonal_stats(zone_raster, data_raster, {"crop":mask_raster, "none":None}, n_cores=2, block_scale_factor=1, executor=executor)
+	assert_matches_baseline(result["crop"], baseline_zonal_stats(zone_array(), data, nodata, mask_array()))
+	assert_matches_baseline(result["none"], baseline_zonal_stats(zone_array(), data, nodata))
+
+
+def test_prefetched_reads_match_baseline(zone_raster, product):
+	data_raster, data, nodata = product
+	result = zonal_stats(zone_raster, data_raster, block_scale_factor=1, executor="thread", prefetch_depth=2)
+	assert_matches_baseline(result, baseline_zonal_stats(zone_array(), data, nodata))
+
+
+def test_multi_date_keeps_keys_apart(tmp_path, zone_raster):
+	rasters = {}
+	arrays = {}
+	for seed in range(3):
+		arrays[f"date{seed}"] = data_array("int16", -3000, seed)
+		rasters[f"date{seed}"] = write_raster(tmp_path / f"date{seed}.tif", arrays[f"date{seed}"], -3000)
+	result = multi_date_zonal_stats(zone_raster, rasters, block_scale_factor=1, executor="thread")
+	assert list(result) == list(rasters)
+	for key, data in arrays.items():
+		assert_matches_baseline(result[key], baseline_zonal_stats(zone_array(), data, -3000))
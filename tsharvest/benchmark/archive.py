@@ -0,0 +1,227 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import json, math
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from ..util import overview_factors
+from ..const import *
+from ..exceptions import BadInputError
+
+
+# real GLAM products and how to fake them: pixel size as a multiple of the
+# base pixel size, days between files, data type, nodata and value range
+SYNTHETIC_PRODUCTS = {
+	"MOD09Q1":{"scale":1, "cadence":8, "dtype":"int16", "nodata":-3000, "range":(-1000, 9000)},
+	"MYD09Q1":{"scale":1, "cadence":8, "dtype":"int16", "nodata":-3000, "range":(-1000, 9000)},
+	"MOD13Q1":{"scale":1, "cadence":16, "dtype":"int16", "nodata":-3000, "range":(-2000, 10000)},
+	"MYD13Q1":{"scale":1, "cadence":16, "dtype":"int16", "nodata":-3000, "range":(-2000, 10000)},
+	"chirps":{"scale":5, "cadence":5, "dtype":"float32", "nodata":-9999, "range":(0, 200)},
+	"merra-2":{"scale":50, "cadence":1, "dtype":"float32", "nodata":1e15, "range":(230, 320)},
+	"swi":{"scale":10, "cadence":10, "dtype":"uint8", "nodata":255, "range":(0, 200)},
+	"chirps_gefs":{"scale":5, "cadence":1, "dtype":"float32", "nodata":-9999, "range":(0, 200)},
+	"esi_4wk":{"scale":5, "cadence":7, "dtype":"float32", "nodata":-9999, "range":(-4, 4)},
+	"soil_moisture_as1":{"scale":25, "cadence":3, "dtype":"float32", "nodata":-9999, "range":(0, 1)},
+	"soil_moisture_as2":{"scale":25, "cadence":3, "dtype":"float32", "nodata":-9999, "range":(0, 1)}
+}
+
+MERRA_VARIABLES = ["min", "mean", "max"]
+SYNTHETIC_MASKS = ["maize", "cropland"]
+
+# extent of the synthetic archive, in degrees
+EXTENT = (0.0, 0.0, 20.0, 10.0)
+
+
+def synthetic_dates(n_dates:int, cadence:int, start_year:int = 2001) -> list:
+	"""Returns n_dates file dates of a product that is published every
+	cadence days; like the MODIS composites, periods longer than a
+	day restart on January 1 of each year"""
+	dates = []
+	year = start_year
+	while len(dates) < n_dates:
+		for doy in range(1, 366, cadence):
+			dates.append(datetime(year, 1, 1) + timedelta(days = doy - 1))
+			if len(dates) == n_dates:
+				break
+		year += 1
+	return dates
+
+
+def synthetic_file_name(product:str, date:datetime, variable:str = None) -> str:
+	"""Returns the name a data file of product for date has in the
+	GLAM archive, which util.dateFromFilePath must parse"""
+	doy = date.timetuple().tm_yday
+	if product == "merra-2":
+		return f"merra-2.{date:%Y-%m-%d}.{variable}.tif"
+	elif product == "chirps":
+		return f"chirps.{date:%Y-%m-%d}.tif"
+	elif product == "chirps_gefs":
+		return f"chirpsgefs_{date:%Y%m%d}.tif"
+	elif product == "esi_4wk":
+		return f"DFPPM_4WK_{date:%Y}{doy:03d}.tif"
+	elif product in ["soil_moisture_as1", "soil_moisture_as2"]:
+		return f"SMAP_{date:%Y}_{doy:03d}_{product.split('_')[-1]}_v1.tif"
+	return f"{product}.{date:%Y}.{doy:03d}.tif"
+
+
+def _profile(product:str, pixel_size:float, block_size:int) -> dict:
+	spec = SYNTHETIC_PRODUCTS[product]
+	size = pixel_size * spec["scale"]
+	width = int(round((EXTENT[2] - EXTENT[0]) / size))
+	height = int(round((EXTENT[3] - EXTENT[1]) / size))
+	profile = {"driver":"GTiff", "width":width, "height":height, "count":1, "crs":"EPSG:4326", "transform":from_origin(EXTENT[0], EXTENT[3], size, size), "dtype":spec["dtype"], "nodata":spec["nodata"], "compress":"lzw", "sparse_ok":True}
+	# coarse grids smaller than a tile are striped, like the real ones
+	if min(width, height) >= block_size:
+		profile.update(tiled = True, blockxsize = block_size, blockysize = block_size)
+	return profile
+
+
+def _write_raster(path:str, array, profile:dict, overviews:bool) -> None:
+	with rasterio.open(path, 'w', **profile) as dst:
+		dst.write(array, 1)
+		if overviews:
+			factors = overview_factors(dst.width, dst.height)
+			if factors:
+				dst.build_overviews(factors, Resampling.nearest)
+
+
+def _synthetic_data(rng, profile:dict, value_range:tuple, nodata_fraction:float, ocean_fraction:float):
+	height, width = profile["height"], profile["width"]
+	low, high = value_range
+	if np.issubdtype(np.dtype(profile["dtype"]), np.integer):
+		array = rng.integers(low, high, (height, width)).astype(profile["dtype"])
+	else:
+		array = (rng.random((height, width)) * (high - low) + low).astype(profile["dtype"])
+	array[rng.random((height, width)) < nodata_fraction] = profile["nodata"]
+	# a band of ocean on the east, left empty in the file as in the sparse real products
+	array[:, int(round(width * (1 - ocean_fraction))):] = profile["nodata"]
+	return array
+
+
+def make_zones(out_path:str, n_zones:int, ocean_fraction:float = 0.3, crs:str = "EPSG:3857", seed:int = 0) -> str:
+	"""Writes a shapefile of n_zones rectangular zones over the land
+	part of the synthetic archive, with a numeric "ADM_CODE" field
+
+	Zones are written in crs, by default Web Mercator, so that the
+	shapefile has to be reprojected onto the archive's grid.
+	"""
+	rng = np.random.default_rng(seed)
+	land_width = (EXTENT[2] - EXTENT[0]) * (1 - ocean_fraction)
+	columns = max(1, int(math.ceil(math.sqrt(n_zones * land_width / (EXTENT[3] - EXTENT[1])))))
+	rows = int(math.ceil(n_zones / columns))
+	cell_width = land_width / columns
+	cell_height = (EXTENT[3] - EXTENT[1]) / rows
+	geometries = []
+	for i in range(n_zones):
+		column, row = i % columns, i // columns
+		# shrink each cell a little, so zones have gaps and uneven sizes
+		shrink = rng.uniform(0.05, 0.3, 4)
+		left = EXTENT[0] + (column + shrink[0] / 2) * cell_width
+		right = EXTENT[0] + (column + 1 - shrink[1] / 2) * cell_width
+		bottom = EXTENT[1] + (row + shrink[2] / 2) * cell_height
+		top = EXTENT[1] + (row + 1 - shrink[3] / 2) * cell_height
+		geometries.append(box(left, bottom, right, top))
+	zones = gpd.GeoDataFrame({"ADM_CODE":[1000 + i for i in range(n_zones)]}, geometry = geometries, crs = "EPSG:4326").to_crs(crs)
+	zones.to_file(out_path)
+	return out_path
+
+
+def make_archive(root:str, products:list = None, n_dates:int = 8, zone_counts:list = None, pixel_size:float = 0.01, block_size:int = 256, nodata_fraction:float = 0.05, ocean_fraction:float = 0.3, overviews:bool = True, seed:int = 0) -> dict:
+	"""Generates a synthetic GLAM-style archive of tiled GeoTIFFs
+
+	Data files are named and laid out as in the real archive, so
+	that catalog.ArchiveCatalog and util.dateFromFilePath can list
+	them: GLAM products under ROOT/products/PRODUCT (merra-2 as
+	ROOT/products/merra-2/merra-2.DATE.VARIABLE.tif), external
+	products such as chirps_gefs under ROOT/external/PRODUCT, and
+	crop masks as ROOT/masks/PRODUCT.CROP.tif. Zone shapefiles are
+	written as ROOT/zones/zones_N.shp. An archive already at root
+	is reused if it was made with the same arguments.
+
+	***
+
+	Parameters
+	----------
+	root: str
+		Directory to write archive in
+	products: list
+		Names of products to generate, from SYNTHETIC_PRODUCTS.
+		Default ["MOD09Q1", "chirps", "merra-2", "chirps_gefs"]
+	n_dates: int
+		Number of dates of each product. Default 8
+	zone_counts: list
+		Numbers of zones of the zone shapefiles to write.
+		Default [10]
+	pixel_size: float
+		Pixel size of the finest (MODIS) products, in degrees;
+		coarser products are a multiple of it. The archive
+		covers 20 by 10 degrees. Default 0.01
+	block_size: int
+		Tile size of the data rasters. Default 256
+	nodata_fraction: float
+		Fraction of land pixels that are nodata. Default 0.05
+	ocean_fraction: float
+		Fraction of columns, on the east, that are entirely
+		nodata and left out of the files. Default 0.3
+	overviews: bool
+		Whether to add overviews, like the real COGs. Default
+		True
+	seed: int
+		Random seed. Default 0
+
+	Returns
+	-------
+	Dictionary with keys "product_dir", "external_dir",
+	"mask_dir", "zones" ({n_zones:shapefile_path}), and
+	"arguments", the arguments the archive was made with
+	"""
+	products = products or ["MOD09Q1", "chirps", "merra-2", "chirps_gefs"]
+	zone_counts = zone_counts or [10]
+	arguments = {"products":sorted(products), "n_dates":n_dates, "zone_counts":sorted(zone_counts), "pixel_size":pixel_size, "block_size":block_size, "nodata_fraction":nodata_fraction, "ocean_fraction":ocean_fraction, "overviews":overviews, "seed":seed}
+	archive = {"product_dir":os.path.join(root, "products"), "external_dir":os.path.join(root, "external"), "mask_dir":os.path.join(root, "masks"), "zones":{n:os.path.join(root, "zones", f"zones_{n}.shp") for n in zone_counts}, "arguments":arguments}
+	manifest_path = os.path.join(root, "archive.json")
+	try:
+		with open(manifest_path) as rf:
+			if json.load(rf) == arguments:
+				log.info(f"Reusing synthetic archive at {root}")
+				return archive
+	except (OSError, ValueError):
+		pass
+
+	for sub in ["products", "external", "masks", "zones"]:
+		os.makedirs(os.path.join(root, sub), exist_ok = True)
+	for p, product in enumerate(products):
+		if product not in SYNTHETIC_PRODUCTS:
+			raise BadInputError(f"No synthetic product '{product}'. Must be one of: {list(SYNTHETIC_PRODUCTS)}")
+		spec = SYNTHETIC_PRODUCTS[product]
+		profile = _profile(product, pixel_size, block_size)
+		product_dir = os.path.join(archive["external_dir" if product in EXTERNAL_PRODUCTS else "product_dir"], product)
+		os.makedirs(product_dir, exist_ok = True)
+		log.info(f"Writing {n_dates} dates of {product} ({profile['width']} x {profile['height']})")
+		variables = MERRA_VARIABLES if product == "merra-2" else [None]
+		for d, date in enumerate(synthetic_dates(n_dates, spec["cadence"])):
+			for v, variable in enumerate(variables):
+				rng = np.random.default_rng([seed, p, d, v])
+				array = _synthetic_data(rng, profile, spec["range"], nodata_fraction, ocean_fraction)
+				_write_raster(os.path.join(product_dir, synthetic_file_name(product, date, variable)), array, profile, overviews)
+		if product not in EXTERNAL_PRODUCTS:
+			mask_profile = dict(profile, dtype = "uint8", nodata = None)
+			for m, crop in enumerate(SYNTHETIC_MASKS):
+				rng = np.random.default_rng([seed, p, m, 1000])
+				mask = (rng.random((profile["height"], profile["width"])) < 0.5).astype("uint8")
+				_write_raster(os.path.join(archive["mask_dir"], f"{product}.{crop}.tif"), mask, mask_profile, False)
+
+	for n in zone_counts:
+		make_zones(archive["zones"][n], n, ocean_fraction, seed = seed)
+
+	with open(manifest_path, 'w') as wf:
+		json.dump(arguments, wf, indent = 2)
+	return archive
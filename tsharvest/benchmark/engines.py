@@ -0,0 +1,191 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import argparse, glob, json, resource, threading
+import multiprocessing as mp
+from time import perf_counter
+
+from ..zonal import multi_date_zonal_stats, get_windows, build_zone_index
+from ..executor import EXECUTORS
+
+
+def _process_tree(pid:int) -> list:
+	"""Returns pid and the pids of all its descendants (Linux only)"""
+	pids = [pid]
+	for task in glob.glob(f"/proc/{pid}/task/*/children"):
+		try:
+			with open(task) as rf:
+				children = [int(c) for c in rf.read().split()]
+		except OSError:
+			continue
+		for child in children:
+			pids += _process_tree(child)
+	return pids
+
+
+def _memory(pid:int) -> int:
+	"""Returns the proportional set size of a process in bytes, so
+	that pages shared between pool workers are only counted once
+	in total, or its resident set size if that is not available"""
+	for path, field in [(f"/proc/{pid}/smaps_rollup", "Pss:"), (f"/proc/{pid}/status", "VmRSS:")]:
+		try:
+			with open(path) as rf:
+				for line in rf:
+					if line.startswith(field):
+						return int(line.split()[1]) * 1024
+		except OSError:
+			continue
+	return 0
+
+
+class _MemorySampler(threading.Thread):
+	"""Samples the total memory of this process and its children
+	until stopped, keeping the peak"""
+	def __init__(self, interval:float = 0.05):
+		super().__init__(daemon = True)
+		self.interval = interval
+		self.peak = 0
+		self._stop_event = threading.Event()
+
+	def run(self):
+		pid = os.getpid()
+		while not self._stop_event.is_set():
+			self.peak = max(self.peak, sum(_memory(p) for p in _process_tree(pid)))
+			self._stop_event.wait(self.interval)
+
+	def stop(self) -> int:
+		self._stop_event.set()
+		self.join()
+		if self.peak == 0:
+			# no /proc; fall back to the largest single process
+			usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+			self.peak = usage * 1024
+		return self.peak
+
+
+def _measure(connection, engine:str, zone_raster:str, data_rasters:dict, mask_raster, n_cores:int, kwargs:dict) -> None:
+	# runs in a fresh process, so that every engine starts with a cold GDAL cache
+	sampler = _MemorySampler()
+	sampler.start()
+	start = perf_counter()
+	multi_date_zonal_stats(zone_raster, data_rasters, mask_raster, n_cores = n_cores, executor = engine, **kwargs)
+	seconds = perf_counter() - start
+	connection.send((seconds, sampler.stop()))
+	connection.close()
+
+
+def compare_engines(zone_raster:str, data_rasters:dict, mask_raster = None, n_cores:int = 1, engines:list = None, repeats:int = 1, **kwargs) -> list:
+	"""Times multi_date_zonal_stats under each execution engine and
+	records its peak memory
+
+	Every run is made in a new process. Memory is the peak total
+	proportional set size of that process and its workers, which
+	counts pages shared between workers (e.g. preloaded layers)
+	only once; it is sampled from /proc, so is only available on
+	Linux.
+
+	***
+
+	Parameters
+	----------
+	zone_raster: str
+		Path to input zone raster file
+	data_rasters: dict
+		Dictionary of {key:path}, e.g. {date:data_raster}
+	mask_raster: str or dict
+		Path to mask raster file, or dictionary of
+		{mask_name:path}. Default None
+	n_cores: int
+		Number of processes or threads. Default 1
+	engines: list
+		Names of executors to compare; see
+		executor.EXECUTORS. Default ["process", "thread"]
+	repeats: int
+		Number of runs of each engine. Default 1
+	kwargs:
+		Passed on to multi_date_zonal_stats
+
+	Returns
+	-------
+	List of dictionaries, one per run, with keys "engine",
+	"n_cores", "repeat", "seconds", "peak_memory_bytes" and
+	"mpix_per_second" (millions of data pixels read per second)
+	"""
+	engines = engines or ["process", "thread"]
+	windows = get_windows(list(data_rasters.values())[0], kwargs.get("block_scale_factor", 8), kwargs.get("default_block_size", 256), zone_raster)
+	zone_index = build_zone_index(zone_raster, windows, n_cores)
+	pixels = sum(int(w.width) * int(w.height) for w, counts in zone_index) * len(data_rasters)
+	kwargs["zone_index"] = zone_index
+
+	context = mp.get_context("spawn")
+	results = []
+	for repeat in range(int(repeats)):
+		for engine in engines:
+			receiver, sender = context.Pipe(duplex = False)
+			process = context.Process(target = _measure, args = (sender, engine, zone_raster, data_rasters, mask_raster, n_cores, kwargs))
+			process.start()
+			sender.close()
+			try:
+				seconds, peak = receiver.recv()
+			except EOFError:
+				process.join()
+				raise RuntimeError(f"Benchmark of the {engine} engine failed (exit code {process.exitcode})")
+			process.join()
+			results.append({"engine":engine, "n_cores":int(n_cores), "repeat":repeat, "seconds":seconds, "peak_memory_bytes":peak, "mpix_per_second":pixels / seconds / 1e6})
+			log.info(f"{engine}: {seconds:.2f} s, {peak / 2**20:.0f} MiB peak")
+	return results
+
+
+def format_results(results:list) -> str:
+	"""Formats the output of compare_engines as a table"""
+	lines = [f"{'engine':<12}{'cores':>6}{'seconds':>10}{'MPix/s':>10}{'peak MiB':>10}"]
+	for r in results:
+		lines.append(f"{r['engine']:<12}{r['n_cores']:>6}{r['seconds']:>10.2f}{r['mpix_per_second']:>10.1f}{r['peak_memory_bytes'] / 2**20:>10.0f}")
+	return "\n".join(lines)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare the throughput and memory of tsharvest execution engines")
+	parser.add_argument("zone_raster",
+		help="Path to zone raster, e.g. one cached by a tsharvest run")
+	parser.add_argument("data_rasters",
+		nargs="+",
+		help="Paths to data rasters on the grid of the zone raster")
+	parser.add_argument("-m",
+		"--mask_raster",
+		default=None,
+		help="Path to mask raster")
+	parser.add_argument("-c",
+		"--cores",
+		type=int,
+		default=4,
+		help="Number of processes or threads")
+	parser.add_argument("-e",
+		"--engines",
+		nargs="+",
+		default=["process", "thread"],
+		choices=EXECUTORS,
+		help="Engines to compare. Default process thread")
+	parser.add_argument("-r",
+		"--repeats",
+		type=int,
+		default=1,
+		help="Number of runs of each engine")
+	parser.add_argument("-o",
+		"--out_json",
+		default=None,
+		help="Path to write results to as JSON")
+	args = parser.parse_args()
+
+	results = compare_engines(args.zone_raster, {path:path for path in args.data_rasters}, args.mask_raster, args.cores, args.engines, args.repeats)
+	print(format_results(results))
+	if args.out_json:
+		with open(args.out_json, 'w') as wf:
+			json.dump(results, wf, indent = 2)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,140 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import argparse, json, statistics, subprocess, sys
+
+
+# packages that must not be imported until a run reads or writes data
+HEAVY_MODULES = ["rasterio", "geopandas", "fiona", "shapely", "pyproj", "osgeo", "pyarrow"]
+
+# command lines of the tsharvest script that should return at once; an
+# empty one only imports it. "validate" fails on its --statistics
+# argument, before any file is opened
+STARTUP_CASES = {
+	"import":[],
+	"help":["--help"],
+	"validate":["zones.shp", "MOD09Q1", "out.csv", "-f", "-c", "1", "-s", "not_a_statistic"],
+	}
+
+DEFAULT_BUDGET = 0.5
+
+# run in a fresh interpreter, so that nothing is imported already
+_CHILD = """
+import contextlib, io, json, sys
+from time import perf_counter
+start = perf_counter()
+sys.argv = ["tsharvest"] + {argv!r}
+outcome = "ok"
+with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+	try:
+		import tsharvest.command_line
+		if len(sys.argv) > 1:
+			tsharvest.command_line.main()
+	except SystemExit as e:
+		outcome = f"exit {{e.code}}"
+	except Exception as e:
+		outcome = type(e).__name__
+seconds = perf_counter() - start
+print(json.dumps({{"seconds":seconds, "outcome":outcome, "modules":[m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _run_case(argv:list) -> dict:
+	package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	env = dict(os.environ, LOGLEVEL="ERROR", PYTHONPATH=os.pathsep.join([package_root] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+	completed = subprocess.run([sys.executable, "-c", _CHILD.format(argv = argv, heavy = HEAVY_MODULES)], capture_output = True, text = True, env = env)
+	if completed.returncode != 0:
+		raise RuntimeError(f"Startup benchmark of {argv} failed:\n{completed.stderr}")
+	return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure_startup(cases:dict = None, repeats:int = 5) -> list:
+	"""Times how long the tsharvest script takes to get going, each
+	run in a new interpreter
+
+	Time is measured from the first line of the interpreter's
+	script, so it leaves out the start of Python itself, which
+	tsharvest cannot change.
+
+	***
+
+	Parameters
+	----------
+	cases: dict
+		{name:argv} of command lines to time; an empty argv
+		only imports tsharvest.command_line. Default
+		STARTUP_CASES
+	repeats: int
+		Number of runs of each case. Default 5
+
+	Returns
+	-------
+	List of dictionaries, one per case, with keys "case",
+	"seconds" (median over runs), "min_seconds", "outcome"
+	(e.g. "exit 0", or the name of the exception raised) and
+	"heavy_modules" (those of HEAVY_MODULES that were imported)
+	"""
+	cases = STARTUP_CASES if cases is None else cases
+	results = []
+	for name, argv in cases.items():
+		runs = [_run_case(argv) for repeat in range(max(1, int(repeats)))]
+		seconds = [run["seconds"] for run in runs]
+		results.append({"case":name, "seconds":statistics.median(seconds), "min_seconds":min(seconds), "outcome":runs[-1]["outcome"], "heavy_modules":sorted(set(m for run in runs for m in run["modules"]))})
+	return results
+
+
+def check_startup(results:list, budget:float = DEFAULT_BUDGET) -> list:
+	"""Returns a message for each case of measure_startup output that
+	took longer than budget seconds or imported a heavy module"""
+	failures = []
+	for r in results:
+		if r["seconds"] > budget:
+			failures.append(f"{r['case']} took {r['seconds']:.3f} s, over the budget of {budget:.3f} s")
+		if r["heavy_modules"]:
+			failures.append(f"{r['case']} imported {r['heavy_modules']}")
+	return failures
+
+
+def format_results(results:list) -> str:
+	"""Formats the output of measure_startup as a table"""
+	lines = [f"{'case':<12}{'seconds':>10}{'min':>10}  {'outcome':<20}heavy modules"]
+	for r in results:
+		lines.append(f"{r['case']:<12}{r['seconds']:>10.3f}{r['min_seconds']:>10.3f}  {r['outcome']:<20}{','.join(r['heavy_modules']) or '-'}")
+	return "\n".join(lines)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Check that the tsharvest script starts within its time budget, without importing geospatial packages")
+	parser.add_argument("-r",
+		"--repeats",
+		type=int,
+		default=5,
+		help="Number of runs of each case. Default 5")
+	parser.add_argument("-b",
+		"--budget",
+		type=float,
+		default=DEFAULT_BUDGET,
+		help=f"Seconds each case may take. Default {DEFAULT_BUDGET}")
+	parser.add_argument("-o",
+		"--out_json",
+		default=None,
+		help="Path to write results to as JSON")
+	args = parser.parse_args()
+
+	results = measure_startup(repeats = args.repeats)
+	print(format_results(results))
+	if args.out_json:
+		with open(args.out_json, 'w') as wf:
+			json.dump(results, wf, indent = 2)
+	failures = check_startup(results, args.budget)
+	for failure in failures:
+		log.error(failure)
+	if failures:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
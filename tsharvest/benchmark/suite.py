@@ -0,0 +1,268 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import argparse, itertools, json, platform, shutil, sys, tempfile
+from time import perf_counter
+import numpy as np
+import rasterio
+
+from .archive import make_archive
+from .._version import __version__
+from ..catalog import ArchiveCatalog
+from ..executor import EXECUTORS
+from ..output import open_stats_writer
+from ..util import reproject_shapefile, shapefile_toRaster, zone_field_toCodes
+from ..zonal import get_windows, build_zone_index, multi_date_zonal_stats
+from ..const import *
+
+
+STAGES = ["reproject", "rasterize", "catalog", "windows", "zonal", "output"]
+# parameters that identify a case when comparing runs
+CASE_KEYS = ["product", "n_zones", "block_scale_factor", "n_cores", "n_dates", "executor"]
+
+
+def _archive_name(product:str) -> str:
+	"""Returns the name a product's files and masks are stored under"""
+	return "merra-2" if "merra-2" in product else product
+
+
+def run_case(archive:dict, work_dir:str, product:str, n_zones:int, block_scale_factor:int = 8, n_cores:int = 1, n_dates:int = None, executor:str = "process", mask:str = "maize", statistics:list = None) -> dict:
+	"""Times each stage of a zonal statistics run over a synthetic
+	archive, the way command_line.run_zonal_stats runs them
+
+	The stages are:
+		"reproject": util.reproject_shapefile onto the
+			product's grid
+		"rasterize": util.shapefile_toRaster
+		"catalog": listing the product's files with a new
+			catalog.ArchiveCatalog
+		"windows": zonal.get_windows and
+			zonal.build_zone_index
+		"zonal": zonal.multi_date_zonal_stats over every date
+		"output": writing every date with
+			output.open_stats_writer
+
+	***
+
+	Parameters
+	----------
+	archive: dict
+		Output of archive.make_archive
+	work_dir: str
+		Directory for intermediate files, which is emptied
+	product: str
+		Name of product, e.g. "MOD09Q1" or "merra-2-mean"
+	n_zones: int
+		Number of zones; must be one of the archive's
+		zone_counts
+	block_scale_factor: int
+		Passed on to zonal.get_windows. Default 8
+	n_cores: int
+		Number of workers. Default 1
+	n_dates: int
+		Number of dates to calculate, from the start of the
+		archive. Default None, for all of them
+	executor: str
+		One of executor.EXECUTORS. Default "process"
+	mask: str
+		Crop mask to apply, if the product has it. Default
+		"maize"
+	statistics: list
+		Statistics to calculate. Default ["mean", "pixels"]
+
+	Returns
+	-------
+	Dictionary of the case's parameters, with "stages" (seconds
+	per stage), "pixels" (data pixels read by the zonal stage),
+	"zonal_mpix_per_second" and "seconds_per_date"
+	"""
+	shutil.rmtree(work_dir, ignore_errors = True)
+	os.makedirs(work_dir)
+	statistics = statistics or ["mean", "pixels"]
+	stages = {}
+
+	def timed(stage, function, *args, **kwargs):
+		start = perf_counter()
+		result = function(*args, **kwargs)
+		stages[stage] = perf_counter() - start
+		return result
+
+	with ArchiveCatalog(os.path.join(work_dir, "catalog.sqlite"), archive["product_dir"], archive["external_dir"]) as catalog:
+		files = timed("catalog", catalog.files, product)
+	if n_dates is not None:
+		files = dict(list(files.items())[:n_dates])
+	model_raster = list(files.values())[0]
+	mask_raster = os.path.join(archive["mask_dir"], f"{_archive_name(product)}.{mask}.tif") if mask else None
+	if (mask_raster is not None) and not os.path.exists(mask_raster):
+		mask_raster = None
+
+	shapefile = archive["zones"][n_zones]
+	reprojected = timed("reproject", reproject_shapefile, shapefile, model_raster, os.path.join(work_dir, "zones.shp"))
+	zone_raster = timed("rasterize", shapefile_toRaster, reprojected, model_raster, os.path.join(work_dir, "zones.tif"), zone_field = "ADM_CODE")
+
+	def plan():
+		windows = get_windows(model_raster, block_scale_factor, zone_raster = zone_raster)
+		return build_zone_index(zone_raster, windows, n_cores)
+	zone_index = timed("windows", plan)
+
+	output = timed("zonal", multi_date_zonal_stats, zone_raster, files, mask_raster, n_cores = n_cores, block_scale_factor = block_scale_factor, zone_index = zone_index, statistics = statistics, executor = executor)
+
+	def write():
+		zone_codes = zone_field_toCodes(reprojected, "ADM_CODE")
+		with open_stats_writer(os.path.join(work_dir, "stats.csv"), zone_codes, statistics) as writer:
+			for date, zone_stats in output.items():
+				writer.write(date, zone_stats)
+	timed("output", write)
+
+	pixels = sum(int(w.width) * int(w.height) for w, counts in zone_index) * len(files)
+	return {"product":product, "n_zones":n_zones, "block_scale_factor":block_scale_factor, "n_cores":n_cores, "n_dates":len(files), "executor":executor, "mask":(mask if mask_raster else None), "stages":stages, "pixels":pixels, "zonal_mpix_per_second":pixels / stages["zonal"] / 1e6, "seconds_per_date":stages["zonal"] / len(files)}
+
+
+def run_suite(archive:dict, work_dir:str, products:list, zone_counts:list, block_scale_factors:list, core_counts:list, archive_lengths:list, executor:str = "process", repeats:int = 1, label:str = None, **kwargs) -> dict:
+	"""Runs run_case for every combination of parameters
+
+	With several repeats, each stage's fastest time is kept, since
+	the slower ones are mostly noise from the rest of the machine.
+	Other keyword arguments are passed on to run_case.
+
+	Returns
+	-------
+	Dictionary with "meta" (versions, host and archive
+	arguments) and "cases" (a list of run_case outputs)
+	"""
+	cases = []
+	for product, n_zones, block_scale_factor, n_cores, n_dates in itertools.product(products, zone_counts, block_scale_factors, core_counts, archive_lengths):
+		best = None
+		for repeat in range(int(repeats)):
+			case = run_case(archive, work_dir, product, n_zones, block_scale_factor, n_cores, n_dates, executor, **kwargs)
+			if best is None:
+				best = case
+			else:
+				best["stages"] = {stage:min(seconds, case["stages"][stage]) for stage, seconds in best["stages"].items()}
+		best["zonal_mpix_per_second"] = best["pixels"] / best["stages"]["zonal"] / 1e6
+		best["seconds_per_date"] = best["stages"]["zonal"] / best["n_dates"]
+		log.info(f"{product}, {n_zones} zones, block scale {block_scale_factor}, {n_cores} cores, {best['n_dates']} dates: " + ", ".join(f"{stage} {seconds:.3f} s" for stage, seconds in best["stages"].items()))
+		cases.append(best)
+
+	meta = {"label":label, "timestamp":datetime.now().isoformat(), "tsharvest":__version__, "python":platform.python_version(), "numpy":np.__version__, "rasterio":rasterio.__version__, "gdal":rasterio.__gdal_version__, "host":platform.node(), "cpu_count":os.cpu_count(), "executor":executor, "repeats":int(repeats), "archive":archive["arguments"]}
+	return {"meta":meta, "cases":cases}
+
+
+def _case_key(case:dict) -> tuple:
+	return tuple(case[k] for k in CASE_KEYS)
+
+
+def compare_results(old:dict, new:dict) -> list:
+	"""Matches the cases of two run_suite outputs
+
+	Returns a list of (case_key, stage, old_seconds, new_seconds)
+	tuples for every stage of every case present in both
+	"""
+	old_cases = {_case_key(case):case for case in old["cases"]}
+	rows = []
+	for case in new["cases"]:
+		key = _case_key(case)
+		if key not in old_cases:
+			continue
+		for stage in STAGES:
+			if (stage in case["stages"]) and (stage in old_cases[key]["stages"]):
+				rows.append((key, stage, old_cases[key]["stages"][stage], case["stages"][stage]))
+	return rows
+
+
+def format_comparison(rows:list) -> str:
+	"""Formats the output of compare_results as a table"""
+	lines = [f"{'case':<44}{'stage':<11}{'old s':>9}{'new s':>9}{'change':>9}"]
+	for key, stage, old_seconds, new_seconds in rows:
+		case = "/".join(str(k) for k in key)
+		change = (new_seconds / old_seconds - 1) * 100 if old_seconds > 0 else 0
+		lines.append(f"{case:<44}{stage:<11}{old_seconds:>9.3f}{new_seconds:>9.3f}{change:>+8.0f}%")
+	return "\n".join(lines)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Time the stages of tsharvest on a synthetic GLAM-style archive")
+	parser.add_argument("--archive_dir",
+		default=os.path.join(tempfile.gettempdir(), "tsharvest_benchmark_archive"),
+		help="Where to generate the synthetic archive; reused if it was made with the same settings")
+	parser.add_argument("-p",
+		"--products",
+		nargs="+",
+		default=["MOD09Q1", "chirps", "merra-2-mean", "chirps_gefs"],
+		help="Products to benchmark. Default MOD09Q1 chirps merra-2-mean chirps_gefs")
+	parser.add_argument("-z",
+		"--zone_counts",
+		nargs="+",
+		type=int,
+		default=[10, 100],
+		help="Numbers of zones. Default 10 100")
+	parser.add_argument("-b",
+		"--block_scale_factors",
+		nargs="+",
+		type=int,
+		default=[2, 8],
+		help="Window sizes, as multiples of the raster block size. Default 2 8")
+	parser.add_argument("-c",
+		"--cores",
+		nargs="+",
+		type=int,
+		default=[1, 4],
+		help="Numbers of workers. Default 1 4")
+	parser.add_argument("-d",
+		"--dates",
+		nargs="+",
+		type=int,
+		default=[4, 16],
+		help="Archive lengths, in dates. Default 4 16")
+	parser.add_argument("--pixel_size",
+		type=float,
+		default=0.01,
+		help="Pixel size of the finest synthetic products, in degrees. Default 0.01")
+	parser.add_argument("--executor",
+		default="process",
+		choices=EXECUTORS,
+		help="Executor to run the zonal stage on. Default process")
+	parser.add_argument("-r",
+		"--repeats",
+		type=int,
+		default=1,
+		help="Runs of each case; the fastest time of each stage is kept")
+	parser.add_argument("-l",
+		"--label",
+		default=None,
+		help="Label stored with the results, e.g. a git commit")
+	parser.add_argument("-o",
+		"--out_json",
+		default="tsharvest_benchmark.json",
+		help="Path to write results to")
+	parser.add_argument("--compare",
+		nargs=2,
+		metavar=("OLD_JSON", "NEW_JSON"),
+		default=None,
+		help="Compare two result files instead of running the suite")
+	args = parser.parse_args()
+
+	if args.compare:
+		with open(args.compare[0]) as rf:
+			old = json.load(rf)
+		with open(args.compare[1]) as rf:
+			new = json.load(rf)
+		print(format_comparison(compare_results(old, new)))
+		return
+
+	archive = make_archive(args.archive_dir, sorted(set(_archive_name(p) for p in args.products)), max(args.dates), args.zone_counts, args.pixel_size)
+	work_dir = tempfile.mkdtemp(prefix = "tsharvest_benchmark.")
+	try:
+		results = run_suite(archive, work_dir, args.products, args.zone_counts, args.block_scale_factors, args.cores, args.dates, args.executor, args.repeats, args.label)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors = True)
+	with open(args.out_json, 'w') as wf:
+		json.dump(results, wf, indent = 2)
+	log.info(f"Results written to {args.out_json}")
+
+
+if __name__ == "__main__":
+	main()
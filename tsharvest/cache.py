@@ -0,0 +1,279 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import glob, hashlib, json, shutil, uuid
+
+from .util import open_raster
+from .const import *
+
+
+class DiskCache:
+	"""Size-limited directory cache with least-recently-used eviction
+
+	Each entry is a directory named after its key. Reading an
+	entry refreshes its modification time, and entries with the
+	oldest modification times are evicted first once the cache
+	grows beyond max_bytes.
+
+	***
+
+	Parameters
+	----------
+	cache_dir: str
+		Directory in which entries are stored
+	max_bytes: int
+		Total size above which entries are evicted
+	"""
+	def __init__(self, cache_dir:str, max_bytes:int):
+		self.cache_dir = cache_dir
+		self.max_bytes = int(max_bytes)
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		# running estimate of total size, so that not every put lists the cache
+		self._total_bytes = None
+
+	def get(self, key:str):
+		"""Returns path to entry directory, or None on a miss"""
+		entry = os.path.join(self.cache_dir, key)
+		if not os.path.isdir(entry):
+			return None
+		os.utime(entry)
+		return entry
+
+	def put(self, key:str, files:dict) -> str:
+		"""Moves files into a new entry and returns its path
+
+		***
+
+		Parameters
+		----------
+		key: str
+			Entry key
+		files: dict
+			Dictionary of {name_in_entry:source_path}. Source
+			files are moved, not copied
+		"""
+		entry = os.path.join(self.cache_dir, key)
+		staging = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}")
+		os.makedirs(staging)
+		for name, source in files.items():
+			shutil.move(source, os.path.join(staging, name))
+		try:
+			os.rename(staging, entry)
+		except OSError: # another process stored the same entry first
+			shutil.rmtree(staging, ignore_errors=True)
+		if self._total_bytes is None:
+			self.evict()
+		else:
+			self._total_bytes += _entry_size(entry)
+			if self._total_bytes > self.max_bytes:
+				self.evict()
+		return entry
+
+	def evict(self) -> None:
+		"""Removes least-recently-used entries until cache fits in max_bytes"""
+		entries = []
+		for entry in glob.glob(os.path.join(self.cache_dir, "*")):
+			entries.append((os.path.getmtime(entry), _entry_size(entry), entry))
+		total = sum(size for mtime, size, entry in entries)
+		for mtime, size, entry in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			log.debug(f"Evicting {os.path.basename(entry)} from {self.cache_dir}")
+			shutil.rmtree(entry, ignore_errors=True)
+			total -= size
+		self._total_bytes = total
+
+
+def _entry_size(entry:str) -> int:
+	return sum(os.path.getsize(f) for f in glob.glob(os.path.join(entry, "*")))
+
+
+class ResultCache:
+	"""Cache of finished zonal statistics, one entry per data file
+
+	Entries are keyed by result_key, so a result is reused by any
+	later run, by any user sharing the cache, that burns the same
+	zones onto the same grid and asks for the same statistics of
+	an unchanged data file under the same masks. Each result is
+	stored as soon as it is finished, which lets an interrupted
+	run resume where it stopped. Entries are stored in a DiskCache
+	and evicted least-recently-used first.
+
+	***
+
+	Parameters
+	----------
+	cache_dir: str
+		Directory in which entries are stored. Default
+		CACHE_DIR/results, as CACHE_DIR is when the cache
+		is created
+	max_bytes: int
+		Total size above which entries are evicted. Default
+		RESULT_CACHE_MAX_BYTES
+	"""
+	def __init__(self, cache_dir:str = None, max_bytes:int = RESULT_CACHE_MAX_BYTES):
+		if cache_dir is None:
+			cache_dir = os.path.join(CACHE_DIR, "results")
+		self._cache = DiskCache(cache_dir, max_bytes)
+
+	def get(self, key:str):
+		"""Returns cached output of zonal.run_zonal_jobs for one data
+		file, or None on a miss"""
+		entry = self._cache.get(key)
+		if entry is None:
+			return None
+		try:
+			with open(os.path.join(entry, "result.json"),'r') as rf:
+				stored = json.load(rf)
+		except (OSError, ValueError): # evicted or half-written by another process
+			return None
+		if stored["masks"] is None:
+			return _zone_stats_from_json(stored["zones"])
+		return {mask:_zone_stats_from_json(zones) for mask, zones in stored["masks"]}
+
+	def put(self, key:str, result:dict, masks:bool = False) -> None:
+		"""Stores output of zonal.run_zonal_jobs for one data file
+
+		If masks is set, result is {mask_name:zonal_stats_output}
+		"""
+		if masks:
+			stored = {"masks":[[mask, _zone_stats_to_json(zone_stats)] for mask, zone_stats in result.items()], "zones":None}
+		else:
+			stored = {"masks":None, "zones":_zone_stats_to_json(result)}
+		result_file = os.path.join(TEMP_DIR, f"{key}.{uuid.uuid4().hex}.json")
+		with open(result_file,'w') as wf:
+			json.dump(stored, wf)
+		self._cache.put(key, {"result.json":result_file})
+
+
+def _python(value):
+	return value.item() if hasattr(value, "item") else value
+
+
+def _zone_stats_to_json(zone_stats:dict) -> list:
+	return [[_python(zone), {stat:_python(value) for stat, value in stats.items()}] for zone, stats in zone_stats.items()]
+
+
+def _zone_stats_from_json(zones:list) -> dict:
+	return {zone:stats for zone, stats in zones}
+
+
+def _signature(file_path:str):
+	if file_path is None:
+		return None
+	file_stat = os.stat(file_path)
+	return [file_path, file_stat.st_size, file_stat.st_mtime]
+
+
+def result_key(zone_key:str, data_path:str, mask_paths = None, statistics:list = None, histogram_range = None, histogram_bins:int = None) -> str:
+	"""Generates cache key for the zonal statistics of one data file
+
+	***
+
+	Parameters
+	----------
+	zone_key: str
+		Output of zone_layer_key for the zone raster
+	data_path: str
+		Path to data file; its size and modification time
+		are part of the key
+	mask_paths: str, list or dict
+		Path to mask file, list of paths, or dictionary of
+		{mask_name:path}. Default None
+	statistics: list
+		Names of requested statistics. Default None
+	histogram_range: tuple
+		Histogram range used for percentiles. Default None
+	histogram_bins: int
+		Histogram bins used for percentiles. Default None
+
+	Returns
+	-------
+	String sha256 hex digest
+	"""
+	if isinstance(mask_paths, dict):
+		masks = [[name, _signature(path)] for name, path in mask_paths.items()]
+	elif isinstance(mask_paths, (list, tuple)):
+		masks = [_signature(path) for path in mask_paths]
+	else:
+		masks = _signature(mask_paths)
+	histogram = [list(histogram_range) if histogram_range is not None else None, histogram_bins]
+	blob = json.dumps([zone_key, _signature(data_path), masks, statistics, histogram])
+	return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def hash_shapefile(shapefile_path:str) -> str:
+	"""Returns sha256 hex digest of all files that make up a shapefile"""
+	in_dir = os.path.dirname(shapefile_path)
+	in_name = os.path.splitext(os.path.basename(shapefile_path))[0]
+	digest = hashlib.sha256()
+	for f in sorted(glob.glob(os.path.join(in_dir, f"{in_name}.*"))):
+		digest.update(os.path.splitext(f)[1].lower().encode())
+		with open(f,'rb') as rf:
+			for chunk in iter(lambda: rf.read(1024 * 1024), b""):
+				digest.update(chunk)
+	return digest.hexdigest()
+
+
+def zone_layer_key(shapefile_path:str, model_raster:str, zone_field:str = None, dtype = None, clip:bool = True, overview_level:int = None) -> str:
+	"""Generates cache key for a zone raster
+
+	The key covers everything that determines the burned output:
+	the contents of the shapefile, the zone field, the output data
+	type, whether it is clipped, and the grid (CRS, transform and
+	shape) of the model raster.
+
+	***
+
+	Parameters
+	----------
+	shapefile_path: str
+		Path to input shapefile
+	model_raster: str
+		Path to raster whose grid the zones are burned onto
+	zone_field: str
+		Field in shapefile used as raster value. Default None
+	dtype: str
+		Data type override passed to shapefile_toRaster.
+		Default None
+	clip: bool
+		Whether the zone raster is clipped to the shapefile's
+		bounding box. Default True
+	overview_level: int
+		Overview level of model_raster the zones are burned
+		onto, or None for full resolution. Default None
+
+	Returns
+	-------
+	String sha256 hex digest
+	"""
+	with open_raster(model_raster, overview_level) as img:
+		grid = [img.crs.to_wkt(), list(img.transform)[:6], img.width, img.height]
+	key_parts = [hash_shapefile(shapefile_path), zone_field, str(dtype), grid, clip]
+	if overview_level is not None:
+		key_parts.append(int(overview_level))
+	blob = json.dumps(key_parts)
+	return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def zone_codes_key(shapefile_path:str, zone_field:str) -> str:
+	"""Generates cache key for a zone code table"""
+	blob = json.dumps([hash_shapefile(shapefile_path), zone_field])
+	return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def write_zone_codes(zone_code_dict:dict, out_path:str) -> str:
+	"""Writes output of zone_field_toCodes to json"""
+	with open(out_path,'w') as wf:
+		json.dump({int(code):(name.item() if hasattr(name, "item") else name) for code, name in zone_code_dict.items()}, wf)
+	return out_path
+
+
+def read_zone_codes(in_path:str) -> dict:
+	"""Reads json written by write_zone_codes"""
+	with open(in_path,'r') as rf:
+		return {int(code):name for code, name in json.load(rf).items()}
@@ -0,0 +1,172 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import glob, json, sqlite3
+
+from .util import dateFromFilePath, open_raster
+from .const import *
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+	product TEXT NOT NULL,
+	directory TEXT NOT NULL,
+	mtime REAL NOT NULL,
+	PRIMARY KEY (product, directory)
+);
+CREATE TABLE IF NOT EXISTS files (
+	product TEXT NOT NULL,
+	directory TEXT NOT NULL,
+	date TEXT NOT NULL,
+	path TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	PRIMARY KEY (product, path)
+);
+CREATE INDEX IF NOT EXISTS files_by_date ON files (product, directory, date);
+CREATE TABLE IF NOT EXISTS grids (
+	path TEXT PRIMARY KEY,
+	mtime REAL NOT NULL,
+	crs TEXT,
+	transform TEXT NOT NULL,
+	width INTEGER NOT NULL,
+	height INTEGER NOT NULL,
+	dtype TEXT NOT NULL,
+	nodata REAL,
+	block_width INTEGER,
+	block_height INTEGER
+);
+"""
+
+
+def product_files(product:str, product_dir:str = PRODUCT_DIR, external_dir:str = EXTERNAL_DIR) -> tuple:
+	"""Returns (directory, glob pattern) of a product's data files"""
+	if "merra-2" in product:
+		merra_variable = product.split("-")[2]
+		return os.path.join(product_dir, "merra-2"), f"merra-2.*.{merra_variable}.tif"
+	elif product in EXTERNAL_PRODUCTS:
+		return os.path.join(external_dir, product), "*.tif"
+	return os.path.join(product_dir, product), f"{product}.*.tif"
+
+
+class ArchiveCatalog:
+	"""Persistent SQLite catalog of the data archive
+
+	Records the date, size and modification time of every data
+	file of a product, so that runs query dates with an index
+	instead of globbing the archive and parsing every file name.
+	A product's directory is only listed again when its
+	modification time changes, i.e. when files are added,
+	removed or replaced; files rewritten in place are not
+	noticed until refresh is called with force=True. Raster
+	grid metadata is cached alongside, keyed by path and
+	modification time.
+
+	***
+
+	Parameters
+	----------
+	catalog_path: str
+		Path to SQLite database, created if it does not exist.
+		Default CATALOG_PATH
+	product_dir: str
+		Directory of GLAM products. Default PRODUCT_DIR
+	external_dir: str
+		Directory of external products. Default EXTERNAL_DIR
+	"""
+	def __init__(self, catalog_path:str = CATALOG_PATH, product_dir:str = PRODUCT_DIR, external_dir:str = EXTERNAL_DIR):
+		self.catalog_path = catalog_path
+		self.product_dir = product_dir
+		self.external_dir = external_dir
+		catalog_dir = os.path.dirname(os.path.abspath(catalog_path))
+		if not os.path.exists(catalog_dir):
+			os.makedirs(catalog_dir)
+		self._db = sqlite3.connect(catalog_path, timeout=60)
+		self._db.executescript(_SCHEMA)
+
+	def refresh(self, product:str, force:bool = False) -> bool:
+		"""Brings a product's entries up to date with its directory
+
+		Returns whether the directory was listed, i.e. whether
+		it changed since the last refresh or force was set
+		"""
+		directory, pattern = product_files(product, self.product_dir, self.external_dir)
+		try:
+			dir_mtime = os.stat(directory).st_mtime
+		except FileNotFoundError:
+			dir_mtime = -1.0
+		row = self._db.execute("SELECT mtime FROM directories WHERE product = ? AND directory = ?", (product, directory)).fetchone()
+		if (not force) and (row is not None) and (row[0] == dir_mtime):
+			return False
+
+		log.debug(f"Listing {directory} for {product}")
+		entries = []
+		for f in glob.glob(os.path.join(directory, pattern)):
+			file_stat = os.stat(f)
+			entries.append((product, directory, dateFromFilePath(f).strftime("%Y-%m-%d"), f, file_stat.st_size, file_stat.st_mtime))
+		with self._db:
+			self._db.execute("DELETE FROM files WHERE product = ? AND directory = ?", (product, directory))
+			self._db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", entries)
+			self._db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (product, directory, dir_mtime))
+		return True
+
+	def files(self, product:str, start_date = None, end_date = None, refresh:bool = True) -> dict:
+		"""Returns {"YYYY-MM-DD":file_path} of a product's data files
+		within a date range, in date order
+
+		***
+
+		Parameters
+		----------
+		product: str
+			Name of desired product
+		start_date: datetime.date
+			Beginning date of imagery, inclusive. Default None
+		end_date: datetime.date
+			End date of imagery, inclusive. Default None
+		refresh: bool
+			Whether to refresh the product first. Default True
+		"""
+		if refresh:
+			self.refresh(product)
+		directory, pattern = product_files(product, self.product_dir, self.external_dir)
+		query = "SELECT date, path FROM files WHERE product = ? AND directory = ?"
+		params = [product, directory]
+		if start_date:
+			query += " AND date >= ?"
+			params.append(start_date.strftime("%Y-%m-%d"))
+		if end_date:
+			query += " AND date <= ?"
+			params.append(end_date.strftime("%Y-%m-%d"))
+		return dict(self._db.execute(query + " ORDER BY date, path", params).fetchall())
+
+	def grid(self, raster_path:str) -> dict:
+		"""Returns grid metadata of a raster, reading it only if the
+		raster changed since it was last cached
+
+		Keys are "crs" (WKT), "transform" (first six affine
+		coefficients), "width", "height", "dtype", "nodata",
+		"block_width" and "block_height"
+		"""
+		mtime = os.stat(raster_path).st_mtime
+		row = self._db.execute("SELECT crs, transform, width, height, dtype, nodata, block_width, block_height FROM grids WHERE path = ? AND mtime = ?", (raster_path, mtime)).fetchone()
+		if row is None:
+			with open_raster(raster_path) as img:
+				block_height, block_width = img.block_shapes[0]
+				row = ((img.crs.to_wkt() if img.crs else None), json.dumps(list(img.transform)[:6]), img.width, img.height, img.dtypes[0], img.nodata, block_width, block_height)
+			with self._db:
+				self._db.execute("INSERT OR REPLACE INTO grids VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (raster_path, mtime, *row))
+		crs, transform, width, height, dtype, nodata, block_width, block_height = row
+		return {"crs":crs, "transform":tuple(json.loads(transform)), "width":width, "height":height, "dtype":dtype, "nodata":nodata, "block_width":block_width, "block_height":block_height}
+
+	def close(self) -> None:
+		self._db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
@@ -4,16 +4,25 @@ from datetime import datetime, timedelta
 logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
 log = logging.getLogger(__name__)
 
-import argparse, glob
+import argparse, contextlib, glob, json, uuid
 from datetime import datetime
-from .zonal import zonal_stats
+from .zonal import DEFAULT_OVERVIEW_MIN_PIXELS, run_zonal_jobs, get_windows, build_zone_index, zone_pixel_counts, restrict_zone_index
 from .util import *
+from .output import CsvStatsWriter, open_stats_writer, iter_stats, iter_stats_rows, read_statistics, read_group_columns
+from .stats import STATISTICS, validate_statistics, statistic_key, default_histogram
+from .cube import StatsCube
+from .catalog import ArchiveCatalog
+from .executor import EXECUTORS
+from .tuning import AUTO, resolve_cores, tune
+from .profiling import profile, span
+from .cache import DiskCache, ResultCache, result_key, zone_layer_key, zone_codes_key, read_zone_codes, write_zone_codes
 from .const import *
 from .exceptions import *
 
 
-def multi_zonal_stats(input_vector:str, product:str, mask:str = None, start_date:str=None, end_date:str=None, full_archive:bool = False, verbose:bool = False, *args, **kwargs) -> dict:
-	"""Run zonal.zonal_stats over multiple files
+def burn_zone_layer(input_vector:str, model_raster:str, zone_field:str = None, dtype = None, use_cache:bool = True, clip:bool = True, overview_level:int = None, *args, **kwargs) -> str:
+	"""Reprojects and rasterizes a zone shapefile onto the grid of
+	a model raster, reusing a previous result if one is cached
 
 	***
 
@@ -21,10 +30,298 @@ def multi_zonal_stats(input_vector:str, product:str, mask:str = None, start_date
 	----------
 	input_vector: str
 		Path to vector zone file on disk
+	model_raster: str
+		Path to raster whose grid the zones are burned onto
+	zone_field: str
+		If shapefile has multiple zones, name of numeric field
+		to use for zone values. Default None
+	dtype: str
+		If set, overrides default zone raster data type.
+		Default None
+	use_cache: bool
+		Whether to look up and store the result in the zone
+		layer cache at CACHE_DIR. Default True
+	clip: bool
+		Whether to burn only the bounding box of the zones
+		instead of the full extent of model_raster. Default
+		True
+	overview_level: int
+		If set, burn onto this overview level of model_raster
+		instead of its full resolution grid. Default None
+
+	Returns
+	-------
+	String path to zone raster. If use_cache is False, this is a
+	scratch file in TEMP_DIR, which the caller removes when done
+	with it (see remove_scratch)
+	"""
+	if use_cache:
+		zone_cache = DiskCache(os.path.join(CACHE_DIR, "zones"), ZONE_CACHE_MAX_BYTES)
+		key = zone_layer_key(input_vector, model_raster, zone_field, dtype, clip, overview_level)
+		entry = zone_cache.get(key)
+		if entry is not None:
+			log.debug(f"Zone layer cache hit for {os.path.basename(input_vector)}")
+			return os.path.join(entry, "zones.tif")
+
+	# define new file names, unique so that burns onto other grids, or by other runs, do not overwrite them
+	name, ext = os.path.splitext(os.path.basename(input_vector))
+	stem = os.path.join(TEMP_DIR, f"{name}.{uuid.uuid4().hex}")
+	reprojected_shape = f"{stem}{ext}"
+	rasterized_shape = f"{stem}.tif" if overview_level is None else f"{stem}.ov{overview_level}.tif"
+
+	# reproject and rasterize shape; the reprojected shapefile is only needed for this
+	try:
+		with span("reproject", shapefile = os.path.basename(input_vector)):
+			reproject_shapefile(input_vector, model_raster, reprojected_shape)
+		with span("rasterize", shapefile = os.path.basename(input_vector)):
+			shapefile_toRaster(reprojected_shape, model_raster, rasterized_shape, zone_field = zone_field, dtype = dtype, clip = clip, overview_level = overview_level)
+	finally:
+		remove_scratch([f for f in glob.glob(f"{glob.escape(stem)}.*") if f != rasterized_shape])
+
+	# make sure the rasterization worked
+	assert os.path.exists(rasterized_shape)
+
+	if use_cache:
+		entry = zone_cache.put(key, {"zones.tif":rasterized_shape})
+		return os.path.join(entry, "zones.tif")
+
+	return rasterized_shape
+
+
+def remove_scratch(paths:list) -> None:
+	"""Removes scratch files written to TEMP_DIR, e.g. zone rasters
+	burned with use_cache off"""
+	for path in paths:
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			continue
+		except OSError:
+			log.warning(f"Failed to remove {path}")
+
+
+def get_zone_codes(input_vector:str, zone_field:str, use_cache:bool = True) -> dict:
+	"""Returns output of util.zone_field_toCodes, reusing a
+	previous result if one is cached"""
+	if not use_cache:
+		return zone_field_toCodes(input_vector, zone_field)
+	zone_cache = DiskCache(os.path.join(CACHE_DIR, "zones"), ZONE_CACHE_MAX_BYTES)
+	key = zone_codes_key(input_vector, zone_field)
+	entry = zone_cache.get(key)
+	if entry is None:
+		codes_file = write_zone_codes(zone_field_toCodes(input_vector, zone_field), os.path.join(TEMP_DIR, f"{key}.json"))
+		entry = zone_cache.put(key, {"zone_codes.json":codes_file})
+	return read_zone_codes(os.path.join(entry, "zone_codes.json"))
+
+
+def get_data_files(product:str, start_date = None, end_date = None, catalog = None) -> dict:
+	"""Finds the archive files of a product within a date range
+
+	Files are looked up in the archive catalog, which is
+	refreshed first if the product's directory has changed.
+
+	***
+
+	Parameters
+	----------
 	product: str
 		Name of desired product
-	mask: str
-		Name of desired crop mask
+	start_date: datetime.date
+		Beginning date of imagery, inclusive. Default None
+	end_date: datetime.date
+		End date of imagery, inclusive. Default None
+	catalog: catalog.ArchiveCatalog
+		Catalog to query. If None, the catalog at CATALOG_PATH
+		is used. Default None
+
+	Returns
+	-------
+	Dictionary of {"YYYY-MM-DD":file_path}, in date order
+	"""
+	if catalog is None:
+		with ArchiveCatalog(CATALOG_PATH, PRODUCT_DIR, EXTERNAL_DIR) as catalog:
+			return get_data_files(product, start_date, end_date, catalog)
+
+	# make sure some files were found
+	catalog.refresh(product)
+	assert len(catalog.files(product, refresh = False)) > 0
+
+	# filter by date
+	data_dict = catalog.files(product, start_date, end_date, refresh = False)
+
+	# make sure there's at least one file in the time period of interest
+	assert len(data_dict) > 0
+
+	return data_dict
+
+
+# mask name written for products that have none of the requested masks
+NO_MASK = "none"
+
+
+def _mask_file(product:str, mask:str) -> str:
+	"""Returns where a product's crop mask would be stored"""
+	if "merra-2" in product:
+		product = "merra-2"
+	return os.path.join(MASK_DIR, f"{product}.{mask}.tif")
+
+
+def _mask_path(product:str, mask:str):
+	"""Returns path to a product's crop mask, or None if it does not exist"""
+	mask_path = _mask_file(product, mask)
+	if not os.path.exists(mask_path):
+		log.warning(f"Mask '{mask}' does not exist for product '{product}.' Running with no mask.")
+		return None
+	return mask_path
+
+
+def _grid(raster_path:str, catalog) -> tuple:
+	"""Returns (crs, transform, width, height) of a raster, for
+	grouping products that can share a zone raster"""
+	grid = catalog.grid(raster_path)
+	return grid["crs"], grid["transform"], grid["width"], grid["height"]
+
+
+def _check_histograms(data_dicts:dict, statistics:list, histogram_range, catalog) -> None:
+	"""Raises BadInputError if percentiles are requested of a product
+	whose data type has no default histogram (see
+	stats.default_histogram), before any work is done"""
+	if histogram_range is not None:
+		return
+	for p, data_dict in data_dicts.items():
+		if len(data_dict) > 0:
+			try:
+				default_histogram(catalog.grid(list(data_dict.values())[0])["dtype"], statistics)
+			except BadInputError as e:
+				raise BadInputError(f"{p}: {e.args[0]}") from e
+
+
+def _available_masks(product:str, masks:list) -> list:
+	"""Returns names of the masks that exist for a product, or
+	[NO_MASK] if none of them do"""
+	available = [mask for mask in dict.fromkeys(masks) if os.path.exists(_mask_file(product, mask))]
+	return available if len(available) > 0 else [NO_MASK]
+
+
+def _mask_rasters(product:str, masks:list) -> dict:
+	"""Returns {mask_name:path} for the masks that exist for a
+	product; a product with none of them is run with no mask,
+	named NO_MASK"""
+	available = _available_masks(product, masks)
+	for mask in dict.fromkeys(masks):
+		if mask not in available:
+			log.warning(f"Mask '{mask}' does not exist for product '{product}.' Leaving it out.")
+	if available == [NO_MASK]:
+		log.warning(f"None of the masks exist for product '{product}.' Running with no mask.")
+		return {NO_MASK:None}
+	return {mask:_mask_file(product, mask) for mask in available}
+
+
+def _writer_callback(writer, product:str, by_mask:bool):
+	"""Returns a zonal.run_zonal_jobs callback that writes one
+	product's output, filling in the writer's group columns"""
+	groups = {"product":product} if "product" in writer.group_columns else {}
+	if not by_mask:
+		if len(groups) == 0:
+			return writer.write
+		return lambda date, zone_stats: writer.write(date, zone_stats, **groups)
+	def callback(date, mask_stats):
+		for mask_name, zone_stats in mask_stats.items():
+			writer.write(date, zone_stats, mask = mask_name, **groups)
+	return callback
+
+
+def _zone_codes(input_vector:str, zone_field:str, use_cache:bool = True) -> list:
+	"""Returns every zone code that shapefile_toRaster burns for a shapefile"""
+	if zone_field is None:
+		return [1]
+	return list(get_zone_codes(input_vector, zone_field, use_cache))
+
+
+def _masks_toOverview(job:dict, model_raster:str, overview_level:int, scratch:list) -> None:
+	"""Swaps a job's masks for copies on an overview level of
+	model_raster, adding the copies to scratch for removal"""
+	def resample(mask_path):
+		if mask_path is None:
+			return None
+		# unique, since other grids or runs may resample the same mask
+		out_path = os.path.join(TEMP_DIR, f"{os.path.splitext(os.path.basename(mask_path))[0]}.{uuid.uuid4().hex}.ov{overview_level}.tif")
+		scratch.append(out_path)
+		with span("resample", mask = os.path.basename(mask_path)):
+			return resample_toOverview(mask_path, model_raster, overview_level, out_path)
+	if "mask_rasters" in job:
+		job["mask_rasters"] = {name:resample(path) for name, path in job["mask_rasters"].items()}
+	else:
+		job["mask_raster"] = resample(job["mask_raster"])
+
+
+def _with_fallback(overview_stats:dict, fallback_stats:dict, small_zones:set, by_mask:bool) -> dict:
+	"""Replaces the overview statistics of small zones with their
+	full resolution statistics"""
+	if by_mask:
+		return {name:_with_fallback(overview_stats[name], fallback_stats.get(name, {}), small_zones, False) for name in overview_stats}
+	merged = {zone:stats for zone, stats in overview_stats.items() if zone not in small_zones}
+	merged.update({zone:stats for zone, stats in fallback_stats.items() if zone in small_zones})
+	return merged
+
+
+def _with_fallback_cube(overview_cube, fallback_cube, small_zones:set, path:str = None):
+	"""Replaces the overview statistics of small zones in a
+	StatsCube, or {mask_name:StatsCube}, with their full resolution
+	statistics, in a new cube created in path if that is set"""
+	if isinstance(overview_cube, dict):
+		return {name:_with_fallback_cube(overview_cube[name], fallback_cube[name], small_zones, (os.path.join(path, name) if path is not None else None)) for name in overview_cube}
+	# the fallback also covers the other zones of its windows; every
+	# small zone with pixels at overview level has them at full resolution too
+	small = [zone for zone in fallback_cube.zones.tolist() if zone in small_zones]
+	return overview_cube.merge(fallback_cube.select(small), path)
+
+
+def _fallback_callbacks(callback, small_zones:set, by_mask:bool) -> tuple:
+	"""Returns (overview_callback, fallback_callback) that pass each
+	date on to callback once both of its parts are finished"""
+	parts = {}
+	def part_callback(i):
+		def store(date, zone_stats):
+			parts.setdefault(date, [None, None])[i] = zone_stats
+			if None not in parts[date]:
+				overview_stats, fallback_stats = parts.pop(date)
+				callback(date, _with_fallback(overview_stats, fallback_stats, small_zones, by_mask))
+		return store
+	return part_callback(0), part_callback(1)
+
+
+def _block_scale_factor(model_raster:str, job:dict, overview_level:int, kwargs:dict) -> int:
+	"""Returns the block scale factor for planning a job's windows
+	here rather than in run_zonal_jobs, tuning it if it is "auto" """
+	block_scale_factor = kwargs.get("block_scale_factor", 8)
+	if block_scale_factor != AUTO:
+		return block_scale_factor
+	n_masks = len(job["mask_rasters"]) if "mask_rasters" in job else int(job.get("mask_raster") is not None)
+	decision = tune(model_raster, job["zone_raster"], len(job["data_rasters"]), n_masks, kwargs.get("memory_budget"), AUTO, kwargs.get("n_cores", 1), kwargs.get("default_block_size", 256), overview_level, kwargs.get("prefetch_depth", 0), kwargs.get("executor", "process"))
+	return decision["block_scale_factor"]
+
+
+def multi_zonal_stats(input_vector:str, product, mask:str = None, start_date:str=None, end_date:str=None, full_archive:bool = False, verbose:bool = False, use_cache:bool = True, skip_dates = None, writer = None, overview_level:int = None, overview_min_pixels:int = DEFAULT_OVERVIEW_MIN_PIXELS, cube = None, *args, **kwargs) -> dict:
+	"""Run zonal.zonal_stats over multiple files
+
+	Several products may be requested at once. They are run in
+	a single pool of workers, and products on the same grid share
+	one zone raster and window plan, so the shapefile is only
+	reprojected and burned once per grid. Likewise, several crop
+	masks may be requested at once, in which case every window
+	of every data file is read once and reduced under each mask.
+
+	***
+
+	Parameters
+	----------
+	input_vector: str
+		Path to vector zone file on disk
+	product: str or list
+		Name of desired product, or list of names
+	mask: str or list
+		Name of desired crop mask, or list of names
 	start_date: str
 		Beginning date of imagery to be analyzed,
 		inclusive. Format as either
@@ -39,10 +336,54 @@ def multi_zonal_stats(input_vector:str, product:str, mask:str = None, start_date
 		archive. Default False
 	verbose: bool
 		Whether to log progress; default False
+	use_cache: bool
+		Whether to reuse zone rasters burned, and results
+		calculated, by earlier runs. Each date's result is
+		cached as soon as it is finished, so an interrupted
+		run picks up where it stopped; default True
+	skip_dates: iterable or dict
+		"YYYY-MM-DD" dates to leave out, e.g. because
+		they are already in an existing output, or a
+		dictionary of {product:dates} to leave out
+		different dates per product; default None
+	writer: output.CsvStatsWriter or output.ColumnarStatsWriter
+		If set, each date is written as soon as it is
+		finished instead of being returned. If product is a
+		list, either a writer with a "product" group
+		column, or a dictionary of {product:writer}. If
+		mask is a list, writers need a "mask" group column;
+		default None
+	overview_level: int
+		If set, approximate the statistics from this overview
+		level of the data files (0 is the first overview)
+		instead of reading them at full resolution. Zones are
+		burned onto the overview grid, so "pixels" counts
+		overview pixels; default None
+	overview_min_pixels: int
+		Zones with fewer pixels than this at overview_level
+		are calculated at full resolution instead, so their
+		"pixels" count full resolution pixels while those of
+		other zones count overview pixels, and cannot be
+		compared with them; default 4
+	cube: bool or str
+		If True, return a cube.StatsCube of date by zone
+		arrays (or {mask_name:StatsCube} if mask is a list)
+		instead of dictionaries; if a directory path, the
+		cube's arrays are memory-mapped files there, in a
+		subdirectory per product if product is a list. Cannot
+		be combined with writer; default None
 	args, kwargs
 		Other arguments to be passed to
-		zonal.zonal_stats
-
+		zonal.run_zonal_jobs
+
+	Returns
+	-------
+	Dictionary of {date:zonal_stats_output} if product is a
+	string, or {product:{date:zonal_stats_output}} if it is a
+	list. If mask is a list, each zonal_stats_output is nested
+	under {mask_name:zonal_stats_output}. Products with a writer
+	are left empty. If cube is set, each product's
+	{date:zonal_stats_output} is a StatsCube instead.
 	"""
 	startTime = datetime.now()
 
@@ -57,78 +398,119 @@ def multi_zonal_stats(input_vector:str, product:str, mask:str = None, start_date
 	if (not start_date) and (not end_date):
 		if not full_archive:
 			raise BadInputError("If full_archive is False, must set either start_date or end_date!")
-
-	# get list of data files to be analyzed
-	if product in EXTERNAL_PRODUCTS:
-		data_directory = os.path.join(EXTERNAL_DIR, product)
-	else:
-		data_directory = os.path.join(PRODUCT_DIR, product)
-	# filter
-	if "merra-2" in product:
-		data_directory = os.path.join(PRODUCT_DIR, "merra-2")
-		merra_variable = product.split("-")[2]
-		all_files = glob.glob(os.path.join(data_directory, f"merra-2.*.{merra_variable}.tif"))
-		product = "merra-2"
-	elif product in EXTERNAL_PRODUCTS:
-		all_files = glob.glob(os.path.join(data_directory, f"*.tif"))
-	else:
-		all_files = glob.glob(os.path.join(data_directory, f"{product}.*.tif"))
-
-	# make sure some files were found
-	assert len(all_files) > 0
-
-	# filter by date
-	data_dict = {}
-	for f in all_files:
-		file_date = dateFromFilePath(f)
-		if start_date and (start_date > file_date):
-			continue
-		if end_date and (end_date < file_date):
-			continue
-		data_dict[file_date.strftime("%Y-%m-%d")] = f
-
-	# make sure there's at least one file in the time period of interest
-	assert len(data_dict) > 0
-
-	# get crop mask
-	if mask is not None:
-		try:
-			mask = os.path.join(MASK_DIR, f"{product}.{mask}.tif")
-			assert os.path.exists(mask)
-		except AssertionError:
-			mask = None
-			log.warning(f"Mask '{mask}' does not exist for product '{product}.' Running with no mask.")
+	statistics = validate_statistics(kwargs.get("statistics"))
+	products = [product] if isinstance(product, str) else list(dict.fromkeys(product))
+	if cube and (writer is not None):
+		raise BadInputError("Cannot both return a cube and write to a writer")
+	cube_paths = {p:(cube if (cube is True) or (not cube) or isinstance(product, str) else os.path.join(cube, p)) for p in products}
+
+	# get data files to be analyzed, leaving out dates that the caller already has
+	data_dicts = {}
+	grids = {}
+	with ArchiveCatalog(CATALOG_PATH, PRODUCT_DIR, EXTERNAL_DIR) as catalog, span("catalog"):
+		for p in products:
+			data_dict = get_data_files(p, start_date, end_date, catalog)
+			product_skip_dates = skip_dates.get(p) if isinstance(skip_dates, dict) else skip_dates
+			if product_skip_dates:
+				data_dict = {date:data_dict[date] for date in data_dict if date not in product_skip_dates}
+			if len(data_dict) > 0:
+				data_dicts[p] = data_dict
+				grids[p] = _grid(list(data_dict.values())[0], catalog)
+		_check_histograms(data_dicts, statistics, kwargs.get("histogram_range"), catalog)
+	if len(data_dicts) == 0:
+		if verbose:
+			log.info("No new dates to process")
+		return {} if isinstance(product, str) else {p:{} for p in products}
 
 	if verbose:
 		log.info("Burning shapefile to raster")
 		burnTime = datetime.now()
 
-	# define new file names
-	reprojected_shape = os.path.join(TEMP_DIR,os.path.basename(input_vector))
-	rasterized_shape = reprojected_shape.replace(os.path.splitext(reprojected_shape)[1],".tif")
-
-	# reproject and rasterize shape
-	model_raster = list(data_dict.values())[0]
-	reproject_shapefile(input_vector, model_raster, reprojected_shape)
-	shapefile_toRaster(reprojected_shape, model_raster, rasterized_shape, *args, **kwargs)
-
-	# make sure the rasterization worked
-	assert os.path.exists(rasterized_shape)
-
-	# cloud-optimize new raster
-	cloud_optimize_inPlace(rasterized_shape)
-
-	if verbose:
-		log.info(f"Finished burning shapefile in {datetime.now() - burnTime}")
-		log.info("Calculating zonal statistics")
-		zoneTime = datetime.now()
+	# zone rasters burned without the cache, and masks resampled to overviews, are removed once the jobs are done
+	scratch = []
+	try:
+		# reproject and rasterize shape once per grid
+		zone_rasters = {}
+		zone_keys = {}
+		jobs = []
+		job_products = [] # (product, whether the job is a full resolution fallback)
+		fallback_zones = {}
+		for p, data_dict in data_dicts.items():
+			model_raster = list(data_dict.values())[0]
+			grid = grids[p] + (overview_level,)
+			if grid not in zone_rasters:
+				zone_rasters[grid] = burn_zone_layer(input_vector, model_raster, kwargs.get("zone_field"), kwargs.get("dtype"), use_cache, kwargs.get("clip", True), overview_level)
+				if use_cache:
+					zone_keys[grid] = zone_layer_key(input_vector, model_raster, kwargs.get("zone_field"), kwargs.get("dtype"), kwargs.get("clip", True), overview_level)
+				else:
+					scratch.append(zone_rasters[grid])
+			product_writer = writer.get(p) if isinstance(writer, dict) else writer
+			job = {"zone_raster":zone_rasters[grid], "data_rasters":data_dict}
+			if isinstance(mask, (list, tuple)):
+				job["mask_rasters"] = _mask_rasters(p, mask)
+			else:
+				job["mask_raster"] = _mask_path(p, mask) if mask is not None else None
+			callback = _writer_callback(product_writer, p, "mask_rasters" in job) if product_writer is not None else None
+			if use_cache:
+				job_masks = job["mask_rasters"] if "mask_rasters" in job else job["mask_raster"]
+				job["result_keys"] = {date:result_key(zone_keys[grid], path, job_masks, statistics, kwargs.get("histogram_range"), kwargs.get("histogram_bins")) for date, path in data_dict.items()}
+			if cube:
+				job["cube"] = cube_paths[p]
+			if overview_level is None:
+				job["callback"] = callback
+				jobs.append(job)
+				job_products.append((p, False))
+				continue
+
+			# approximate from overviews; zones too small for them fall back to full resolution
+			fallback_job = {"data_rasters":data_dict, **{k:job[k] for k in ["mask_raster", "mask_rasters"] if k in job}}
+			job["overview_level"] = overview_level
+			_masks_toOverview(job, model_raster, overview_level, scratch)
+			job["zone_index"] = build_zone_index(job["zone_raster"], get_windows(model_raster, _block_scale_factor(model_raster, job, overview_level, kwargs), kwargs.get("default_block_size", 256), job["zone_raster"], overview_level), resolve_cores(kwargs.get("n_cores", 1)))
+			overview_pixels = zone_pixel_counts(job["zone_index"])
+			small = set(zone for zone in _zone_codes(input_vector, kwargs.get("zone_field"), use_cache) if overview_pixels.get(zone, 0) < overview_min_pixels)
+			if verbose:
+				log.info(f"{p}: {len(overview_pixels) + len(small - set(overview_pixels))} zones, {len(small)} of which have fewer than {overview_min_pixels} pixels at overview level {overview_level} and are calculated at full resolution")
+			log.debug(f"{p}: zones calculated at full resolution: {sorted(small)}")
+			if len(small) == 0:
+				job["callback"] = callback
+				jobs.append(job)
+				job_products.append((p, False))
+				continue
+			full_grid = grids[p] + (None,)
+			if full_grid not in zone_rasters:
+				zone_rasters[full_grid] = burn_zone_layer(input_vector, model_raster, kwargs.get("zone_field"), kwargs.get("dtype"), use_cache, kwargs.get("clip", True))
+				if not use_cache:
+					scratch.append(zone_rasters[full_grid])
+			fallback_job["zone_raster"] = zone_rasters[full_grid]
+			full_windows = get_windows(model_raster, _block_scale_factor(model_raster, fallback_job, None, kwargs), kwargs.get("default_block_size", 256), fallback_job["zone_raster"])
+			fallback_job["zone_index"] = restrict_zone_index(build_zone_index(fallback_job["zone_raster"], full_windows, resolve_cores(kwargs.get("n_cores", 1))), small)
+			if cube:
+				# the parts are merged into cube_paths[p] once both are finished
+				job["cube"], fallback_job["cube"] = [(True if cube_paths[p] is True else os.path.join(cube_paths[p], part)) for part in ["overview", "full"]]
+			if callback is not None:
+				job["callback"], fallback_job["callback"] = _fallback_callbacks(callback, small, "mask_rasters" in job)
+			jobs += [job, fallback_job]
+			job_products += [(p, False), (p, True)]
+			fallback_zones[p] = small
 
-	# meat and potatoes of processing
-	full_output = {}
-	for date in data_dict:
 		if verbose:
-			log.info(date)
-		full_output[date] = zonal_stats(rasterized_shape, data_dict[date], mask, *args, **kwargs)
+			log.info(f"Finished burning shapefile to {len(zone_rasters)} grid(s) in {datetime.now() - burnTime}")
+			log.info("Calculating zonal statistics")
+			zoneTime = datetime.now()
+
+		# meat and potatoes of processing
+		job_outputs = run_zonal_jobs(jobs, *args, result_cache = (ResultCache(os.path.join(CACHE_DIR, "results")) if use_cache else None), **kwargs)
+	finally:
+		remove_scratch(scratch)
+	full_output = {p:{} for p in products}
+	for (p, is_fallback), job_output in zip(job_products, job_outputs):
+		if is_fallback and cube:
+			full_output[p] = _with_fallback_cube(full_output[p], job_output, fallback_zones[p], (None if cube_paths[p] is True else cube_paths[p]))
+		elif is_fallback:
+			full_output[p] = {date:_with_fallback(full_output[p][date], job_output[date], fallback_zones[p], isinstance(mask, (list, tuple))) for date in full_output[p]}
+		else:
+			full_output[p] = job_output
 
 	# log time if necessary
 	if verbose:
@@ -136,26 +518,209 @@ def multi_zonal_stats(input_vector:str, product:str, mask:str = None, start_date
 		log.info(f"Completed in {datetime.now() - startTime}")
 
 	# return data
+	if isinstance(product, str):
+		return full_output[product]
 	return full_output
 
 
-def stats_to_csv(stats_dictionary, output_csv, zone_code_dict = None) -> None:
-	"""Writes statistics dictionary to csv format"""
-	lines = []
-	header = "date,zone,mean,pixels\n"
-	lines.append(header)
-	# generate lines
-	for date in stats_dictionary:
-		for zone in stats_dictionary[date]:
-			if zone_code_dict is not None:
-				zone_name = zone_code_dict[int(zone)]
-			else:
-				zone_name = zone
-			line = f"{date},{zone_name},{stats_dictionary[date][zone]['value']},{stats_dictionary[date][zone]['pixels']}\n"
-			lines.append(line)
-	# write to file
-	with open(output_csv,'w') as wf:
-		wf.writelines(lines)
+def stats_to_csv(stats_dictionary, output_csv, zone_code_dict = None, statistics = None) -> None:
+	"""Writes statistics dictionary, or a cube.StatsCube, to csv format"""
+	with CsvStatsWriter(output_csv, zone_code_dict, statistics) as writer:
+		if isinstance(stats_dictionary, StatsCube):
+			writer.write_cube(stats_dictionary)
+			return
+		for date in stats_dictionary:
+			writer.write(date, stats_dictionary[date])
+
+
+def stats_from_csv(input_csv) -> dict:
+	"""Reads csv written by stats_to_csv back into a statistics dictionary
+
+	Zones are keyed by their name as written in the csv. If the
+	csv has group columns, e.g. product, dates are keyed by
+	(date, *groups) tuples instead.
+	"""
+	keys = [statistic_key(stat) for stat in read_statistics(input_csv)]
+	n_groups = len(read_group_columns(input_csv))
+	stats_dictionary = {}
+	for row in iter_stats_rows(input_csv):
+		group_key = row[0] if n_groups == 0 else row[:n_groups + 1]
+		stats_dictionary.setdefault(group_key, {})[row[n_groups + 1]] = dict(zip(keys, row[n_groups + 2:]))
+	return stats_dictionary
+
+
+def read_manifest(output_path) -> dict:
+	"""Reads the data file manifest stored next to an output file
+
+	Returns a dictionary of {date:{'path':PATH,'size':SIZE,'mtime':MTIME}},
+	which is empty if no manifest exists. In outputs with product
+	or mask columns, entries are keyed by "date|product|mask"
+	instead, leaving out the columns the output does not have.
+	"""
+	manifest_path = f"{output_path}.manifest.json"
+	if not os.path.exists(manifest_path):
+		return {}
+	with open(manifest_path,'r') as rf:
+		return json.load(rf)
+
+
+def write_manifest(manifest, output_path) -> None:
+	"""Writes the data file manifest stored next to an output file"""
+	with open(f"{output_path}.manifest.json",'w') as wf:
+		json.dump(manifest, wf, indent=1, sort_keys=True)
+
+
+def file_signature(file_path) -> dict:
+	"""Returns the manifest entry for a data file"""
+	file_stat = os.stat(file_path)
+	return {'path':file_path, 'size':file_stat.st_size, 'mtime':file_stat.st_mtime}
+
+
+def product_output_path(output_path:str, product:str) -> str:
+	"""Returns path of one product's output when outputs are split
+	per product, e.g. out.csv -> out.MOD09Q1.csv"""
+	output_root, output_ext = os.path.splitext(output_path)
+	return f"{output_root}.{product}{output_ext}"
+
+
+def run_zonal_stats(input_vector:str, product, output_path:str, mask:str = None, start_date:str=None, end_date:str=None, full_archive:bool = False, verbose:bool = False, use_cache:bool = True, update:bool = False, split_products:bool = False, *args, **kwargs):
+	"""Runs multi_zonal_stats and streams the output to disk,
+	optionally as an incremental update of an earlier run
+
+	Each date is written as soon as it is finished, so memory
+	use does not grow with the length of the archive. The output
+	format follows the extension of output_path; see
+	output.open_stats_writer. A manifest of the data file behind
+	every date is written next to each output. If update is set,
+	only dates that are missing from the output, or whose data
+	file has changed since it was written, are calculated; the
+	rest are carried over from the existing output. An output
+	without a manifest, e.g. one written by an older version,
+	is taken to be up to date for the dates it has, and their
+	current data files are recorded in its new manifest.
+
+	If several products are requested, they are calculated in a
+	single pass and written either to output_path with a product
+	column, or, if split_products is set, to one file per
+	product (see product_output_path). If several masks are
+	requested, the output has a mask column.
+
+	***
+
+	Parameters
+	----------
+	input_vector: str
+		Path to vector zone file on disk
+	product: str or list
+		Name of desired product, or list of names
+	output_path: str
+		Path to output file
+	mask, start_date, end_date, full_archive, verbose, use_cache
+		See multi_zonal_stats
+	update: bool
+		Whether to reuse the dates already in the output,
+		if it exists. Default False
+	split_products: bool
+		Whether to write one output per product instead of
+		a single output with a product column. Default False
+	args, kwargs
+		Other arguments to be passed to multi_zonal_stats
+
+	Returns
+	-------
+	List of dates that were calculated if product is a string,
+	or dictionary of {product:[dates]} if it is a list
+	"""
+	statistics = validate_statistics(kwargs.get("statistics"))
+	products = [product] if isinstance(product, str) else list(dict.fromkeys(product))
+	if split_products and (len(products) > 1):
+		targets = {product_output_path(output_path, p):[p] for p in products}
+	else:
+		targets = {output_path:products}
+	by_mask = isinstance(mask, (list, tuple))
+
+	def group_columns(target_products):
+		return (["product"] if len(target_products) > 1 else []) + (["mask"] if by_mask else [])
+
+	def row_keys(date, p, target_products):
+		# (date, *groups) of every group of rows written for a date of a product
+		product_key = (p,) if len(target_products) > 1 else ()
+		if not by_mask:
+			return [(date, *product_key)]
+		return [(date, *product_key, m) for m in _available_masks(p, mask)]
+
+	# dates are up to date if their data file has not changed
+	with ArchiveCatalog(CATALOG_PATH, PRODUCT_DIR, EXTERNAL_DIR) as catalog:
+		data_dicts = {p:get_data_files(p, parseDateString(start_date) if start_date else None, parseDateString(end_date) if end_date else None, catalog) for p in products}
+		_check_histograms(data_dicts, statistics, kwargs.get("histogram_range"), catalog)
+	skip_dates = {p:set() for p in products}
+	manifests = {}
+	updates = {}
+	for path, target_products in targets.items():
+		# read what has been done already
+		updates[path] = update and os.path.exists(path)
+		if updates[path] and ((read_statistics(path) != statistics) or (read_group_columns(path) != group_columns(target_products))):
+			log.warning(f"Columns of {path} do not match {group_columns(target_products) + statistics}; recalculating all dates")
+			updates[path] = False
+		manifests[path] = read_manifest(path) if updates[path] else {}
+		existing = set(key for key, rows in iter_stats(path)) if updates[path] else set()
+		# without a manifest, the dates already written are all there is to go on
+		adopt = updates[path] and not os.path.exists(f"{path}.manifest.json")
+		if adopt:
+			log.warning(f"{path} has no manifest; reusing the dates it already has without checking whether their data files have changed since")
+		for p in target_products:
+			for date in data_dicts[p]:
+				signature = file_signature(data_dicts[p][date])
+				keys = row_keys(date, p, target_products)
+				if adopt and all(key in existing for key in keys):
+					manifests[path].update({"|".join(key):signature for key in keys})
+				if all((key in existing) and (manifests[path].get("|".join(key)) == signature) for key in keys):
+					skip_dates[p].add(date)
+			if verbose:
+				log.info(f"{len(skip_dates[p])} of {len(data_dicts[p])} dates of {p} are up to date in {path}")
+
+	zone_field = kwargs.get("zone_field")
+	zone_code_dict = get_zone_codes(input_vector, zone_field, use_cache) if zone_field else None
+
+	# write to partial files, which replace the outputs once complete
+	partial_paths = {}
+	writers = {}
+	with contextlib.ExitStack() as stack:
+		for path, target_products in targets.items():
+			output_root, output_ext = os.path.splitext(path)
+			partial_paths[path] = f"{output_root}.partial{output_ext}"
+			writer = stack.enter_context(open_stats_writer(partial_paths[path], zone_code_dict, statistics, group_columns(target_products)))
+			# carry over dates that are up to date or outside the requested range
+			if updates[path]:
+				for key, rows in iter_stats(path):
+					date, p = key[0], (key[1] if len(target_products) > 1 else target_products[0])
+					if (date in skip_dates.get(p, ())) or (date not in data_dicts.get(p, {})):
+						writer.write_rows(rows)
+			for p in target_products:
+				writers[p] = writer
+		multi_zonal_stats(input_vector, products, mask, start_date, end_date, full_archive, verbose, use_cache, skip_dates, writers, *args, **kwargs)
+
+	new_dates = {p:[date for date in data_dicts[p] if date not in skip_dates[p]] for p in products}
+	for path, target_products in targets.items():
+		os.replace(partial_paths[path], path)
+		for p in target_products:
+			for date in new_dates[p]:
+				for key in row_keys(date, p, target_products):
+					manifests[path]["|".join(key)] = file_signature(data_dicts[p][date])
+		write_manifest(manifests[path], path)
+
+	if isinstance(product, str):
+		return new_dates[product]
+	return new_dates
+
+
+def _int_or_auto(value:str):
+	if value == AUTO:
+		return AUTO
+	try:
+		return int(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"must be an integer or '{AUTO}', not '{value}'")
 
 
 def main():
@@ -163,6 +728,7 @@ def main():
 	parser.add_argument("zone_shapefile",
 		help="Path to zone shapefile")
 	parser.add_argument("product_name",
+		nargs="+",
 		choices=[
 			"MOD09Q1",
 			"MYD09Q1",
@@ -174,9 +740,9 @@ def main():
 			"merra-2-max",
 			"swi"
 			] + EXTERNAL_PRODUCTS,
-		help="Name of data product to be analyzed")
+		help="Name of data product to be analyzed. Several products may be given, and are calculated in a single pass")
 	parser.add_argument("out_path",
-		help="Path to output csv file")
+		help="Path to output file. Written as Parquet if it ends in '.parquet', as Arrow IPC if it ends in '.arrow', and as csv otherwise")
 	parser.add_argument("-sd",
 		"--start_date",
 		help="Start of temporal range of interest, formatted as 'YYYY-MM-DD' or 'YYYY.DOY'")
@@ -191,9 +757,18 @@ def main():
 		"--cores",
 		default=20,
 		required = True,
-		help="Number of cores to use for parallel processing")
+		type=_int_or_auto,
+		help="Number of cores to use for parallel processing, or 'auto' to choose from the available cores, the work to do and --memory_budget")
+	parser.add_argument("--block_scale_factor",
+		default=8,
+		type=_int_or_auto,
+		help="Size of windowed reads, as a multiple of the data raster's tile size, or 'auto' to choose it for each product from its tiling, zone coverage and --memory_budget. Default 8")
+	parser.add_argument("--memory_budget",
+		default=None,
+		help="With -c auto or --block_scale_factor auto, memory the run may use, e.g. 16G. Default 75%% of available memory")
 	parser.add_argument("-m",
 		"--crop_mask",
+		nargs="+",
 		default = None,
 		choices=[
 			"maize",
@@ -203,31 +778,92 @@ def main():
 			"springwheat",
 			"cropland"
 			],
-		help="Name of crop mask to apply")
+		help="Name of crop mask to apply. Several masks may be given, and are calculated in a single pass with a mask column in the output")
 	parser.add_argument("-zf",
 		"--zone_field",
 		default=None,
 		help="If shapefile has multiple zones, name of numeric field to use for zone values")
+	parser.add_argument("-s",
+		"--statistics",
+		nargs="+",
+		default=["mean", "pixels"],
+		help=f"Statistics to calculate for each zone and date. Any of {STATISTICS}, or 'pNN' for the NNth percentile. Default: mean pixels")
+	parser.add_argument("--histogram_range",
+		nargs=2,
+		type=float,
+		default=None,
+		metavar=("LOW", "HIGH"),
+		help="Range of the histogram used to estimate percentiles. Defaults to the full range of the product's integer data type")
+	parser.add_argument("--histogram_bins",
+		type=int,
+		default=1000,
+		help="Number of histogram bins used to estimate percentiles. Default 1000")
+	parser.add_argument("--split_products",
+		action="store_true",
+		help="If several products are given, write one output per product, e.g. out.MOD09Q1.csv, instead of a single output with a product column")
+	parser.add_argument("-u",
+		"--update",
+		action="store_true",
+		help="Only calculate dates that are missing from, or have changed since, an existing output at out_path, and merge them in")
+	parser.add_argument("--no_cache",
+		action="store_true",
+		help="Burn the zone shapefile and calculate every date again instead of reusing the zone raster and results cached by earlier runs")
+	parser.add_argument("--overview_level",
+		type=int,
+		default=None,
+		help="Approximate the statistics from this overview level of the data files (0 is the first, usually half resolution) instead of reading them at full resolution")
+	parser.add_argument("--overview_min_pixels",
+		type=int,
+		default=DEFAULT_OVERVIEW_MIN_PIXELS,
+		help=f"With --overview_level, zones with fewer pixels than this at the overview level are calculated at full resolution, and their pixels column counts full resolution pixels. Default {DEFAULT_OVERVIEW_MIN_PIXELS}")
+	parser.add_argument("--executor",
+		default="process",
+		choices=EXECUTORS,
+		help="Run tasks on a process pool, a thread pool, or workers sharing a task queue directory, possibly on other nodes. Default process")
+	parser.add_argument("--queue_dir",
+		default=None,
+		help="With --executor distributed, task queue directory on a filesystem shared with the workers, which are started with 'tsharvest-worker QUEUE_DIR'. If not set, --cores local workers are used")
+	parser.add_argument("--local_workers",
+		type=int,
+		default=None,
+		help="With --executor distributed and --queue_dir, number of workers to also start on this node. Default 0")
+	parser.add_argument("--prefetch_depth",
+		type=int,
+		default=0,
+		help="Read up to this many windows ahead on I/O threads in each worker while the current one is calculated. Default 0, i.e. no read-ahead")
+	parser.add_argument("--io_threads",
+		type=int,
+		default=2,
+		help="With --prefetch_depth, number of read-ahead threads per worker. Default 2")
+	parser.add_argument("--refresh_catalog",
+		action="store_true",
+		help="List the product directories again even if they have not changed, e.g. after data files were rewritten in place")
+	parser.add_argument("--profile",
+		default=None,
+		metavar="TRACE_JSON",
+		help="Record how long each stage and each task of every worker takes, and write them to TRACE_JSON as a trace that chrome://tracing or ui.perfetto.dev can open. A summary of throughput per stage and per date is logged")
 	parser.add_argument("-q",
 		"--quiet",
 		action="store_false",
 		help="Suppress logging of progress and time")
 	args = parser.parse_args()
 
-	data = multi_zonal_stats(input_vector=args.zone_shapefile, product=args.product_name, mask=args.crop_mask, start_date=args.start_date, end_date=args.end_date, full_archive=args.full_archive, verbose=args.quiet, n_cores = args.cores, zone_field = args.zone_field)
-
+	executor_options = None
+	if args.executor == "distributed":
+		executor_options = {"queue_dir":args.queue_dir, "local_workers":args.local_workers}
 
-	if not args.quiet:
-		log.info("Writing data to csv")
-	if args.zone_field:
-		zone_code_dict = zone_field_toCodes(args.zone_shapefile,args.zone_field)
-	else:
-		zone_code_dict = None
-	stats_to_csv(data,args.out_path,zone_code_dict)
+	if args.refresh_catalog:
+		with ArchiveCatalog(CATALOG_PATH, PRODUCT_DIR, EXTERNAL_DIR) as catalog:
+			for product in args.product_name:
+				catalog.refresh(product, force = True)
 
-	try:
-		clean()
-	except:
-		log.warning("Failed to clear temp directory")
+	with contextlib.ExitStack() as stack:
+		profiler = stack.enter_context(profile()) if args.profile else None
+		run_zonal_stats(input_vector=args.zone_shapefile, product=(args.product_name[0] if len(args.product_name) == 1 else args.product_name), output_path=args.out_path, mask=(args.crop_mask[0] if (args.crop_mask is not None) and (len(args.crop_mask) == 1) else args.crop_mask), start_date=args.start_date, end_date=args.end_date, full_archive=args.full_archive, verbose=args.quiet, use_cache=not args.no_cache, update=args.update, split_products=args.split_products, overview_level=args.overview_level, overview_min_pixels=args.overview_min_pixels, n_cores = args.cores, zone_field = args.zone_field, statistics = args.statistics, histogram_range = args.histogram_range, histogram_bins = args.histogram_bins, executor = args.executor, executor_options = executor_options, prefetch_depth = args.prefetch_depth, io_threads = args.io_threads, block_scale_factor = args.block_scale_factor, memory_budget = args.memory_budget)
+	if profiler is not None:
+		log.info(f"Wrote profile of {len(profiler.spans)} spans to {profiler.write_trace(args.profile)}\n{profiler.format_summary()}")
 
-	log.info(f"Done. Output is at {args.out_path}")
+	if args.split_products and (len(args.product_name) > 1):
+		log.info(f"Done. Outputs are at {[product_output_path(args.out_path, p) for p in args.product_name]}")
+	else:
+		log.info(f"Done. Output is at {args.out_path}")
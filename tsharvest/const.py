@@ -2,7 +2,13 @@ import os
 
 TEMP_DIR = os.path.join(os.path.dirname(__file__),"temp")
 if not os.path.exists(TEMP_DIR):
-	os.path.mkdir(TEMP_DIR)
+	os.makedirs(TEMP_DIR)
+
+CACHE_DIR = os.environ.get("TSHARVEST_CACHE_DIR", os.path.join(os.path.expanduser("~"),".tsharvest","cache"))
+ZONE_CACHE_MAX_BYTES = int(os.environ.get("TSHARVEST_ZONE_CACHE_BYTES", 20 * 1024**3))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("TSHARVEST_RESULT_CACHE_BYTES", 2 * 1024**3))
+CATALOG_PATH = os.environ.get("TSHARVEST_CATALOG", os.path.join(os.path.expanduser("~"),".tsharvest","catalog.sqlite"))
+PRELOAD_MAX_BYTES = int(os.environ.get("TSHARVEST_PRELOAD_BYTES", 4 * 1024**3))
 
 PRODUCT_DIR = r"/gpfs/data1/cmongp2/GLAM/rasters/products/"
 
@@ -0,0 +1,213 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import json
+import numpy as np
+
+from .stats import validate_statistics, statistic_key
+from .exceptions import *
+
+
+CUBE_METADATA = "cube.json"
+
+
+def cube_statistics(statistics) -> list:
+	"""Returns the statistics a StatsCube holds for the requested
+	ones: those, then "mean" and "pixels" if they were not
+	requested, as zonal_stats outputs always have them"""
+	return list(dict.fromkeys(validate_statistics(statistics) + ["mean", "pixels"]))
+
+
+class StatsCube:
+	"""Zonal statistics of many dates as dense date by zone arrays
+
+	A dictionary of {date:{zone:{statistic:value}}} holds a
+	Python dictionary and boxed number per zone and date; a cube
+	holds one numpy array per statistic instead, indexed by the
+	dates and zones vectors, so that results can be merged and
+	written a whole date (or archive) at a time. Cubes created
+	with a path are memory-mapped .npy files in that directory,
+	with the index vectors in cube.json, and can be reopened
+	with StatsCube.open.
+
+	"pixels" is int64. Other statistics are float64 and NaN
+	where a zone has no valid pixels, except "sum" of integer
+	data, which is an int64 array (exact within the limits given
+	in stats.window_columns) that is 0 there; use valid() to
+	mask it.
+
+	***
+
+	Parameters
+	----------
+	dates: list
+		Keys of the rows, e.g. "YYYY-MM-DD" dates
+	zones: list
+		Zone codes of the columns, e.g. from a zone raster
+	statistics: list
+		Names of statistics; see cube_statistics. Default
+		["mean", "pixels"]
+	arrays: dict
+		{statistic:array} of shape (len(dates), len(zones)).
+		If None, empty arrays are created. Default None
+	path: str
+		Directory to create memory-mapped arrays in, if arrays
+		is None. Default None, for arrays in memory
+	integer_sums: bool
+		Whether "sum" holds integer sums. Default False
+	"""
+	def __init__(self, dates:list, zones:list, statistics:list = None, arrays:dict = None, path:str = None, integer_sums:bool = False):
+		self.dates = [str(date) for date in dates]
+		self.zones = np.asarray(zones)
+		self.statistics = cube_statistics(statistics)
+		self.path = path
+		self.integer_sums = bool(integer_sums)
+		self._date_index = {date:i for i, date in enumerate(self.dates)}
+		self._zone_order = np.argsort(self.zones, kind='stable')
+		if len(self._date_index) != len(self.dates):
+			raise BadInputError("Dates of a StatsCube must be unique")
+		if arrays is None:
+			arrays = {stat:self._empty(stat) for stat in self.statistics}
+			if path is not None:
+				self._write_metadata()
+		self.arrays = arrays
+
+	def _dtype(self, stat:str):
+		return 'int64' if (stat == "pixels") or ((stat == "sum") and self.integer_sums) else 'float64'
+
+	def _empty(self, stat:str):
+		shape = (len(self.dates), self.zones.size)
+		fill = 0 if self._dtype(stat) == 'int64' else np.nan
+		if self.path is None:
+			return np.full(shape, fill, dtype=self._dtype(stat))
+		os.makedirs(self.path, exist_ok=True)
+		array = np.lib.format.open_memmap(os.path.join(self.path, f"{stat}.npy"), mode='w+', dtype=self._dtype(stat), shape=shape)
+		array[:] = fill
+		return array
+
+	def _write_metadata(self) -> None:
+		with open(os.path.join(self.path, CUBE_METADATA), 'w') as wf:
+			json.dump({"dates":self.dates, "zones":self.zones.tolist(), "statistics":self.statistics, "integer_sums":self.integer_sums}, wf)
+
+	@classmethod
+	def open(cls, path:str, mode:str = 'r'):
+		"""Opens a cube created with a path, memory-mapping its
+		arrays with mode ('r' or 'r+')"""
+		with open(os.path.join(path, CUBE_METADATA)) as rf:
+			metadata = json.load(rf)
+		arrays = {stat:np.load(os.path.join(path, f"{stat}.npy"), mmap_mode=mode) for stat in metadata["statistics"]}
+		return cls(metadata["dates"], metadata["zones"], metadata["statistics"], arrays, path, metadata["integer_sums"])
+
+	@classmethod
+	def from_stats(cls, stats_dictionary:dict, statistics:list = None, zones:list = None, path:str = None):
+		"""Builds a cube from a dictionary of {date:zonal_stats_output},
+		as returned by multi_date_zonal_stats
+
+		Zones default to every zone in stats_dictionary, sorted.
+		"""
+		if zones is None:
+			zones = sorted(set(zone for zone_stats in stats_dictionary.values() for zone in zone_stats))
+		integer_sums = any(isinstance(s.get("sum"), (int, np.integer)) for zone_stats in stats_dictionary.values() for s in zone_stats.values())
+		cube = cls(list(stats_dictionary), zones, statistics, path = path, integer_sums = integer_sums)
+		for date, zone_stats in stats_dictionary.items():
+			cube.set_stats(date, zone_stats)
+		return cube
+
+	def __len__(self) -> int:
+		return len(self.dates)
+
+	def __getitem__(self, stat:str):
+		return self.arrays[stat]
+
+	def positions(self, zones):
+		"""Returns the column of each of zones, which must be in the cube"""
+		zones = np.asarray(zones)
+		if zones.size == 0:
+			return np.zeros(0, dtype='int64')
+		if self.zones.size == 0:
+			raise BadInputError("This StatsCube has no zones")
+		found = self._zone_order[np.searchsorted(self.zones, zones, sorter=self._zone_order).clip(0, self.zones.size - 1)]
+		if not np.array_equal(self.zones[found], zones):
+			raise BadInputError("Some zones are not in this StatsCube")
+		return found
+
+	def set(self, date, values:dict, zones = None) -> None:
+		"""Sets the row of date from {statistic:array}, with one
+		value per zone of the cube, or per zone of zones"""
+		row = self._date_index[str(date)]
+		columns = slice(None) if zones is None else self.positions(zones)
+		for stat in self.statistics:
+			self.arrays[stat][row, columns] = values[stat]
+
+	def set_stats(self, date, zone_stats:dict) -> None:
+		"""Sets the row of date from a zonal_stats output dictionary"""
+		zones = list(zone_stats)
+		values = {}
+		for stat in self.statistics:
+			column = [zone_stats[zone][statistic_key(stat)] for zone in zones]
+			if self._dtype(stat) == 'int64':
+				# integer sums of zones without pixels are NaN in dictionaries
+				column = [(0 if (isinstance(v, float) and np.isnan(v)) else v) for v in column]
+			values[stat] = np.array(column, dtype=self._dtype(stat))
+		self.set(date, values, zones)
+
+	def valid(self):
+		"""Returns a (dates, zones) boolean array of where zones have
+		valid pixels"""
+		return self.arrays["pixels"] > 0
+
+	def to_stats(self, date) -> dict:
+		"""Returns the row of date as a zonal_stats output dictionary"""
+		row = self._date_index[str(date)]
+		present = self.arrays["pixels"][row] > 0
+		columns = {}
+		for stat in self.statistics:
+			values = self.arrays[stat][row]
+			if (stat == "sum") and self.integer_sums:
+				columns[stat] = [(v if p else np.nan) for v, p in zip(values.tolist(), present.tolist())]
+			else:
+				columns[stat] = values.tolist()
+		keys = [statistic_key(stat) for stat in self.statistics]
+		return {zone:dict(zip(keys, values)) for zone, values in zip(self.zones.tolist(), zip(*[columns[stat] for stat in self.statistics]))}
+
+	def to_dict(self) -> dict:
+		"""Returns the cube as a dictionary of {date:zonal_stats_output}"""
+		return {date:self.to_stats(date) for date in self.dates}
+
+	def select(self, zones, path:str = None):
+		"""Returns a new cube with only zones, which must be in the
+		cube, created in path if that is set"""
+		columns = self.positions(zones)
+		selected = StatsCube(self.dates, self.zones[columns], self.statistics, path = path, integer_sums = self.integer_sums)
+		for stat in self.statistics:
+			selected.arrays[stat][:] = self.arrays[stat][:, columns]
+		return selected
+
+	def merge(self, other, path:str = None):
+		"""Returns a new cube with the dates and zones of both cubes,
+		created in path if that is set
+
+		Dates in both cubes take other's values for other's
+		zones. Zones missing from a date's cube have no valid
+		pixels.
+		"""
+		if self.statistics != other.statistics:
+			raise BadInputError(f"Cannot merge cubes of {self.statistics} and {other.statistics}")
+		dates = self.dates + [date for date in other.dates if date not in self._date_index]
+		zones = np.union1d(self.zones, other.zones)
+		merged = StatsCube(dates, zones, self.statistics, path = path, integer_sums = self.integer_sums and other.integer_sums)
+		for cube in [self, other]:
+			rows = np.array([merged._date_index[date] for date in cube.dates], dtype='int64')
+			columns = np.searchsorted(zones, cube.zones)
+			for stat in self.statistics:
+				merged.arrays[stat][np.ix_(rows, columns)] = cube.arrays[stat]
+		return merged
+
+	def flush(self) -> None:
+		"""Writes changes to memory-mapped arrays to disk"""
+		for array in self.arrays.values():
+			if isinstance(array, np.memmap):
+				array.flush()
@@ -0,0 +1,330 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import threading, uuid, weakref
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import open_raster, offset_window
+from .profiling import enable_profiling
+from .const import *
+
+
+DEFAULT_MAX_HANDLES = 32
+
+# per-worker state; each pool process, or each thread of a thread
+# pool, gets its own handles, since GDAL handles must not be shared
+# between threads. _states holds every thread's state by ident, so
+# the handles of threads that have exited are closed by _prune_states
+_state = threading.local()
+_states = {}
+_max_handles = DEFAULT_MAX_HANDLES
+_layers = {}
+# {raster_path:array_path} behind _layers; a path may be preloaded
+# again into a new file, e.g. after the raster is rewritten
+_layer_files = {}
+_io_pool = None
+
+
+def _worker_state():
+	if not hasattr(_state, "handles"):
+		_state.handles = OrderedDict()
+		_state.max_handles = _max_handles
+		_state.hits = 0
+		_state.misses = 0
+		_state.pid = os.getpid()
+		_state.thread = weakref.ref(threading.current_thread())
+		_prune_states()
+		_states[threading.get_ident()] = _state.__dict__
+	return _state
+
+
+def _prune_states() -> None:
+	"""Closes the handles of threads of this process that have exited
+	without release_thread, and forgets their state along with
+	that inherited from a parent process"""
+	pid = os.getpid()
+	alive = {thread.ident:thread for thread in threading.enumerate()}
+	for ident, state in list(_states.items()):
+		if state["pid"] != pid:
+			_states.pop(ident, None)
+		elif (state["thread"]() is None) or (alive.get(ident) is not state["thread"]()):
+			# the thread is gone, so nothing else can use its handles;
+			# a new thread may have been given its ident
+			_states.pop(ident, None)
+			while state["handles"]:
+				key, handle = state["handles"].popitem()
+				handle.close()
+
+
+def init_worker(max_handles:int = DEFAULT_MAX_HANDLES, layers:dict = None, profile:bool = False) -> None:
+	"""Pool initializer that sets up an empty dataset handle cache,
+	maps any preloaded layers and turns profiling on or off
+
+	***
+
+	Parameters
+	----------
+	max_handles: int
+		Number of open datasets to keep before closing the
+		least recently used one. Default 32
+	layers: dict
+		Dictionary of {raster_path:layer}, where each layer
+		is returned by preload_layer. Default None
+	profile: bool
+		Whether to record spans of the worker's tasks; see
+		profiling.profile. Default False
+	"""
+	global _layers, _layer_files, _max_handles
+	enable_profiling(profile)
+	close_all()
+	_max_handles = max(1, int(max_handles))
+	state = _worker_state()
+	state.max_handles = _max_handles
+	state.hits = 0
+	state.misses = 0
+	state.pid = os.getpid()
+	_states[threading.get_ident()] = state.__dict__
+	layers = layers or {}
+	layer_files = {path:array_path for path, (array_path, nodata) in layers.items()}
+	if layer_files != _layer_files:
+		_layers = {path:(np.load(array_path, mmap_mode='r'), nodata) for path, (array_path, nodata) in layers.items()}
+		_layer_files = layer_files
+
+
+def open_dataset(path:str, overview_level:int = None):
+	"""Returns an open rasterio dataset for path, at overview_level
+	if that is set, reusing a cached handle if this worker has
+	opened it before
+
+	Callers must not close the returned dataset.
+	"""
+	state = _worker_state()
+	key = (path, overview_level)
+	try:
+		handle = state.handles.pop(key)
+		state.hits += 1
+	except KeyError:
+		handle = open_raster(path, overview_level)
+		state.misses += 1
+		while len(state.handles) >= state.max_handles:
+			old_key, old_handle = state.handles.popitem(last=False)
+			old_handle.close()
+	state.handles[key] = handle
+	return handle
+
+
+def close_all() -> None:
+	"""Closes every cached dataset handle of this worker"""
+	state = _worker_state()
+	while state.handles:
+		key, handle = state.handles.popitem()
+		handle.close()
+
+
+def release_thread() -> None:
+	"""Closes every cached dataset handle of this thread and forgets
+	its state, e.g. before the thread's pool shuts down"""
+	close_all()
+	_states.pop(threading.get_ident(), None)
+	_state.__dict__.clear()
+
+
+def release_exited_threads() -> None:
+	"""Closes the handles of threads of this process that have
+	exited, e.g. those of a thread pool once it has been joined"""
+	_prune_states()
+
+
+def release_pool_threads(pool, n_threads:int, timeout:float = 60) -> None:
+	"""Runs release_thread on every thread of a thread pool
+
+	Each thread waits on a barrier after releasing, so that no
+	thread takes a second one while another has none. Call this
+	once the pool has no other tasks left, before shutting it
+	down.
+
+	***
+
+	Parameters
+	----------
+	pool: multiprocessing.pool.ThreadPool
+		Or concurrent.futures.ThreadPoolExecutor; anything
+		with a map method that runs on the pool's threads
+	n_threads: int
+		Number of threads in pool
+	timeout: float
+		Seconds to wait for every thread to reach the barrier
+		before giving up on any that have not. Default 60
+	"""
+	barrier = threading.Barrier(max(1, int(n_threads)), timeout = timeout)
+	def release(i):
+		release_thread()
+		try:
+			barrier.wait()
+		except threading.BrokenBarrierError:
+			pass
+	list(pool.map(release, range(max(1, int(n_threads)))))
+
+
+def handle_cache_stats() -> tuple:
+	"""Returns (worker_id, hits, misses) for this worker's handle cache"""
+	state = _worker_state()
+	return f"{os.getpid()}.{threading.get_ident()}", state.hits, state.misses
+
+
+def process_handle_stats() -> list:
+	"""Returns handle_cache_stats() of every thread of this process
+	that has opened a dataset, e.g. the threads of io_pool"""
+	pid = os.getpid()
+	# forked workers inherit the entries of their parent's threads
+	return [(f"{pid}.{ident}", state["hits"], state["misses"]) for ident, state in list(_states.items()) if state["pid"] == pid]
+
+
+def io_pool(n_threads:int = 2):
+	"""Returns this process's pool of threads for reading ahead,
+	creating it on first use
+
+	Each thread keeps its own dataset handles (see open_dataset).
+	GDAL releases the GIL while it reads and decodes, so these
+	reads overlap with computation in the calling thread.
+	"""
+	global _io_pool
+	# a forked worker inherits the pool object, but not its threads
+	if (_io_pool is None) or (_io_pool[0] != os.getpid()):
+		n_threads = max(1, int(n_threads))
+		_io_pool = (os.getpid(), ThreadPoolExecutor(max_workers = n_threads, thread_name_prefix = "tsharvest_io"), n_threads)
+	return _io_pool[1]
+
+
+def shutdown_io_pool() -> None:
+	"""Closes the dataset handles of this process's io_pool threads
+	and shuts it down; the next io_pool call creates a new one"""
+	global _io_pool
+	if (_io_pool is not None) and (_io_pool[0] == os.getpid()):
+		pid, pool, n_threads = _io_pool
+		release_pool_threads(pool, n_threads)
+		pool.shutdown()
+	_io_pool = None
+
+
+def summarize_handle_stats(worker_stats:dict) -> str:
+	"""Formats {worker_id:(worker_id, hits, misses)} collected from workers for logging"""
+	hits = sum(stats[1] for stats in worker_stats.values())
+	misses = sum(stats[2] for stats in worker_stats.values())
+	return f"Dataset handle cache: {hits} hits, {misses} misses across {len(worker_stats)} workers"
+
+
+def preload_layer(raster_path:str, window, strip_rows:int = 1024) -> tuple:
+	"""Decodes a region of a raster once into a memory-mapped scratch
+	file in TEMP_DIR
+
+	Worker processes map the file read-only (see init_worker), so
+	they share one copy of the decoded pixels through the page
+	cache instead of each decompressing the same blocks again.
+
+	***
+
+	Parameters
+	----------
+	raster_path: str
+		Path to raster file
+	window: rasterio.windows.Window
+		Region of raster_path to load
+	strip_rows: int
+		Number of rows decoded at a time. Default 1024
+
+	Returns
+	-------
+	Tuple of (array_path, nodata), to be passed to init_worker
+	and removed with release_layer when no longer needed
+	"""
+	from rasterio.windows import Window
+	array_path = os.path.join(TEMP_DIR, f"layer.{uuid.uuid4().hex}.npy")
+	with open_raster(raster_path) as img:
+		shape = (int(window.height), int(window.width))
+		array = np.lib.format.open_memmap(array_path, mode='w+', dtype=img.dtypes[0], shape=shape)
+		for row in range(0, shape[0], strip_rows):
+			rows = min(strip_rows, shape[0] - row)
+			array[row:row + rows] = img.read(1, window=Window(window.col_off, window.row_off + row, shape[1], rows))
+		nodata = img.nodata
+	array.flush()
+	del array
+	return array_path, nodata
+
+
+def release_layer(layer:tuple) -> None:
+	"""Removes scratch file created by preload_layer, unmapping it
+	first if this process has mapped it (see init_worker)"""
+	global _layers, _layer_files
+	array_path = layer[0]
+	if array_path in _layer_files.values():
+		# the file's pages are not freed while a map of it remains
+		_layers = {path:_layers[path] for path, mapped in _layer_files.items() if mapped != array_path}
+		_layer_files = {path:mapped for path, mapped in _layer_files.items() if mapped != array_path}
+	try:
+		os.remove(array_path)
+	except OSError:
+		log.warning(f"Failed to remove {array_path}")
+
+
+def window_is_empty(handle, window) -> bool:
+	"""Returns whether every block of a dataset's first band under
+	window is missing from the file
+
+	Sparse GeoTIFFs leave out blocks that hold only nodata, and
+	GDAL reads those as nodata without reading or decoding
+	anything, so a window over only such blocks is known to be
+	all nodata without reading it. Blocks are looked up by their
+	byte counts in the TIFF header. Always False for other
+	formats, and for bands without a nodata value (whose missing
+	blocks read as 0) or with a NaN one.
+	"""
+	from rasterio.errors import RasterBlockError
+	nodata = handle.nodata
+	if (handle.driver != "GTiff") or (nodata is None) or np.isnan(nodata):
+		return False
+	block_height, block_width = handle.block_shapes[0]
+	col_start, row_start = int(window.col_off), int(window.row_off)
+	for i in range(row_start // block_height, (row_start + int(window.height) - 1) // block_height + 1):
+		for j in range(col_start // block_width, (col_start + int(window.width) - 1) // block_width + 1):
+			try:
+				if handle.block_size(1, i, j) > 0:
+					return False
+			except RasterBlockError:
+				# not in the file
+				continue
+	return True
+
+
+def read_layer(path:str, window, offset:tuple = (0, 0)):
+	"""Reads a window of a raster, from its preloaded layer if this
+	process has one and from disk otherwise
+
+	***
+
+	Parameters
+	----------
+	path: str
+		Path to raster file
+	window: rasterio.windows.Window
+		Window in the coordinates of the preloaded region,
+		i.e. the zone raster grid
+	offset: tuple
+		(column, row) of that grid within path, used when
+		reading from disk. Default (0, 0)
+
+	Returns
+	-------
+	Tuple of (array, nodata). Preloaded arrays are read-only views.
+	"""
+	if path in _layers:
+		array, nodata = _layers[path]
+		col, row = int(window.col_off), int(window.row_off)
+		return array[row:row + int(window.height), col:col + int(window.width)], nodata
+	handle = open_dataset(path)
+	return handle.read(1, window=offset_window(window, offset)), handle.nodata
@@ -0,0 +1,357 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import argparse, pickle, shutil, socket, subprocess, sys, tempfile, time, traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .exceptions import BadInputError
+
+
+EXECUTORS = ["process", "thread", "distributed"]
+
+# seconds between polls of the task queue
+DEFAULT_POLL_INTERVAL = 0.05
+# seconds after which a claimed shard whose worker has gone quiet is queued again
+DEFAULT_CLAIM_TIMEOUT = 600
+# shards written ahead of the results coming back
+DEFAULT_MAX_PENDING_SHARDS = 256
+
+
+def make_executor(kind:str = "process", n_workers:int = 1, initializer = None, initargs:tuple = (), **options):
+	"""Creates a pool of workers to run zonal tasks on
+
+	Every executor has the map and imap_unordered methods of
+	multiprocessing.Pool, and closes its workers when used as a
+	context manager.
+
+	***
+
+	Parameters
+	----------
+	kind: str
+		One of EXECUTORS: "process" for a multiprocessing.Pool,
+		"thread" for a thread pool in this process, or
+		"distributed" for a DistributedExecutor. Default "process"
+	n_workers: int
+		Number of processes or threads. For "distributed", the
+		number of local worker processes to start if no
+		queue_dir is given. Default 1
+	initializer: function
+		Called as initializer(*initargs) in each worker before
+		it runs any tasks. Default None
+	initargs: tuple
+		Arguments of initializer. Default ()
+	options:
+		Passed on to DistributedExecutor
+	"""
+	if kind == "process":
+		return Pool(processes = int(n_workers), initializer = initializer, initargs = initargs)
+	elif kind == "thread":
+		return ThreadPool(processes = int(n_workers), initializer = initializer, initargs = initargs)
+	elif kind == "distributed":
+		return DistributedExecutor(n_workers, initializer, initargs, **options)
+	raise BadInputError(f"Executor '{kind}' not recognized. Must be one of: {EXECUTORS}")
+
+
+def _write_pickle(obj, path:str) -> None:
+	# write beside the target and rename, so readers never see a partial file
+	tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+	with open(tmp_path, 'wb') as wf:
+		pickle.dump(obj, wf, protocol = pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp_path, path)
+
+
+def _read_pickle(path:str):
+	with open(path, 'rb') as rf:
+		return pickle.load(rf)
+
+
+class DistributedExecutor:
+	"""Runs tasks on worker processes, on this node or others, that
+	share a task queue directory
+
+	The coordinator (this object) splits the tasks into shards and
+	writes each one to QUEUE_DIR/tasks. Workers, started on any
+	node that mounts QUEUE_DIR with
+
+		tsharvest-worker QUEUE_DIR
+
+	claim a shard by renaming it into QUEUE_DIR/claimed, run it,
+	and write its results to QUEUE_DIR/results, from where the
+	coordinator merges them. A shard whose worker stops touching
+	its claim for claim_timeout seconds, e.g. because its node
+	went down, is queued again, and any duplicate results are
+	dropped. Closing the executor tells the workers to exit.
+
+	Workers must be able to import tsharvest, and to read every
+	file the tasks name at the same path as the coordinator.
+
+	***
+
+	Parameters
+	----------
+	n_workers: int
+		Number of local worker processes to start if queue_dir
+		is None. Default 1
+	initializer: function
+		Called as initializer(*initargs) in each worker before
+		it runs any tasks. Default None
+	initargs: tuple
+		Arguments of initializer. Default ()
+	queue_dir: str
+		Directory on a shared filesystem to use as the task
+		queue. If None, a temporary directory is created, and
+		removed on close, and n_workers local workers serve it.
+		Default None
+	local_workers: int
+		Number of local worker processes to start alongside any
+		remote workers. Defaults to n_workers if queue_dir is
+		None, and to 0 otherwise
+	shard_size: int
+		Number of tasks per shard, overriding the chunksize
+		passed to map and imap_unordered. Default None
+	poll_interval: float
+		Seconds between polls of the queue. Default 0.05
+	claim_timeout: float
+		Seconds after which a quiet claim is queued again.
+		Default 600
+	max_pending_shards: int
+		Number of shards written ahead of the results coming
+		back. Default 256
+	"""
+	def __init__(self, n_workers:int = 1, initializer = None, initargs:tuple = (), queue_dir:str = None, local_workers:int = None, shard_size:int = None, poll_interval:float = DEFAULT_POLL_INTERVAL, claim_timeout:float = DEFAULT_CLAIM_TIMEOUT, max_pending_shards:int = DEFAULT_MAX_PENDING_SHARDS):
+		self._owns_queue = queue_dir is None
+		if self._owns_queue:
+			queue_dir = tempfile.mkdtemp(prefix = "tsharvest_queue.")
+		if local_workers is None:
+			local_workers = int(n_workers) if self._owns_queue else 0
+		if self._owns_queue and local_workers < 1:
+			raise BadInputError("A distributed executor without a queue_dir needs at least one local worker")
+		self.queue_dir = queue_dir
+		self.shard_size = shard_size
+		self.poll_interval = poll_interval
+		self.claim_timeout = claim_timeout
+		self.max_pending_shards = max(1, int(max_pending_shards))
+		self._next_shard = 0
+		self._closed = False
+
+		for sub in ["tasks", "claimed", "results"]:
+			os.makedirs(os.path.join(queue_dir, sub), exist_ok = True)
+		for f in os.listdir(os.path.join(queue_dir, "tasks")) + os.listdir(os.path.join(queue_dir, "claimed")) + os.listdir(os.path.join(queue_dir, "results")):
+			log.warning(f"Task queue {queue_dir} is not empty; clearing {f}")
+		for sub in ["tasks", "claimed", "results"]:
+			for f in os.listdir(os.path.join(queue_dir, sub)):
+				os.remove(os.path.join(queue_dir, sub, f))
+		if os.path.exists(os.path.join(queue_dir, "stop")):
+			os.remove(os.path.join(queue_dir, "stop"))
+		_write_pickle((initializer, tuple(initargs)), os.path.join(queue_dir, "init.pkl"))
+
+		# workers import tsharvest from the same place as the coordinator
+		env = dict(os.environ)
+		package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+		env["PYTHONPATH"] = os.pathsep.join([package_parent] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+		self._procs = [subprocess.Popen([sys.executable, "-m", "tsharvest.executor", queue_dir], env = env) for i in range(int(local_workers))]
+		log.info(f"Task queue at {queue_dir}; started {len(self._procs)} local workers")
+
+	def _submit(self, func, items:list) -> str:
+		shard = f"{self._next_shard:010d}"
+		self._next_shard += 1
+		_write_pickle((func, items), os.path.join(self.queue_dir, "tasks", f"{shard}.pkl"))
+		return shard
+
+	def _requeue_stale(self) -> None:
+		claimed_dir = os.path.join(self.queue_dir, "claimed")
+		now = time.time()
+		for f in os.listdir(claimed_dir):
+			try:
+				age = now - os.stat(os.path.join(claimed_dir, f)).st_mtime
+				if age > self.claim_timeout:
+					shard = f.split(".")[0]
+					log.warning(f"Shard {shard} has not been touched for {age:.1f} seconds; queueing it again")
+					os.replace(os.path.join(claimed_dir, f), os.path.join(self.queue_dir, "tasks", f"{shard}.pkl"))
+			except FileNotFoundError:
+				# finished or moved in the meantime
+				pass
+
+	def _check_workers(self) -> None:
+		if self._owns_queue and self._procs and all(p.poll() is not None for p in self._procs):
+			raise RuntimeError(f"All local workers exited with pending tasks (exit codes {[p.returncode for p in self._procs]})")
+
+	def _collect(self, pending:set):
+		"""Yields the results of finished shards that are in pending"""
+		results_dir = os.path.join(self.queue_dir, "results")
+		for f in sorted(os.listdir(results_dir)):
+			if not f.endswith(".pkl"):
+				continue
+			shard = f[:-len(".pkl")]
+			path = os.path.join(results_dir, f)
+			payload = _read_pickle(path)
+			os.remove(path)
+			if shard not in pending:
+				# duplicate of a shard that was queued again
+				continue
+			pending.discard(shard)
+			status, value = payload
+			if status == "error":
+				exc, remote_traceback = value
+				log.error(f"Shard {shard} failed on a worker:\n{remote_traceback}")
+				raise exc
+			yield value
+
+	def imap_unordered(self, func, iterable, chunksize:int = 1):
+		"""Yields func(item) for every item of iterable, in the order
+		the results come back"""
+		shard_size = max(1, int(self.shard_size or chunksize))
+		iterator = iter(iterable)
+		pending = set()
+		exhausted = False
+		last_check = time.time()
+		while True:
+			# keep the queue topped up without holding every task in it
+			while (not exhausted) and (len(pending) < self.max_pending_shards):
+				items = []
+				for item in iterator:
+					items.append(item)
+					if len(items) >= shard_size:
+						break
+				if len(items) == 0:
+					exhausted = True
+					break
+				pending.add(self._submit(func, items))
+			if exhausted and not pending:
+				return
+			found = False
+			for results in self._collect(pending):
+				found = True
+				for result in results:
+					yield result
+			if not found:
+				time.sleep(self.poll_interval)
+				if time.time() - last_check > min(self.claim_timeout, 10):
+					self._check_workers()
+					self._requeue_stale()
+					last_check = time.time()
+
+	def map(self, func, iterable, chunksize:int = None) -> list:
+		"""Returns [func(item) for item in iterable], in order"""
+		indexed = sorted(self.imap_unordered(_IndexedCall(func), enumerate(iterable), chunksize or 1), key = lambda pair: pair[0])
+		return [result for i, result in indexed]
+
+	def close(self) -> None:
+		"""Tells the workers to exit, and waits for local ones to do so"""
+		if self._closed:
+			return
+		self._closed = True
+		with open(os.path.join(self.queue_dir, "stop"), 'w') as wf:
+			wf.write(datetime.now().isoformat())
+		for p in self._procs:
+			try:
+				p.wait(timeout = 60)
+			except subprocess.TimeoutExpired:
+				log.warning(f"Local worker {p.pid} did not exit; killing it")
+				p.kill()
+		if self._owns_queue:
+			shutil.rmtree(self.queue_dir, ignore_errors = True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class _IndexedCall:
+	"""Picklable wrapper that returns (index, func(item)) for (index, item)"""
+	def __init__(self, func):
+		self.func = func
+
+	def __call__(self, indexed_item):
+		i, item = indexed_item
+		return i, self.func(item)
+
+
+def run_worker(queue_dir:str, poll_interval:float = DEFAULT_POLL_INTERVAL) -> int:
+	"""Serves the task queue of a DistributedExecutor until it is closed
+
+	Returns the number of shards run
+	"""
+	init_path = os.path.join(queue_dir, "init.pkl")
+	stop_path = os.path.join(queue_dir, "stop")
+	tasks_dir = os.path.join(queue_dir, "tasks")
+	worker_id = f"{socket.gethostname()}_{os.getpid()}"
+
+	# the coordinator may not have started yet
+	while not os.path.exists(init_path):
+		if os.path.exists(stop_path):
+			return 0
+		time.sleep(poll_interval)
+	initializer, initargs = _read_pickle(init_path)
+	if initializer is not None:
+		initializer(*initargs)
+
+	n_shards = 0
+	while not os.path.exists(stop_path):
+		claim_path = None
+		for f in sorted(os.listdir(tasks_dir)):
+			if not f.endswith(".pkl"):
+				continue
+			candidate = os.path.join(queue_dir, "claimed", f"{f[:-len('.pkl')]}.{worker_id}")
+			try:
+				os.rename(os.path.join(tasks_dir, f), candidate)
+			except FileNotFoundError:
+				# claimed by another worker first
+				continue
+			claim_path = candidate
+			break
+		if claim_path is None:
+			time.sleep(poll_interval)
+			continue
+
+		shard = os.path.basename(claim_path).split(".")[0]
+		try:
+			func, items = _read_pickle(claim_path)
+			results = []
+			for item in items:
+				results.append(func(item))
+				# show the coordinator this shard is still alive
+				try:
+					os.utime(claim_path)
+				except FileNotFoundError:
+					pass
+			payload = ("ok", results)
+		except Exception as e:
+			payload = ("error", (e, traceback.format_exc()))
+		try:
+			_write_pickle(payload, os.path.join(queue_dir, "results", f"{shard}.pkl"))
+		except Exception as e:
+			# e.g. an exception that cannot be pickled
+			_write_pickle(("error", (RuntimeError(repr(e)), traceback.format_exc())), os.path.join(queue_dir, "results", f"{shard}.pkl"))
+		try:
+			os.remove(claim_path)
+		except FileNotFoundError:
+			pass
+		n_shards += 1
+
+	log.debug(f"Worker {worker_id} ran {n_shards} shards")
+	return n_shards
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve the task queue of a distributed tsharvest run")
+	parser.add_argument("queue_dir",
+		type=str,
+		help="Task queue directory given to the coordinator with --queue_dir")
+	parser.add_argument("--poll_interval",
+		type=float,
+		default=DEFAULT_POLL_INTERVAL,
+		help="Seconds between polls of the queue")
+	args = parser.parse_args()
+	run_worker(args.queue_dir, args.poll_interval)
+
+
+if __name__ == "__main__":
+	main()
@@ -4,8 +4,6 @@ from datetime import datetime, timedelta
 logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
 log = logging.getLogger(__name__)
 
-import fiona
-from shapely.geometry import Point, shape
 from .const import *
 
 
@@ -63,6 +61,9 @@ def coords_within_poly(x, y, shapefile_path) -> bool:
 	-------
 	True if point falls within shapefile; False otherwise
 	"""
+	# fiona and shapely are only needed here, so they are not imported with the module
+	import fiona
+	from shapely.geometry import Point, shape
 	point = Point(x,y)
 	polygons = [pol for pol in fiona.open(shapefile_path)]
 	for j, poly in enumerate(polygons):
@@ -0,0 +1,378 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import csv, itertools
+import numpy as np
+from datetime import datetime
+
+from .exceptions import *
+from .stats import validate_statistics, statistic_key
+
+# pyarrow is optional and slow to import, so it is imported by
+# _import_pyarrow when parquet or arrow files are first used
+pa = None
+pq = None
+
+
+PARQUET_EXTENSIONS = [".parquet", ".pq"]
+ARROW_EXTENSIONS = [".arrow", ".feather", ".ipc"]
+
+# columns that identify a row, in the order they are written; date
+# and zone are always present, the others only when a run has more
+# than one of them
+KEY_COLUMNS = ["date", "product", "mask", "zone"]
+GROUP_COLUMNS = ["product", "mask"]
+
+
+def _import_pyarrow(action:str) -> None:
+	global pa, pq
+	if pa is not None:
+		return
+	try:
+		import pyarrow, pyarrow.parquet
+	except ImportError:
+		raise BadInputError(f"{action} parquet or arrow output requires the pyarrow package")
+	pa, pq = pyarrow, pyarrow.parquet
+
+
+def output_format(output_path:str) -> str:
+	"""Returns "parquet", "arrow" or "csv" based on file extension"""
+	ext = os.path.splitext(output_path)[1].lower()
+	if ext in PARQUET_EXTENSIONS:
+		return "parquet"
+	elif ext in ARROW_EXTENSIONS:
+		return "arrow"
+	return "csv"
+
+
+def _zone_name(zone, zone_code_dict):
+	if zone_code_dict is not None:
+		return zone_code_dict[int(zone)]
+	return zone
+
+
+def _rows(date:str, groups:tuple, zone_stats:dict, zone_code_dict:dict, statistics:list):
+	keys = [statistic_key(stat) for stat in statistics]
+	return ((date, *groups, _zone_name(zone, zone_code_dict), *[zone_stats[zone][key] for key in keys]) for zone in zone_stats)
+
+
+def _cube_columns(cube, statistics:list, rows:slice) -> tuple:
+	"""Returns ([array per statistic], present) for rows of a
+	cube.StatsCube, where present marks zones with valid pixels,
+	which integer sums (the only int64 statistic besides "pixels")
+	are NaN without in zonal_stats output dictionaries"""
+	missing = [stat for stat in statistics if stat not in cube.statistics]
+	if missing:
+		raise BadInputError(f"StatsCube has no {missing}")
+	return [cube[stat][rows] for stat in statistics], cube["pixels"][rows] > 0
+
+
+def _csv_field(value) -> str:
+	"""Returns value as csv.writer would write it, e.g. quoted if
+	it holds a comma"""
+	value = str(value)
+	if any(c in value for c in ',"\r\n'):
+		return '"' + value.replace('"', '""') + '"'
+	return value
+
+
+def _group_columns(group_columns) -> list:
+	group_columns = list(group_columns or [])
+	for column in group_columns:
+		if column not in GROUP_COLUMNS:
+			raise BadInputError(f"Unknown group column '{column}'. Use any of {GROUP_COLUMNS}")
+	return [column for column in GROUP_COLUMNS if column in group_columns]
+
+
+def _group_values(group_columns:list, groups:dict) -> tuple:
+	try:
+		return tuple(groups[column] for column in group_columns)
+	except KeyError as e:
+		raise BadInputError(f"Missing value for group column {e}")
+
+
+class CsvStatsWriter:
+	"""Writes statistics to csv one date at a time
+
+	Columns are date, then any group columns (product, mask), then
+	zone and then one column per statistic, named after it.
+
+	***
+
+	Parameters
+	----------
+	output_path: str
+		Path to output csv file
+	zone_code_dict: dict
+		Output of util.zone_field_toCodes, used to name
+		zones. Default None
+	statistics: list
+		Names of statistics to write. Default ["mean", "pixels"]
+	group_columns: list
+		Names of extra key columns, out of GROUP_COLUMNS.
+		Default None
+	"""
+	def __init__(self, output_path:str, zone_code_dict:dict = None, statistics:list = None, group_columns:list = None):
+		self.output_path = output_path
+		self.zone_code_dict = zone_code_dict
+		self.statistics = validate_statistics(statistics)
+		self.group_columns = _group_columns(group_columns)
+		self._file = open(output_path,'w', newline='')
+		self._writer = csv.writer(self._file, lineterminator="\n")
+		self._writer.writerow(["date"] + self.group_columns + ["zone"] + self.statistics)
+
+	def write(self, date:str, zone_stats:dict, **groups) -> None:
+		"""Writes the zonal_stats output for one date, with a keyword
+		argument for each group column"""
+		self.write_rows(_rows(date, _group_values(self.group_columns, groups), zone_stats, self.zone_code_dict, self.statistics))
+
+	def write_cube(self, cube, **groups) -> None:
+		"""Writes every date of a cube.StatsCube, with a keyword
+		argument for each group column
+
+		Each date's lines are built from the cube's arrays at once,
+		rather than a row at a time.
+		"""
+		lead = "".join(f"{_csv_field(g)}," for g in _group_values(self.group_columns, groups))
+		# quoted as write_rows would, e.g. "Nord, Kivu"
+		zone_names = np.array([_csv_field(_zone_name(zone, self.zone_code_dict)) for zone in cube.zones.tolist()], dtype=str)
+		for i, date in enumerate(cube.dates):
+			lines = np.char.add(f"{date},{lead}", zone_names)
+			columns, present = _cube_columns(cube, self.statistics, i)
+			for stat, column in zip(self.statistics, columns):
+				strings = column.astype(str)
+				if (stat != "pixels") and np.issubdtype(column.dtype, np.integer):
+					strings = np.where(present, strings, "nan")
+				lines = np.char.add(np.char.add(lines, ","), strings)
+			self._file.write("".join(line + "\n" for line in lines.tolist()))
+		self._file.flush()
+
+	def write_rows(self, rows) -> None:
+		"""Writes (date, *groups, zone_name, *statistics) tuples"""
+		# as str, since csv.writer writes numpy floats with their repr
+		self._writer.writerows([str(item) for item in row] for row in rows)
+		self._file.flush()
+
+	def close(self) -> None:
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class ColumnarStatsWriter:
+	"""Writes statistics to Parquet or Arrow IPC in batches
+
+	Rows are buffered until row_group_size of them have
+	accumulated, then written as one row group (Parquet) or
+	record batch (Arrow), so memory use does not grow with the
+	length of the archive. Columns are date (date32), any group
+	columns (string), zone (int64 if every zone name is an
+	integer, otherwise string), and one column per statistic,
+	named after it: pixels is int64 and the rest are float64.
+	The file is not readable until close writes its footer.
+
+	***
+
+	Parameters
+	----------
+	output_path: str
+		Path to output file
+	zone_code_dict: dict
+		Output of util.zone_field_toCodes, used to name
+		zones. Default None
+	statistics: list
+		Names of statistics to write. Default ["mean", "pixels"]
+	output_format: str
+		"parquet" or "arrow". Default "parquet"
+	row_group_size: int
+		Number of rows per row group. Default 65536
+	group_columns: list
+		Names of extra key columns, out of GROUP_COLUMNS.
+		Default None
+	"""
+	def __init__(self, output_path:str, zone_code_dict:dict = None, statistics:list = None, output_format:str = "parquet", row_group_size:int = 65536, group_columns:list = None):
+		_import_pyarrow("Writing")
+		self.output_path = output_path
+		self.zone_code_dict = zone_code_dict
+		self.statistics = validate_statistics(statistics)
+		self.output_format = output_format
+		self.row_group_size = int(row_group_size)
+		self.group_columns = _group_columns(group_columns)
+		if (zone_code_dict is None) or all(_is_integer(name) for name in zone_code_dict.values()):
+			zone_type = pa.int64()
+		else:
+			zone_type = pa.string()
+		self.schema = pa.schema([("date", pa.date32())] + [(column, pa.string()) for column in self.group_columns] + [("zone", zone_type)] + [(stat, (pa.int64() if stat == "pixels" else pa.float64())) for stat in self.statistics])
+		if output_format == "parquet":
+			self._writer = pq.ParquetWriter(output_path, self.schema)
+		else:
+			self._writer = pa.ipc.new_file(output_path, self.schema)
+		self._rows = []
+
+	def write(self, date:str, zone_stats:dict, **groups) -> None:
+		"""Writes the zonal_stats output for one date, with a keyword
+		argument for each group column"""
+		self.write_rows(_rows(date, _group_values(self.group_columns, groups), zone_stats, self.zone_code_dict, self.statistics))
+
+	def write_cube(self, cube, **groups) -> None:
+		"""Writes every date of a cube.StatsCube, with a keyword
+		argument for each group column
+
+		Columns are built from the cube's arrays, row_group_size
+		rows (rounded to whole dates) at a time.
+		"""
+		self._flush()
+		group_values = _group_values(self.group_columns, groups)
+		zone_type = self.schema.field("zone").type
+		zone_names = [_zone_name(zone, self.zone_code_dict) for zone in cube.zones.tolist()]
+		zone_values = pa.array([(int(float(z)) if pa.types.is_integer(zone_type) else str(z)) for z in zone_names], zone_type)
+		n_zones = len(zone_values)
+		dates = np.array(cube.dates, dtype='datetime64[D]')
+		step = max(1, self.row_group_size // max(1, n_zones))
+		for start in range(0, len(dates), step):
+			rows = slice(start, start + step)
+			n_dates = len(dates[rows])
+			arrays = [pa.array(np.repeat(dates[rows], n_zones), pa.date32())]
+			arrays += [pa.array([str(g)] * (n_dates * n_zones), pa.string()) for g in group_values]
+			arrays.append(pa.concat_arrays([zone_values] * n_dates) if n_dates > 0 else zone_values[:0])
+			columns, present = _cube_columns(cube, self.statistics, rows)
+			for stat, column in zip(self.statistics, columns):
+				if stat == "pixels":
+					arrays.append(pa.array(column.ravel(), pa.int64()))
+				else:
+					arrays.append(pa.array(np.where(present, column, np.nan).ravel().astype('float64'), pa.float64()))
+			batch = pa.record_batch(arrays, schema = self.schema)
+			if self.output_format == "parquet":
+				self._writer.write_batch(batch)
+			else:
+				self._writer.write(batch)
+
+	def write_rows(self, rows) -> None:
+		"""Writes (date, *groups, zone_name, *statistics) tuples"""
+		self._rows.extend(rows)
+		if len(self._rows) >= self.row_group_size:
+			self._flush()
+
+	def _flush(self) -> None:
+		if len(self._rows) == 0:
+			return
+		columns = list(zip(*self._rows))
+		n_keys = len(self.group_columns) + 2
+		zone_type = self.schema.field("zone").type
+		arrays = [pa.array([datetime.strptime(d, "%Y-%m-%d").date() for d in columns[0]], pa.date32())]
+		arrays += [pa.array([str(g) for g in values], pa.string()) for values in columns[1:n_keys - 1]]
+		arrays.append(pa.array([(int(float(z)) if pa.types.is_integer(zone_type) else str(z)) for z in columns[n_keys - 1]], zone_type))
+		for stat, values in zip(self.statistics, columns[n_keys:]):
+			if stat == "pixels":
+				arrays.append(pa.array([int(v) for v in values], pa.int64()))
+			else:
+				arrays.append(pa.array([float(v) for v in values], pa.float64()))
+		batch = pa.record_batch(arrays, schema = self.schema)
+		if self.output_format == "parquet":
+			self._writer.write_batch(batch)
+		else:
+			self._writer.write(batch)
+		self._rows = []
+
+	def close(self) -> None:
+		self._flush()
+		self._writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def _is_integer(value) -> bool:
+	try:
+		return float(value) == int(float(value))
+	except (TypeError, ValueError):
+		return False
+
+
+def open_stats_writer(output_path:str, zone_code_dict:dict = None, statistics:list = None, group_columns:list = None, *args, **kwargs):
+	"""Returns the statistics writer matching the extension of output_path
+
+	".parquet" and ".pq" files are written as Parquet, ".arrow",
+	".feather" and ".ipc" files as Arrow IPC, and anything else
+	as csv.
+	"""
+	fmt = output_format(output_path)
+	if fmt == "csv":
+		return CsvStatsWriter(output_path, zone_code_dict, statistics, group_columns)
+	return ColumnarStatsWriter(output_path, zone_code_dict, statistics, fmt, *args, group_columns = group_columns, **kwargs)
+
+
+def _column_names(input_path:str) -> list:
+	fmt = output_format(input_path)
+	if fmt == "csv":
+		with open(input_path,'r', newline='') as rf:
+			return next(csv.reader(rf), [])
+	_import_pyarrow("Reading")
+	if fmt == "parquet":
+		return pq.read_schema(input_path).names
+	return pa.ipc.open_file(input_path).schema.names
+
+
+def read_statistics(input_path:str) -> list:
+	"""Returns names of the statistic columns in a file written by
+	one of the statistics writers"""
+	return [name for name in _column_names(input_path) if name not in KEY_COLUMNS]
+
+
+def read_group_columns(input_path:str) -> list:
+	"""Returns names of the group columns in a file written by one
+	of the statistics writers, e.g. ["product", "mask"], or an empty list"""
+	return [name for name in _column_names(input_path) if name in GROUP_COLUMNS]
+
+
+def iter_stats_rows(input_path:str):
+	"""Yields (date, *groups, zone_name, *statistics) rows from a
+	file written by one of the statistics writers
+
+	Dates are yielded as "YYYY-MM-DD" strings. Rows are read
+	one batch at a time, so memory use does not depend on the
+	size of the file.
+	"""
+	fmt = output_format(input_path)
+	if fmt == "csv":
+		with open(input_path,'r', newline='') as rf:
+			reader = csv.reader(rf)
+			names = next(reader, [])
+			statistics = [name for name in names if name not in KEY_COLUMNS]
+			n_keys = len(names) - len(statistics)
+			for items in reader:
+				yield (*items[:n_keys], *[(int(v) if stat == "pixels" else float(v)) for stat, v in zip(statistics, items[n_keys:])])
+		return
+	_import_pyarrow("Reading")
+	if fmt == "parquet":
+		batches = pq.ParquetFile(input_path).iter_batches()
+	else:
+		reader = pa.ipc.open_file(input_path)
+		batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+	for batch in batches:
+		columns = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+		for row in zip(*columns):
+			yield (row[0].strftime("%Y-%m-%d"), *row[1:])
+
+
+def iter_stats(input_path:str):
+	"""Yields ((date, *groups), [rows]) for each date and group, e.g.
+	each date, product and mask, in a file written by one of the
+	statistics writers
+
+	Relies on the rows of each of these being contiguous, which is
+	how the writers lay them out.
+	"""
+	n_groups = len(read_group_columns(input_path))
+	for key, rows in itertools.groupby(iter_stats_rows(input_path), key = lambda row: row[:n_groups + 1]):
+		yield key, list(rows)
@@ -0,0 +1,211 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import json, socket, threading, time
+from contextlib import contextmanager
+
+
+# spans are tuples of (name, category, process, thread, start, seconds, args),
+# where process is "host:pid", start is seconds since the epoch and args is a
+# dictionary that may hold "bytes", "pixels", "zones" and the task's "key"
+SPAN_FIELDS = ["name", "category", "process", "thread", "start", "seconds"]
+
+_host = socket.gethostname()
+_enabled = False
+# (pid, spans) recorded in this process and not yet collected, so that
+# a forked worker does not hand back spans its parent recorded
+_buffer = (None, [])
+_lock = threading.Lock()
+
+
+def _spans() -> list:
+	global _buffer
+	if _buffer[0] != os.getpid():
+		_buffer = (os.getpid(), [])
+	return _buffer[1]
+
+
+def enable_profiling(enabled:bool = True) -> None:
+	"""Turns recording of spans in this process on or off"""
+	global _enabled
+	_enabled = bool(enabled)
+
+
+def profiling_enabled() -> bool:
+	"""Returns whether spans are recorded in this process"""
+	return _enabled
+
+
+def add_span(name:str, category:str, start:float, seconds:float, **args) -> None:
+	"""Records a span that started at start (seconds since the
+	epoch) and lasted seconds, if profiling is enabled"""
+	if not _enabled:
+		return
+	record = (name, category, f"{_host}:{os.getpid()}", threading.current_thread().name, start, seconds, args)
+	with _lock:
+		_spans().append(record)
+
+
+def add_spans(spans:list) -> None:
+	"""Records spans collected in another process, e.g. a worker"""
+	if _enabled and spans:
+		with _lock:
+			_spans().extend(spans)
+
+
+def collect_spans() -> list:
+	"""Returns and forgets the spans recorded in this process"""
+	with _lock:
+		spans = list(_spans())
+		_spans().clear()
+	return spans
+
+
+@contextmanager
+def span(name:str, category:str = "stage", **args):
+	"""Records the time spent in a with block as a span, if
+	profiling is enabled
+
+	Yields the span's args dictionary, which the block may add
+	"bytes", "pixels" and "zones" counts to.
+	"""
+	if not _enabled:
+		yield args
+		return
+	start = time.time()
+	clock = time.perf_counter()
+	try:
+		yield args
+	finally:
+		add_span(name, category, start, time.perf_counter() - clock, **args)
+
+
+def summarize_spans(spans:list, by:list = None) -> list:
+	"""Totals spans by some of their fields
+
+	Every span counts its own seconds, so with several workers the
+	seconds of a worker stage are summed over workers, and its
+	throughput is per worker.
+
+	***
+
+	Parameters
+	----------
+	spans: list
+		Span tuples, as recorded by span
+	by: list
+		Names of fields (see SPAN_FIELDS) or args to group by.
+		Spans without one of the args are left out. Default
+		["name"]
+
+	Returns
+	-------
+	List of dictionaries, one per group in order of first
+	appearance, with the grouping fields and "count", "seconds",
+	"pixels", "bytes", "zones", "mpix_per_second" and
+	"mb_per_second"
+	"""
+	by = by or ["name"]
+	groups = {}
+	for s in spans:
+		fields = dict(zip(SPAN_FIELDS, s[:6]))
+		args = s[6]
+		if any((b not in fields) and (b not in args) for b in by):
+			continue
+		key = tuple(fields[b] if b in fields else args[b] for b in by)
+		group = groups.setdefault(key, {"count":0, "seconds":0.0, "pixels":0, "bytes":0, "zones":0})
+		group["count"] += 1
+		group["seconds"] += s[5]
+		for total in ["pixels", "bytes", "zones"]:
+			group[total] += int(args.get(total, 0))
+	rows = []
+	for key, group in groups.items():
+		seconds = group["seconds"]
+		rows.append({**dict(zip(by, key)), **group, "mpix_per_second":(group["pixels"] / seconds / 1e6 if seconds > 0 else 0.0), "mb_per_second":(group["bytes"] / seconds / 1e6 if seconds > 0 else 0.0)})
+	return rows
+
+
+def format_summary(rows:list, by:list = None) -> str:
+	"""Formats the output of summarize_spans as a table"""
+	by = by or ["name"]
+	lines = ["".join(f"{b:<24}" for b in by) + f"{'count':>8}{'seconds':>10}{'MPix':>10}{'MB':>10}{'zones':>10}{'MPix/s':>10}{'MB/s':>10}"]
+	for r in rows:
+		lines.append("".join(f"{str(r[b]):<24}" for b in by) + f"{r['count']:>8}{r['seconds']:>10.3f}{r['pixels'] / 1e6:>10.1f}{r['bytes'] / 1e6:>10.1f}{r['zones']:>10}{r['mpix_per_second']:>10.1f}{r['mb_per_second']:>10.1f}")
+	return "\n".join(lines)
+
+
+class Profiler:
+	"""Spans recorded during a run, from this process and its workers
+
+	Returned by profile; see there.
+	"""
+	def __init__(self, spans:list = None):
+		self.spans = list(spans or [])
+
+	def trace(self) -> dict:
+		"""Returns the spans as a Chrome trace, which chrome://tracing
+		and https://ui.perfetto.dev can open
+
+		Each process is one track, labelled by host and pid, with a
+		row per thread. Times are relative to the first span.
+		"""
+		origin = min((s[4] for s in self.spans), default = 0.0)
+		processes = {}
+		threads = {}
+		events = []
+		for name, category, process, thread, start, seconds, args in self.spans:
+			pid = processes.setdefault(process, len(processes) + 1)
+			tid = threads.setdefault((process, thread), len(threads) + 1)
+			events.append({"name":name, "cat":category, "ph":"X", "ts":round((start - origin) * 1e6, 3), "dur":round(max(0.0, seconds) * 1e6, 3), "pid":pid, "tid":tid, "args":args})
+		for process, pid in processes.items():
+			events.append({"name":"process_name", "ph":"M", "pid":pid, "tid":0, "args":{"name":process}})
+		for (process, thread), tid in threads.items():
+			events.append({"name":"thread_name", "ph":"M", "pid":processes[process], "tid":tid, "args":{"name":thread}})
+		return {"traceEvents":events, "displayTimeUnit":"ms", "otherData":{"start":datetime.fromtimestamp(origin).isoformat()}}
+
+	def write_trace(self, path:str) -> str:
+		"""Writes the output of trace to path as JSON"""
+		with open(path, 'w') as wf:
+			json.dump(self.trace(), wf, default = str)
+		return path
+
+	def summary(self, by:list = None) -> list:
+		"""Returns summarize_spans of the recorded spans"""
+		return summarize_spans(self.spans, by)
+
+	def format_summary(self) -> str:
+		"""Formats throughput per stage, and of the worker stages per
+		key (e.g. date), as tables"""
+		task_spans = [s for s in self.spans if s[1] == "task"]
+		by_key = sorted(summarize_spans(task_spans, ["key", "name"]), key = lambda row: row["key"])
+		return "\n\n".join([format_summary(self.summary(["name"]), ["name"]), format_summary(by_key, ["key", "name"])])
+
+
+@contextmanager
+def profile():
+	"""Records spans of everything run within a with block, e.g.
+
+		with profile() as profiler:
+			run_zonal_stats(...)
+		profiler.write_trace("trace.json")
+		print(profiler.format_summary())
+
+	Workers started within the block record the spans of their
+	tasks ("read", "reduce" and "pickle") and send them back with
+	their results; stages run here, such as "rasterize", "merge"
+	and "write", are recorded directly. Each span carries the
+	bytes read, pixels processed and zones touched, where they
+	apply. The Profiler is filled in when the block exits.
+	"""
+	previous = _enabled
+	collect_spans()
+	enable_profiling(True)
+	profiler = Profiler()
+	try:
+		yield profiler
+	finally:
+		profiler.spans = collect_spans()
+		enable_profiling(previous)
@@ -0,0 +1,230 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import re
+import numpy as np
+
+from .exceptions import *
+
+
+DEFAULT_STATISTICS = ["mean", "pixels"]
+
+STATISTICS = ["mean", "pixels", "sum", "min", "max", "std", "median"]
+
+DEFAULT_HISTOGRAM_BINS = 1000
+
+# keys used for each statistic in zonal_stats output dictionaries
+STATISTIC_KEYS = {"mean":"value"}
+
+_PERCENTILE_PATTERN = re.compile(r"^p(\d+(\.\d+)?)$")
+
+
+def validate_statistics(statistics) -> list:
+	"""Checks names of requested statistics
+
+	Valid names are those in STATISTICS, plus "pNN" for the
+	NNth percentile, e.g. "p10" or "p97.5"
+
+	Returns list of statistic names
+	"""
+	if statistics is None:
+		return list(DEFAULT_STATISTICS)
+	if isinstance(statistics, str):
+		statistics = statistics.split(",")
+	statistics = list(statistics)
+	for stat in statistics:
+		if stat in STATISTICS:
+			continue
+		match = _PERCENTILE_PATTERN.match(stat)
+		if (match is None) or (float(match.group(1)) > 100):
+			raise BadInputError(f"Unknown statistic '{stat}'. Use one of {STATISTICS} or 'pNN' for a percentile")
+	return statistics
+
+
+def statistic_key(stat:str) -> str:
+	"""Returns key under which stat is stored in zonal_stats output"""
+	return STATISTIC_KEYS.get(stat, stat)
+
+
+def _percentile(stat:str):
+	if stat == "median":
+		return 50.0
+	match = _PERCENTILE_PATTERN.match(stat)
+	return float(match.group(1)) if match else None
+
+
+def needs_histogram(statistics) -> bool:
+	"""Returns whether any requested statistic is a percentile"""
+	return any(_percentile(stat) is not None for stat in statistics)
+
+
+def required_accumulators(statistics) -> set:
+	"""Returns names of the accumulators needed for statistics"""
+	needed = {"count", "sum"}
+	for stat in statistics:
+		if stat == "std":
+			needed.add("m2")
+		elif stat in ["min", "max"]:
+			needed.add(stat)
+		elif _percentile(stat) is not None:
+			needed.update(["hist", "min", "max"])
+	return needed
+
+
+def default_histogram(dtype, statistics, bins:int = DEFAULT_HISTOGRAM_BINS):
+	"""Returns (low, high, bins) histogram spanning the range of an
+	integer data type, or None if no percentiles are requested
+
+	Float data has no natural range, so a BadInputError is raised
+	if percentiles are requested for it.
+	"""
+	if not needs_histogram(statistics):
+		return None
+	if not np.issubdtype(np.dtype(dtype), np.integer):
+		raise BadInputError(f"Percentiles of {dtype} data need an explicit histogram_range")
+	info = np.iinfo(np.dtype(dtype))
+	return (float(info.min), float(info.max) + 1, int(bins))
+
+
+def window_columns(zone_index, values, n_zones:int, statistics = DEFAULT_STATISTICS, histogram = None) -> dict:
+	"""Computes mergeable accumulators for every zone of a window in
+	a single vectorized pass, as one array per accumulator
+
+	***
+
+	Parameters
+	----------
+	zone_index: numpy.ndarray
+		Contiguous zone index (0 to n_zones - 1) of each valid
+		pixel
+	values: numpy.ndarray
+		Data value of each valid pixel
+	n_zones: int
+		Number of zones in the window
+	statistics: list
+		Names of statistics that will be requested from the
+		accumulators. Default DEFAULT_STATISTICS
+	histogram: tuple
+		(low, high, bins) of fixed-bin histogram used for
+		percentiles. Default None
+
+	Returns
+	-------
+	Dictionary of {accumulator_name:array}, where each array has
+	one entry (or, for "hist", one row) per zone index. Sums of
+	integer data are int64 arrays, but are added up in float64
+	first, so they are only exact while each zone's total in
+	the window stays below 2**53, which always holds for 8 and
+	16 bit data. "m2" is each zone's sum of squared deviations
+	from its mean in the window, which merge_columns combines
+	across windows without the cancellation of a sum of squares.
+	"""
+	needed = required_accumulators(statistics)
+	integer = np.issubdtype(values.dtype, np.integer)
+	as_float = values.astype('float64')
+
+	counts = np.bincount(zone_index, minlength=n_zones)
+	columns = {"count":counts}
+	# bincount of no pixels is int64 even with weights, which would not merge with float sums
+	columns["sum"] = np.bincount(zone_index, weights=as_float, minlength=n_zones).astype('float64', copy=False)
+	if "m2" in needed:
+		deviations = as_float - (columns["sum"] / np.maximum(counts, 1))[zone_index]
+		columns["m2"] = np.bincount(zone_index, weights=deviations * deviations, minlength=n_zones).astype('float64', copy=False)
+	if ("min" in needed) or ("max" in needed):
+		order = np.argsort(zone_index, kind='stable')
+		sorted_values = as_float[order]
+		present = counts > 0
+		starts = (np.cumsum(counts) - counts)[present]
+		columns["min"] = np.full(n_zones, np.nan)
+		columns["max"] = np.full(n_zones, np.nan)
+		if starts.size > 0:
+			columns["min"][present] = np.minimum.reduceat(sorted_values, starts)
+			columns["max"][present] = np.maximum.reduceat(sorted_values, starts)
+	if "hist" in needed:
+		low, high, bins = histogram
+		bin_index = np.clip(((as_float - low) * (bins / (high - low))).astype('int64'), 0, bins - 1)
+		columns["hist"] = np.bincount(zone_index * bins + bin_index, minlength=n_zones * bins).reshape(n_zones, bins)
+	if integer:
+		columns["sum"] = np.rint(columns["sum"]).astype('int64')
+	return columns
+
+
+def empty_columns(n_zones:int, like:dict) -> dict:
+	"""Returns accumulator arrays for n_zones zones with no pixels,
+	with the accumulators and data types of like, an output of
+	window_columns"""
+	columns = {}
+	for name, column in like.items():
+		shape = (n_zones,) + column.shape[1:]
+		columns[name] = np.full(shape, np.nan) if name in ["min", "max"] else np.zeros(shape, dtype=column.dtype)
+	return columns
+
+
+def merge_columns(stored:dict, new:dict, positions) -> dict:
+	"""Merges window_columns output new into the accumulator arrays
+	stored, in place, where positions are the indices in stored
+	of new's zones. int64 accumulators are added without
+	rounding, as long as they do not overflow. "m2" is merged
+	with the pairwise update of Chan et al., from the counts and
+	means of both sides."""
+	if "m2" in new:
+		# from the counts and sums before new's are added to them
+		stored_count = stored["count"][positions].astype('float64')
+		new_count = new["count"].astype('float64')
+		delta = new["sum"] / np.maximum(new_count, 1) - stored["sum"][positions] / np.maximum(stored_count, 1)
+		stored["m2"][positions] += new["m2"] + delta * delta * (stored_count * new_count / np.maximum(stored_count + new_count, 1))
+	for name, column in new.items():
+		if name == "m2":
+			continue
+		elif name in ["min", "max"]:
+			stored[name][positions] = (np.fmin if name == "min" else np.fmax)(stored[name][positions], column)
+		else:
+			stored[name][positions] += column
+	return stored
+
+
+def finalize_columns(columns:dict, statistics = DEFAULT_STATISTICS, histogram = None) -> dict:
+	"""Turns accumulator arrays, e.g. merged with merge_columns, into
+	one array per statistic, vectorized over zones
+
+	Returns {statistic:array} with "mean" and "pixels" whether or not
+	they were requested. Zones with no valid pixels get NaN for
+	every statistic, except for integer sums, which stay int64
+	and are 0; mask them with pixels == 0.
+	"""
+	count = columns["count"]
+	present = count > 0
+	with np.errstate(divide='ignore', invalid='ignore'):
+		out = {"mean":np.where(present, columns["sum"] / np.maximum(count, 1), np.nan), "pixels":count.astype('int64')}
+		for stat in statistics:
+			if stat in ["mean", "pixels"]:
+				continue
+			elif stat == "sum":
+				out[stat] = columns["sum"] if np.issubdtype(columns["sum"].dtype, np.integer) else np.where(present, columns["sum"], np.nan)
+			elif stat in ["min", "max"]:
+				out[stat] = np.where(present, columns[stat], np.nan)
+			elif stat == "std":
+				out[stat] = np.where(present, np.sqrt(columns["m2"] / np.maximum(count, 1)), np.nan)
+			else:
+				out[stat] = np.where(present, _histogram_percentiles(columns, _percentile(stat), histogram), np.nan)
+	return out
+
+
+def _histogram_percentiles(columns:dict, q:float, histogram):
+	"""Estimates the qth percentile of every zone of accumulator
+	arrays by linear interpolation within histogram bins"""
+	low, high, bins = histogram
+	hist = columns["hist"]
+	cumulative = np.cumsum(hist, axis=1)
+	target = (q / 100.0) * columns["count"]
+	i = np.minimum((cumulative < target[:, None]).sum(axis=1), bins - 1)
+	rows = np.arange(hist.shape[0])
+	before = np.where(i > 0, cumulative[rows, np.maximum(i - 1, 0)], 0)
+	in_bin = hist[rows, i]
+	fraction = np.where(in_bin > 0, (target - before) / np.maximum(in_bin, 1), 0)
+	value = low + (i + fraction) * ((high - low) / bins)
+	return np.minimum(np.maximum(value, columns["min"]), columns["max"])
+
@@ -0,0 +1,228 @@
+# set up logging
+import logging, os
+from datetime import datetime, timedelta
+logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
+log = logging.getLogger(__name__)
+
+import math
+import numpy as np
+
+from .util import open_raster
+from .exceptions import BadInputError
+
+
+AUTO = "auto"
+
+# block scale factors considered by the tuner
+BLOCK_SCALE_FACTORS = [1, 2, 4, 8, 16, 32, 64]
+# tasks each worker should get, at least, so that uneven windows even out
+TASKS_PER_WORKER = 4
+# memory of an idle worker process: interpreter, numpy, rasterio and GDAL's block cache
+WORKER_OVERHEAD_BYTES = 256 * 2**20
+# share of available memory used if no budget is given
+DEFAULT_MEMORY_FRACTION = 0.75
+
+
+def available_cores() -> int:
+	"""Returns the number of cores this process may run on"""
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:
+		return os.cpu_count() or 1
+
+
+def available_memory():
+	"""Returns available memory in bytes, or None if it is unknown"""
+	try:
+		with open("/proc/meminfo") as rf:
+			for line in rf:
+				if line.startswith("MemAvailable:"):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return None
+
+
+def parse_bytes(size) -> int:
+	"""Parses a size such as 512M, 8G or 1073741824 to bytes"""
+	if isinstance(size, (int, float)):
+		return int(size)
+	units = {"K":2**10, "M":2**20, "G":2**30, "T":2**40}
+	text = str(size).strip().upper().rstrip("B").rstrip("I")
+	try:
+		if text and text[-1] in units:
+			return int(float(text[:-1]) * units[text[-1]])
+		return int(float(text))
+	except ValueError:
+		raise BadInputError(f"Could not parse memory size '{size}'. Use e.g. 512M or 8G")
+
+
+def resolve_cores(n_cores) -> int:
+	"""Returns n_cores, or available_cores() if it is "auto" """
+	return available_cores() if n_cores == AUTO else int(n_cores)
+
+
+def window_bytes(pixels:int, data_itemsize:int, zone_itemsize:int, n_masks:int = 0) -> int:
+	"""Estimates the peak memory of one worker task (zonal._read_window
+	followed by zonal._reduce_window)
+
+	Counts the data, zone and mask windows as read, and the
+	flattened copies and int64 / float64 working arrays of the
+	reduction, as if every pixel were inside a zone. This is an
+	upper bound; the actual use depends on zone coverage.
+	"""
+	masks = max(1, n_masks)
+	read = data_itemsize + zone_itemsize + n_masks
+	# in-zone and valid flags, flattened zone and data pixels, contiguous zone index
+	flattened = 2 + zone_itemsize + data_itemsize + 8
+	# per mask keys and values, then their concatenation, float copy and sort
+	reduction = masks * (1 + 2 * (8 + data_itemsize)) + 8 * 3
+	return int(pixels * (read + flattened + reduction))
+
+
+def zone_occupancy(zone_raster:str, cell_size:int) -> np.ndarray:
+	"""Returns a boolean grid of which cell_size by cell_size cells of
+	zone_raster contain any zone pixel, reading it one row of cells
+	at a time"""
+	from rasterio.windows import Window
+	with open_raster(zone_raster) as zone_handle:
+		width, height = zone_handle.width, zone_handle.height
+		nodata = zone_handle.nodata
+		n_rows, n_cols = math.ceil(height / cell_size), math.ceil(width / cell_size)
+		occupied = np.zeros((n_rows, n_cols), dtype=bool)
+		for r in range(n_rows):
+			strip = zone_handle.read(1, window=Window(0, r * cell_size, width, min(cell_size, height - r * cell_size)))
+			in_zone = (strip != nodata).any(axis=0)
+			padded = np.zeros(n_cols * cell_size, dtype=bool)
+			padded[:width] = in_zone
+			occupied[r] = padded.reshape(n_cols, cell_size).any(axis=1)
+	return occupied
+
+
+def _grouped(occupied:np.ndarray, factor:int) -> np.ndarray:
+	"""Groups an occupancy grid into factor by factor cells"""
+	n_rows, n_cols = math.ceil(occupied.shape[0] / factor), math.ceil(occupied.shape[1] / factor)
+	padded = np.zeros((n_rows * factor, n_cols * factor), dtype=bool)
+	padded[:occupied.shape[0], :occupied.shape[1]] = occupied
+	return padded.reshape(n_rows, factor, n_cols, factor).any(axis=(1, 3))
+
+
+def tune(model_raster:str, zone_raster:str, n_keys:int = 1, n_masks:int = 0, memory_budget = None, block_scale_factor = AUTO, n_cores = AUTO, default_block_size:int = 256, overview_level:int = None, prefetch_depth:int = 0, executor:str = "process") -> dict:
+	"""Picks the window size and number of workers for a zonal run
+
+	Windows are whole multiples (the block scale factor) of the
+	data raster's tiles, as in zonal.get_windows. Larger windows
+	mean fewer, larger reads, so the largest factor is chosen
+	whose windows still give every worker at least
+	TASKS_PER_WORKER tasks, counting only windows that contain
+	zones, and that fits the memory budget with that many
+	workers. Coarse rasters therefore get small windows and
+	all their cores, and dense ones as many workers as memory
+	allows. Either value can be fixed, in which case only the
+	other is tuned. The decision is logged, with the options
+	that reproduce it.
+
+	***
+
+	Parameters
+	----------
+	model_raster: str
+		Path to a data raster of the run
+	zone_raster: str
+		Path to zone raster on a sub-grid of model_raster
+	n_keys: int
+		Number of data rasters (e.g. dates) to calculate.
+		Default 1
+	n_masks: int
+		Number of mask rasters read with each window. Default
+		0
+	memory_budget: int or str
+		Memory the run may use, in bytes or as e.g. "8G". If
+		None, DEFAULT_MEMORY_FRACTION of available memory, or
+		no limit if that is unknown. Default None
+	block_scale_factor: int or str
+		Fixed block scale factor, or "auto". Default "auto"
+	n_cores: int or str
+		Fixed number of workers, or "auto" for up to
+		available_cores(). Default "auto"
+	default_block_size: int
+		Inferred block size for untiled data raster.
+		Default 256
+	overview_level: int
+		Overview level of model_raster that is read. Default
+		None
+	prefetch_depth: int
+		Windows read ahead per worker; see
+		zonal.run_zonal_jobs. Default 0
+	executor: str
+		Kind of executor; thread workers share the overhead of
+		one process. Default "process"
+
+	Returns
+	-------
+	Dictionary with keys "block_scale_factor", "n_cores",
+	"window_size" (pixels per side), "windows" and
+	"zone_windows" (all windows, and those with zones), "tasks",
+	"max_workers_memory" (workers that fit the budget, or None
+	if unlimited), "estimated_bytes", "memory_budget" and
+	"available_cores"
+	"""
+	with open_raster(model_raster, overview_level) as handle:
+		data_itemsize = np.dtype(handle.dtypes[0]).itemsize
+		tiled = handle.profile.get('tiled', False)
+		block_width = handle.block_shapes[0][1]
+	with open_raster(zone_raster) as zone_handle:
+		zone_itemsize = np.dtype(zone_handle.dtypes[0]).itemsize
+		zone_width, zone_height = zone_handle.width, zone_handle.height
+	cell_size = block_width if tiled else int(default_block_size)
+
+	if memory_budget is None:
+		memory = available_memory()
+		memory_budget = int(memory * DEFAULT_MEMORY_FRACTION) if memory is not None else None
+	else:
+		memory_budget = parse_bytes(memory_budget)
+	cores = available_cores()
+	occupied = zone_occupancy(zone_raster, cell_size)
+
+	def evaluate(factor):
+		size = cell_size * factor
+		pixels = min(size, zone_width) * min(size, zone_height)
+		# each read-ahead window holds its data, zone and mask arrays until reduced
+		per_worker = window_bytes(pixels, data_itemsize, zone_itemsize, n_masks) + int(prefetch_depth) * pixels * (data_itemsize + zone_itemsize + n_masks)
+		overhead = WORKER_OVERHEAD_BYTES if executor != "thread" else 0
+		if memory_budget is None:
+			max_workers = None
+		else:
+			available = memory_budget - (WORKER_OVERHEAD_BYTES if executor == "thread" else 0)
+			max_workers = max(0, available // (per_worker + overhead))
+		grouped = _grouped(occupied, factor)
+		tasks = int(grouped.sum()) * int(n_keys)
+		if n_cores == AUTO:
+			workers = min(cores, max(1, tasks // TASKS_PER_WORKER))
+			if max_workers is not None:
+				workers = min(workers, max_workers)
+		else:
+			workers = int(n_cores)
+		fits = (max_workers is None) or (max_workers >= max(1, workers))
+		busy = min(workers, tasks // TASKS_PER_WORKER)
+		estimate = workers * (per_worker + overhead) + (WORKER_OVERHEAD_BYTES if executor == "thread" else 0)
+		return {"block_scale_factor":factor, "n_cores":max(1, workers), "window_size":size, "windows":int(grouped.size), "zone_windows":int(grouped.sum()), "tasks":tasks, "max_workers_memory":(int(max_workers) if max_workers is not None else None), "estimated_bytes":int(estimate), "memory_budget":memory_budget, "available_cores":cores, "_fits":fits, "_busy":busy}
+
+	factors = BLOCK_SCALE_FACTORS if block_scale_factor == AUTO else [int(block_scale_factor)]
+	# no point in windows much larger than the zone raster
+	largest = max(zone_width, zone_height)
+	candidates = [evaluate(f) for f in factors if (f == factors[0]) or (cell_size * f < 2 * largest)]
+	fitting = [c for c in candidates if c["_fits"]]
+	if fitting:
+		# keep workers busy first, then prefer fewer, larger windows
+		decision = max(fitting, key = lambda c: (c["_busy"], c["block_scale_factor"]))
+	else:
+		decision = candidates[0]
+		log.warning(f"No window size fits the memory budget of {memory_budget / 2**20:.0f} MiB; using the smallest")
+		if n_cores == AUTO:
+			decision["n_cores"] = 1
+	decision = {k:v for k, v in decision.items() if not k.startswith("_")}
+
+	budget = f"{memory_budget / 2**20:.0f} MiB" if memory_budget is not None else "unlimited"
+	log.info(f"Tuned {os.path.basename(model_raster)}: {decision['window_size']} px windows (block scale factor {decision['block_scale_factor']}), {decision['zone_windows']} of {decision['windows']} with zones, {decision['tasks']} tasks; {decision['n_cores']} of {cores} cores; about {decision['estimated_bytes'] / 2**20:.0f} MiB of a {budget} budget. To reproduce: --block_scale_factor {decision['block_scale_factor']} --cores {decision['n_cores']}")
+	return decision
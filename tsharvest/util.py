@@ -4,12 +4,12 @@ from datetime import datetime, timedelta
 logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
 log = logging.getLogger(__name__)
 
-import glob, os, rasterio, shutil, subprocess
-import geopandas as gpd
+import glob, math, os, shutil
+import numpy as np
 from datetime import datetime
-from pyproj import CRS
-from rasterio import features
-from rasterio.windows import Window
+# rasterio, geopandas and pyproj are imported by the functions that use
+# them, since loading them takes longer than most short runs of the
+# command line script need before it starts reading data
 
 from .const import *
 from .exceptions import *
@@ -31,24 +31,30 @@ def clean() ->  bool:
 # raster/vector utilities
 
 
+def overview_factors(width:int, height:int, min_size:int = 256) -> list:
+	"""Returns power-of-two overview factors down to min_size pixels"""
+	factors = []
+	factor = 2
+	while max(width, height) / factor >= min_size:
+		factors.append(factor)
+		factor *= 2
+	return factors
+
+
 def cloud_optimize_inPlace(in_file:str,compress="LZW") -> None:
-	"""Takes path to input and output file location. Reads tif at input location and writes cloud-optimized geotiff of same data to output location."""
+	"""Takes path to input file. Rewrites it in place as a tiled, compressed geotiff with overviews."""
+	import rasterio, rasterio.shutil
+	from rasterio.enums import Resampling
 	## add overviews to file
-	cloudOpArgs = ["gdaladdo",in_file]
-	subprocess.call(cloudOpArgs)
-
-	## copy file
-	intermediate_file = in_file.replace(".tif",".TEMP.tif")
-	with open(intermediate_file,'wb') as a:
-		with open(in_file,'rb') as b:
-			shutil.copyfileobj(b,a)
+	with rasterio.open(in_file,'r+') as img:
+		img.build_overviews(overview_factors(img.width, img.height), Resampling.nearest)
 
 	## add tiling to file
-	cloudOpArgs = ["gdal_translate",intermediate_file,in_file,'-q','-co', "TILED=YES",'-co',"COPY_SRC_OVERVIEWS=YES",'-co', f"COMPRESS={compress}"]#, "-co", "PREDICTOR=2"]
-	subprocess.call(cloudOpArgs)
+	intermediate_file = in_file.replace(".tif",".TEMP.tif")
+	rasterio.shutil.copy(in_file, intermediate_file, driver="GTiff", tiled=True, copy_src_overviews=True, compress=compress)
 
-	## remove intermediate
-	os.remove(intermediate_file)
+	## replace original
+	os.replace(intermediate_file, in_file)
 
 
 def reproject_shapefile(shapefile_path, model_raster, out_path) -> str:
@@ -72,6 +78,7 @@ def reproject_shapefile(shapefile_path, model_raster, out_path) -> str:
 	-------
 	String path to new reprojected shapefile
 	"""
+	import rasterio
 	# get raster projection as wkt
 	with rasterio.open(model_raster,'r') as img:
 		raster_wkt = img.profile['crs'].to_wkt()
@@ -79,6 +86,8 @@ def reproject_shapefile(shapefile_path, model_raster, out_path) -> str:
 	with open(shapefile_path.replace(".shp",".prj")) as rf:
 		shapefile_wkt = rf.read()
 
+	out_shapefile_path = out_path
+
 	# if it's a match, nothing needs to be done
 	if raster_wkt == shapefile_wkt:
 		log.warning("CRS already match")
@@ -97,13 +106,14 @@ def reproject_shapefile(shapefile_path, model_raster, out_path) -> str:
 				with open(out_f,'wb') as wf:
 					shutil.copyfileobj(rf,wf)
 	else:
+		import geopandas as gpd
+		from pyproj import CRS
 		# get CRS objects
 		raster_crs = CRS.from_wkt(raster_wkt)
 		shapefile_crs = CRS.from_wkt(shapefile_wkt)
 		#transformer = Transformer.from_crs(raster_crs,shapefile_crs)
 
 		# convert geometry and crs
-		out_shapefile_path = out_path # os.path.join(temp_dir,os.path.basename(shapefile_path))
 		data = gpd.read_file(shapefile_path)
 		data_proj = data.copy()
 		data_proj['geometry'] = data_proj['geometry'].to_crs(raster_crs)
@@ -116,9 +126,70 @@ def reproject_shapefile(shapefile_path, model_raster, out_path) -> str:
 	return out_shapefile_path
 
 
-def shapefile_toRaster(shapefile_path, model_raster, out_path, zone_field:str = None, dtype = None, *args, **kwargs) -> str:
+def open_raster(raster_path, overview_level:int = None):
+	"""Opens a raster for reading, at one of its overview levels if
+	overview_level is set (0 is the first overview)"""
+	import rasterio
+	if overview_level is None:
+		return rasterio.open(raster_path,'r')
+	try:
+		return rasterio.open(raster_path,'r',overview_level=int(overview_level))
+	except rasterio.errors.RasterioIOError:
+		raise BadInputError(f"Raster {raster_path} has no overview level {overview_level}")
+
+
+def zone_window(shapefile_path, model_raster, overview_level:int = None):
+	"""Returns the window of a model raster that covers a shapefile
+
+	The window is expanded outward to whole pixels, snapped to
+	the block (tile) grid of the model raster, and clipped to its
+	extent. The shapefile must already be in the projection of
+	the model raster.
+
+	***
+
+	Parameters
+	----------
+	shapefile_path: str
+		Path to input shapefile
+	model_raster: str
+		Path to existing raster dataset
+	overview_level: int
+		If set, the window is on this overview level of
+		model_raster. Default None
+
+	Returns
+	-------
+	rasterio.windows.Window
+	"""
+	import geopandas as gpd
+	from rasterio.windows import Window, from_bounds
+	shp = gpd.read_file(shapefile_path)
+	with open_raster(model_raster, overview_level) as rst:
+		transform = rst.transform
+		width = rst.width
+		height = rst.height
+		blockysize, blockxsize = rst.block_shapes[0]
+
+	left, bottom, right, top = shp.total_bounds
+	bounds_window = from_bounds(left, bottom, right, top, transform)
+	col_start = max(0, (math.floor(bounds_window.col_off) // blockxsize) * blockxsize)
+	row_start = max(0, (math.floor(bounds_window.row_off) // blockysize) * blockysize)
+	col_stop = min(width, math.ceil((bounds_window.col_off + bounds_window.width) / blockxsize) * blockxsize)
+	row_stop = min(height, math.ceil((bounds_window.row_off + bounds_window.height) / blockysize) * blockysize)
+	if (col_stop <= col_start) or (row_stop <= row_start):
+		raise BadInputError(f"Shapefile {shapefile_path} does not overlap raster {model_raster}")
+
+	return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def shapefile_toRaster(shapefile_path, model_raster, out_path, zone_field:str = None, dtype = None, clip:bool = True, compress:str = "LZW", overviews:bool = False, overview_level:int = None, *args, **kwargs) -> str:
 	"""Burns shapefile into raster image
 
+	Output is written directly as a tiled, compressed geotiff
+	whose tiles match the blocks of model_raster, so windowed
+	reads of the two line up block for block.
+
 	***
 
 	Parameters
@@ -140,10 +211,41 @@ def shapefile_toRaster(shapefile_path, model_raster, out_path, zone_field:str =
 	dtype: str
 		If set, overrides default int32 dtype with new data type,
 		e.g. float32. Default None
+	clip: bool
+		If True, output raster only covers the bounding box of
+		the shapefile, snapped to the block grid of
+		model_raster (see zone_window), rather than its full
+		extent. Pixels still line up with model_raster.
+		Default True
+	compress: str
+		Compression of output raster. Default "LZW"
+	overviews: bool
+		Whether to add overviews to output raster. The
+		zonal statistics code does not read them. Default
+		False
+	overview_level: int
+		If set, zones are burned onto this overview level of
+		model_raster instead of its full resolution grid.
+		Default None
 	"""
+	import geopandas as gpd
+	import rasterio
+	from rasterio import features
+	from rasterio.enums import Resampling
 	shp = gpd.read_file(shapefile_path)
-	with rasterio.open(model_raster,'r') as rst:
+	with open_raster(model_raster, overview_level) as rst:
 		meta = rst.meta.copy()
+		blockysize, blockxsize = rst.block_shapes[0]
+
+	# tile output to match the model raster; untiled (striped) models get the default tile size
+	if (blockxsize % 16 != 0) or (blockysize % 16 != 0) or (blockxsize == meta['width']):
+		blockxsize = blockysize = 256
+	meta.update(driver="GTiff", tiled=True, blockxsize=blockxsize, blockysize=blockysize, compress=compress)
+
+	# shrink output grid to the region of interest
+	if clip:
+		window = zone_window(shapefile_path, model_raster, overview_level)
+		meta.update(width=int(window.width), height=int(window.height), transform=rasterio.windows.transform(window, meta['transform']))
 
 	# this is where we create a generator of geom, value pairs to use in rasterizing
 	if zone_field is not None:
@@ -164,16 +266,18 @@ def shapefile_toRaster(shapefile_path, model_raster, out_path, zone_field:str =
 		meta.update(dtype="int16")
 
 	try:
-		out =  rasterio.open(out_path, 'w+', **meta)
+		out =  rasterio.open(out_path, 'w', **meta)
 	# merra-2 files have a very high nodata value, beyond the range of int32.
 	# This block catches the resulting ValueError and swaps in the minimum
 	# allowable data type. Nice of rasterio to have such a function.
 	except ValueError:
 		meta.update(dtype=rasterio.dtypes.get_minimum_dtype([meta['nodata']]))
-		out = rasterio.open(out_path, 'w+', **meta)
-	out_arr = out.read(1)
+		out = rasterio.open(out_path, 'w', **meta)
+	out_arr = np.full((out.height, out.width), (out.nodata if out.nodata is not None else 0), dtype=out.dtypes[0])
 	burned = features.rasterize(shapes=shapes, fill=0, out=out_arr, transform=out.transform)
 	out.write_band(1, burned)
+	if overviews:
+		out.build_overviews(overview_factors(out.width, out.height), Resampling.nearest)
 	out.close()
 
 	return out_path
@@ -197,6 +301,7 @@ def zone_field_toCodes(shapefile_path, zone_field) -> dict:
 	where zone_code is a unique integer corresponding
 	to zone_name.
 	"""
+	import geopandas as gpd
 	shp = gpd.read_file(shapefile_path)
 	zone_vals = []
 	for i in range(len(shp)):
@@ -213,6 +318,7 @@ def zone_field_toCodes(shapefile_path, zone_field) -> dict:
 
 
 def getWindows(width, height, blocksize) -> list:
+	from rasterio.windows import Window
 	hnum, vnum = width, height
 	windows = []
 	for hstart in range(0, hnum, blocksize):
@@ -228,6 +334,59 @@ def getWindows(width, height, blocksize) -> list:
 	return windows
 
 
+def grid_offset(zone_raster, data_raster, overview_level:int = None) -> tuple:
+	"""Returns (column, row) of the upper-left pixel of zone_raster
+	within data_raster, or within its overview_level overview if
+	that is set
+
+	The two rasters must share pixel size and alignment; a
+	zone_raster burned with shapefile_toRaster(clip = True) is
+	a sub-grid of its model raster.
+	"""
+	import rasterio
+	with rasterio.open(zone_raster,'r') as zone_handle:
+		zone_transform = zone_handle.transform
+	with open_raster(data_raster, overview_level) as data_handle:
+		data_transform = data_handle.transform
+	zone_pixel = (zone_transform.a, zone_transform.b, zone_transform.d, zone_transform.e)
+	data_pixel = (data_transform.a, data_transform.b, data_transform.d, data_transform.e)
+	if not np.allclose(zone_pixel, data_pixel):
+		raise BadInputError(f"Pixel size of {zone_raster} does not match {data_raster}")
+	col, row = ~data_transform * (zone_transform.c, zone_transform.f)
+	if (abs(col - round(col)) > 1e-6) or (abs(row - round(row)) > 1e-6):
+		raise BadInputError(f"Pixels of {zone_raster} are not aligned with {data_raster}")
+	return int(round(col)), int(round(row))
+
+
+def resample_toOverview(raster_path, model_raster, overview_level:int, out_path, compress:str = "LZW") -> str:
+	"""Writes a nearest-neighbour copy of a raster on the grid of an
+	overview level of model_raster
+
+	Used for rasters without overviews of their own, such as crop
+	masks, that share the full resolution grid of model_raster.
+	"""
+	import rasterio
+	from rasterio.enums import Resampling
+	with open_raster(model_raster, overview_level) as model:
+		width, height, transform = model.width, model.height, model.transform
+		blockysize, blockxsize = model.block_shapes[0]
+	with rasterio.open(raster_path,'r') as img:
+		meta = img.meta.copy()
+		data = img.read(1, out_shape=(height, width), resampling=Resampling.nearest)
+	if (blockxsize % 16 != 0) or (blockysize % 16 != 0) or (blockxsize == width):
+		blockxsize = blockysize = 256
+	meta.update(driver="GTiff", width=width, height=height, transform=transform, tiled=True, blockxsize=blockxsize, blockysize=blockysize, compress=compress)
+	with rasterio.open(out_path,'w',**meta) as out:
+		out.write_band(1, data)
+	return out_path
+
+
+def offset_window(window, offset):
+	"""Shifts a window by a (column, row) offset"""
+	from rasterio.windows import Window
+	return Window(window.col_off + offset[0], window.row_off + offset[1], window.width, window.height)
+
+
 def parseDateString(input_string) -> datetime.date:
 	"""Parses string to datetime"""
 	for date_format in ["%Y-%m-%d","%Y.%j"]:
@@ -243,8 +402,10 @@ def dateFromFilePath(file_path) -> datetime.date:
 	"""Parses GLAM data file path to datetime date object"""
 	baseName = os.path.basename(file_path)
 	name, ext = os.path.splitext(baseName)
+	# external products are recognized by their directory too, so that copies of the archive parse the same
+	external = (EXTERNAL_DIR in file_path) or (os.path.basename(os.path.dirname(file_path)) in EXTERNAL_PRODUCTS)
 	try:
-		if not EXTERNAL_DIR in file_path:
+		if not external:
 			try:
 				product, year, doy = name.split(".")
 				date = ".".join([year, doy])
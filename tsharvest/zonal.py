@@ -4,21 +4,41 @@ from datetime import datetime, timedelta
 logging.basicConfig(level=os.environ.get("LOGLEVEL","INFO"))
 log = logging.getLogger(__name__)
 
-import rasterio
+import pickle, threading
 import numpy as np
+from collections import deque
 from datetime import datetime
 from multiprocessing import Pool
+from time import perf_counter
 
 from .util import *
 from .const import *
+from .executor import make_executor
+from .tuning import AUTO, TASKS_PER_WORKER, available_cores, tune
+from .profiling import span, add_spans, collect_spans, profiling_enabled
+from .datasets import DEFAULT_MAX_HANDLES, init_worker, open_dataset, read_layer, preload_layer, release_layer, handle_cache_stats, process_handle_stats, summarize_handle_stats, io_pool, window_is_empty, release_exited_threads, shutdown_io_pool
+from .stats import DEFAULT_STATISTICS, DEFAULT_HISTOGRAM_BINS, validate_statistics, statistic_key, needs_histogram, default_histogram, window_columns, empty_columns, merge_columns, finalize_columns
+from .cube import StatsCube
 
 
-def _zonal_worker(args):
-	"""A function for use with the multiprocessing
-	package, passed to each worker.
+# zones with fewer pixels than this at an overview level are calculated at full resolution
+DEFAULT_OVERVIEW_MIN_PIXELS = 4
+
+
+def _read_window(args) -> tuple:
+	"""Reads the product, zone and mask windows of a task, the first
+	step of _tagged_zonal_worker and _prefetched_zonal_worker
 
-	Returns a dictionary of the form:
-		{zone_id:{'value':VALUE,'arable_pixels':VALUE,'percent_arable':VALUE},...}
+	Returns a tuple of (product_data, product_noDataVal,
+	shape_data, shape_noDataVal, mask_data, empty), where
+	mask_data is a list with one array per mask, or None for no
+	mask, and empty is whether the product window lies entirely
+	in blocks left out of a sparse file (see
+	datasets.window_is_empty). Such windows are not read; their
+	product_data is a read-only array of nodata. Masks are only
+	read if the window contains zone pixels and may contain
+	data. Safe to call from an I/O thread, since every thread
+	opens its own datasets.
 
 	Parameters
 	----------
@@ -27,151 +47,960 @@ def _zonal_worker(args):
 			targetwindow
 			product_path
 			shape_path
+			mask_paths
+			statistics
+			histogram
+			offset
+			overview_level
+		where targetwindow is on the grid of shape_path,
+		mask_paths is a tuple of mask raster paths (None for
+		no mask), offset is the (column, row) of that grid
+		within the product and mask rasters, and
+		overview_level is the overview of the product to
+		read, or None for full resolution
 	"""
-	targetwindow, product_path, shape_path, mask_path = args
-
-
-	# get product raster info
-	product_handle = rasterio.open(product_path,'r')
-	product_noDataVal = product_handle.meta['nodata']
-	product_data = product_handle.read(1,window=targetwindow)
-	product_handle.close()
-
-	# get shape raster info
-	shape_handle = rasterio.open(shape_path,'r')
-	shape_noDataVal = shape_handle.meta['nodata']
-	shape_data = shape_handle.read(1,window=targetwindow)
-	shape_handle.close()
-
-	# get mask raster info
-	if mask_path is not None:
-		mask_handle = rasterio.open(mask_path,'r')
-		mask_data = mask_handle.read(1,window=targetwindow)
-		mask_handle.close()
+	targetwindow, product_path, shape_path, mask_paths, statistics, histogram, offset, overview_level = args
+	datawindow = offset_window(targetwindow, offset)
+
+
+	# get product raster info; windows known to be nodata are not read
+	product_handle = open_dataset(product_path, overview_level)
+	product_noDataVal = product_handle.nodata
+	empty = window_is_empty(product_handle, datawindow)
+	if empty:
+		product_data = np.broadcast_to(np.array(product_noDataVal, dtype=product_handle.dtypes[0]), (int(datawindow.height), int(datawindow.width)))
 	else:
-		mask_data = np.full(product_data.shape,1)
+		product_data = product_handle.read(1,window=datawindow)
+
+	# get shape raster info; shape and mask may be preloaded on the shape grid
+	shape_data, shape_noDataVal = read_layer(shape_path, targetwindow)
+	if empty or not (shape_data != shape_noDataVal).any():
+		return product_data, product_noDataVal, shape_data, shape_noDataVal, [None for mask_path in mask_paths], empty
+
+	mask_data = [(read_layer(mask_path, targetwindow, offset)[0] if mask_path is not None else None) for mask_path in mask_paths]
+	return product_data, product_noDataVal, shape_data, shape_noDataVal, mask_data, empty
+
+
+def _reduce_window(args, reads:tuple) -> tuple:
+	"""Reduces the windows read by _read_window for the same task
+	args, the second step of _tagged_zonal_worker and
+	_prefetched_zonal_worker
+
+	Returns a tuple of (zones, mask_columns), where zones is an
+	array of the zone codes in the window and mask_columns a list
+	with, per mask, the accumulator arrays of those zones (see
+	stats.window_columns), or None if the window has no zone
+	pixels. This is far cheaper to send between processes than a
+	dictionary per zone.
+	"""
+	targetwindow, product_path, shape_path, mask_paths, statistics, histogram, offset, overview_level = args
+	product_data, product_noDataVal, shape_data, shape_noDataVal, mask_data, empty = reads
+
+
+	# flatten window to the pixels that fall within any zone
+	in_zone = (shape_data != shape_noDataVal)
+	zone_pixels = shape_data[in_zone]
+	if zone_pixels.size == 0:
+		return zone_pixels, [None for mask_path in mask_paths]
+	product_pixels = product_data[in_zone]
+	has_data = (product_pixels != product_noDataVal)
 
+	# map zone codes to contiguous indices
+	uniquezones, zone_index = np.unique(zone_pixels, return_inverse=True)
+	zone_index = zone_index.ravel()
+	n_zones = uniquezones.size
 
-	# create empty output dictionary
-	out_dict = {}
+	# each mask is an extra key alongside the zone, so that every
+	# (mask, zone) pair is reduced in the same pass over the window
+	key_parts = []
+	value_parts = []
+	for m, mask_path in enumerate(mask_paths):
+		valid = has_data
+		# empty windows have no valid pixels to mask, and their masks are not read
+		if (mask_path is not None) and not empty:
+			valid = valid & (mask_data[m][in_zone] == 1)
+		key_parts.append(zone_index[valid] + m * n_zones)
+		value_parts.append(product_pixels[valid])
+	columns = window_columns(np.concatenate(key_parts), np.concatenate(value_parts), n_zones * len(mask_paths), statistics, histogram)
 
-	# loop over all admin codes present in shape_
-	uniquezones = np.unique(shape_data[shape_data != shape_noDataVal]) # exclude nodata value
-	for zone_code in uniquezones:
-		valid_pixels = int((shape_data[(shape_data == zone_code)]).size)
-		if valid_pixels == 0:
-			continue
-		masked = np.array(product_data[(product_data != product_noDataVal) & (shape_data == zone_code) & (mask_data == 1)], dtype='int64')
-		value = (masked.mean() if (masked.size > 0) else 0)
-		out_dict[zone_code] = {"value":value,"pixels":masked.size}
+	return uniquezones, [{name:column[m * n_zones:(m + 1) * n_zones] for name, column in columns.items()} for m in range(len(mask_paths))]
 
-	return out_dict
 
+def _task_span_args(key, worker_args) -> dict:
+	"""Returns the args identifying a task in its profiling spans"""
+	j, data_key = key
+	targetwindow = worker_args[0]
+	return {"job":j, "key":str(data_key), "col":int(targetwindow.col_off), "row":int(targetwindow.row_off)}
 
-def _update(stored_dict,this_dict) -> dict:
-	"""Updates stats dictionary with values from a new window result
+
+def _profiled_read(key, worker_args) -> tuple:
+	"""Runs _read_window, recording a "read" span of the pixels
+	and (decoded) bytes read if profiling is enabled"""
+	with span("read", "task", **_task_span_args(key, worker_args)) as args:
+		reads = _read_window(worker_args)
+		product_data, product_noDataVal, shape_data, shape_noDataVal, mask_data, empty = reads
+		args["pixels"] = int(product_data.size)
+		args["bytes"] = (0 if empty else int(product_data.nbytes)) + int(shape_data.nbytes) + sum(int(m.nbytes) for m in mask_data if m is not None)
+		args["empty"] = bool(empty)
+	return reads
+
+
+def _profiled_reduce(key, worker_args, reads:tuple) -> list:
+	"""Runs _reduce_window, recording a "reduce" span of the pixels
+	processed and zones touched if profiling is enabled"""
+	with span("reduce", "task", **_task_span_args(key, worker_args)) as args:
+		window_result = _reduce_window(worker_args, reads)
+		args["pixels"] = int(reads[2].size)
+		args["zones"] = len(window_result[0])
+	return window_result
+
+
+def _profile_pickle(results:list) -> None:
+	"""Records a "pickle" span of the time it takes to serialize a
+	worker's results, if profiling is enabled
+
+	Results are pickled once more to measure this. Thread pool
+	workers, whose results are not pickled, are left out; process
+	and distributed workers run their tasks on their main thread.
+	"""
+	if profiling_enabled() and (threading.current_thread() is threading.main_thread()):
+		with span("pickle", "task") as args:
+			args["bytes"] = len(pickle.dumps(results, protocol = pickle.HIGHEST_PROTOCOL))
+
+
+def _tagged_zonal_worker(args):
+	"""A function for use with the multiprocessing package, passed
+	to each worker. Reads (_read_window) and reduces
+	(_reduce_window) one task, tagged with its key so that results
+	arriving out of order can be matched back to their data file
+
+	Returns a list with one tuple of (key, window_result), and a
+	tuple of (handle_stats, io_seconds, compute_seconds,
+	empty_windows, spans), where handle_stats is a list of
+	datasets.handle_cache_stats() tuples, io_seconds is the time
+	spent reading, compute_seconds the time spent reducing,
+	empty_windows 1 if the product window was skipped as empty
+	and spans the profiling spans recorded since the last task
+	(see profiling.profile). Both have the same form as the
+	return value of _prefetched_zonal_worker.
 
 	Parameters
 	----------
-	stored_dict:dict
-		Dictionary to be updated with new data
-	this_dict:dict
-		New data with which to update stored_dict
+	args:tuple
+		Tuple of (key, worker_args), where worker_args is
+		passed on to _read_window and _reduce_window unchanged
 	"""
-	out_dict = stored_dict
-	for k in this_dict.keys():
-		this_info = this_dict[k]
-		try:
-			stored_info = stored_dict[k]
-		except KeyError: # if stored_dict has no info for zone k (new zone in this window), set it equal to the info from this_dict
-			out_dict[k] = this_info
-			continue
-		try:
-			# weight of stored_dict value is the ratio of its valid pixels to the total new sum of valid pixels
-			stored_weight = float(stored_info['pixels']) / float(stored_info['pixels'] + this_info['pixels'])
-		except ZeroDivisionError:
-			# if no valid pixels at all, weight everything at 0
-			stored_weight = 0
-		try:
-			# weight of this_dict value is the ratio of its valid pixels to the total new sum of valid pixels
-			this_weight = float(this_info['pixels']) / float(stored_info['pixels'] + this_info['pixels'])
-		except ZeroDivisionError:
-			# if the total valid pixels are 0, everything gets weight 0
-			this_weight = 0
-		## weighted mean value
-		value = (stored_info['value'] * stored_weight) + (this_info['value'] * this_weight)
-		out_dict[k] = {'value':value, 'pixels':stored_info['pixels'] + this_info['pixels']}
-	return out_dict
-
-
-def zonal_stats(zone_raster:str, data_raster:str, mask_raster = None, n_cores:int = 1, block_scale_factor: int = 8, default_block_size: int = 256, time:bool = False, *args, **kwargs) -> dict:
-	"""Generates zonal statistics based on input data and zone rasters
+	key, worker_args = args
+	start = perf_counter()
+	reads = _profiled_read(key, worker_args)
+	read_end = perf_counter()
+	results = [(key, _profiled_reduce(key, worker_args, reads))]
+	compute_seconds = perf_counter() - read_end
+	_profile_pickle(results)
+	return results, ([handle_cache_stats()], read_end - start, compute_seconds, int(reads[-1]), collect_spans())
+
+
+def _prefetched_zonal_worker(args):
+	"""Runs a batch of tasks, reading the windows of the next ones
+	on the process's I/O threads (see datasets.io_pool) while the
+	current one is reduced
+
+	At most prefetch_depth reads are in flight or waiting at any
+	time, which bounds the extra memory to that many windows.
+
+	Returns a list of (key, window_result) tuples, in the order
+	of the batch, and a tuple of (handle_stats, io_wait_seconds,
+	compute_seconds, empty_windows, spans), where
+	io_wait_seconds is only the time spent waiting for reads
+	that had not finished yet
+
+	Parameters
+	----------
+	args:tuple
+		Tuple of (batch, prefetch_depth, io_threads), where
+		batch is a list of _tagged_zonal_worker arguments
+	"""
+	batch, prefetch_depth, io_threads = args
+	pool = io_pool(io_threads)
+	tasks = iter(batch)
+	in_flight = deque()
+
+	def submit():
+		task = next(tasks, None)
+		if task is not None:
+			in_flight.append((task, pool.submit(_profiled_read, task[0], task[1])))
+
+	for i in range(max(1, int(prefetch_depth))):
+		submit()
+	results = []
+	io_wait = 0.0
+	compute = 0.0
+	empty_windows = 0
+	while in_flight:
+		(key, worker_args), future = in_flight.popleft()
+		start = perf_counter()
+		reads = future.result()
+		read_end = perf_counter()
+		# keep the reads ahead while this window is reduced
+		submit()
+		results.append((key, _profiled_reduce(key, worker_args, reads)))
+		io_wait += read_end - start
+		compute += perf_counter() - read_end
+		empty_windows += int(reads[-1])
+	_profile_pickle(results)
+	return results, (process_handle_stats(), io_wait, compute, empty_windows, collect_spans())
+
+
+def _summarize_pipeline(pipeline_seconds:list, prefetch_depth:int) -> str:
+	"""Formats the [io_seconds, compute_seconds] totals of a run for logging"""
+	io_seconds, compute_seconds = pipeline_seconds
+	total = io_seconds + compute_seconds
+	share = (io_seconds / total * 100) if total > 0 else 0
+	io_label = "waiting on reads" if prefetch_depth > 0 else "reading"
+	return f"Workers spent {io_seconds:.2f} s {io_label} and {compute_seconds:.2f} s computing ({share:.0f}% I/O)"
+
+
+def _batches(tasks, batch_size:int):
+	"""Groups an iterable of tasks into lists of up to batch_size"""
+	batch = []
+	for task in tasks:
+		batch.append(task)
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+def _finalize_job(job:dict, mask_columns:list, statistics = DEFAULT_STATISTICS) -> list:
+	"""Finalizes the per-mask accumulator arrays of one key of a job
+
+	Returns a list with, per mask, {statistic:array} over the
+	job's zones (see stats.finalize_columns), or None if the key
+	had no windows
+	"""
+	return [(finalize_columns(columns, statistics, job["histogram"]) if columns is not None else None) for columns in mask_columns]
+
+
+def _zone_stats(zones, values:dict) -> dict:
+	"""Turns the {statistic:array} of stats.finalize_columns into a
+	zonal_stats output dictionary"""
+	if values is None:
+		return {}
+	present = (values["pixels"] > 0).tolist()
+	columns = {}
+	for stat, array in values.items():
+		if np.issubdtype(array.dtype, np.integer) and (stat != "pixels"):
+			# integer sums are NaN for zones without pixels
+			columns[statistic_key(stat)] = [(v if p else np.nan) for v, p in zip(array.tolist(), present)]
+		else:
+			columns[statistic_key(stat)] = array.tolist()
+	keys = list(columns)
+	return {zone:dict(zip(keys, row)) for zone, row in zip(zones.tolist(), zip(*columns.values()))}
+
+
+def _job_output(job:dict, mask_values:list) -> dict:
+	"""Returns {zone:statistics} for a job with a single mask_raster,
+	or {mask_name:{zone:statistics}} for a job with mask_rasters,
+	from the output of _finalize_job"""
+	mask_data = [_zone_stats(job["zones"], values) for values in mask_values]
+	if job["mask_names"] is None:
+		return mask_data[0]
+	return dict(zip(job["mask_names"], mask_data))
+
+
+def _cube_path(cube, mask_name:str = None):
+	"""Returns where a job's cube for a mask is memory-mapped, or None"""
+	if (cube is True) or (cube is None):
+		return None
+	return os.path.join(cube, mask_name) if mask_name is not None else cube
+
+
+def _create_cubes(job:dict, statistics:list, finished:dict) -> list:
+	"""Creates a job's StatsCubes, one per mask, over its data_rasters
+	and zones, and moves any finished outputs into them"""
+	with open_raster(job["model_raster"]) as meta_handle:
+		integer = np.issubdtype(np.dtype(meta_handle.dtypes[0]), np.integer)
+	names = job["mask_names"] or [None]
+	cubes = [StatsCube(list(job["data_rasters"]), job["zones"], statistics, path = _cube_path(job["cube"], name), integer_sums = integer) for name in names]
+	for key in finished:
+		for cube, name in zip(cubes, names):
+			cube.set_stats(key, finished[key] if name is None else finished[key][name])
+		finished[key] = None
+	return cubes
+
+
+def _job_cubes(job:dict, statistics:list, finished:dict):
+	"""Returns a job's StatsCube, or {mask_name:StatsCube} for a job
+	with mask_rasters, building them from finished outputs if no
+	key had to be calculated"""
+	if "cubes" in job:
+		cubes = job["cubes"]
+	else:
+		names = job["mask_names"] or [None]
+		cubes = [StatsCube.from_stats({key:(finished[key] if name is None else finished[key][name]) for key in job["data_rasters"]}, statistics, path = _cube_path(job["cube"], name)) for name in names]
+	for cube in cubes:
+		cube.flush()
+	if job["mask_names"] is None:
+		return cubes[0]
+	return dict(zip(job["mask_names"], cubes))
+
+
+def _histogram(data_raster:str, statistics, histogram_range = None, histogram_bins:int = DEFAULT_HISTOGRAM_BINS):
+	"""Returns (low, high, bins) histogram for percentiles of data_raster, or None"""
+	if not needs_histogram(statistics):
+		return None
+	if histogram_range is not None:
+		low, high = histogram_range
+		return (float(low), float(high), int(histogram_bins))
+	with open_raster(data_raster) as meta_handle:
+		dtype = meta_handle.dtypes[0]
+	return default_histogram(dtype, statistics, histogram_bins)
+
+
+def get_windows(data_raster:str, block_scale_factor: int = 8, default_block_size: int = 256, zone_raster:str = None, overview_level:int = None) -> list:
+	"""Plans the windowed reads for a data raster
+
+	Window size follows the tiling of data_raster. If zone_raster
+	is set, the windows cover only its extent, in its own pixel
+	coordinates; use util.grid_offset to place them on
+	data_raster.
 
 	***
 
 	Parameters
 	----------
-	zone_raster: str
-		Path to input zone raster file
 	data_raster: str
 		Path to raster file
-	n_cores: int
-		How many cores to use for parallel processing. Default
-		1
 	block_scale_factor: int
 		Factor by which to scale default raster block size for
 		the purposes of windowed reads. Default 8
 	default_block_size: int
 		Inferred block size for untiled data raster.
 		Default 256
+	zone_raster: str
+		Path to zone raster on a sub-grid of data_raster.
+		Default None
+	overview_level: int
+		If set, plan windows on this overview level of
+		data_raster. Default None
+
+	Returns
+	-------
+	List of rasterio.windows.Window objects covering
+	zone_raster, or data_raster if zone_raster is None
+	"""
+	# get raster metadata
+	with open_raster(data_raster, overview_level) as meta_handle:
+		metaprofile = meta_handle.profile
+		hnum = meta_handle.width
+		vnum = meta_handle.height
+	if zone_raster is not None:
+		with open_raster(zone_raster) as zone_handle:
+			hnum = zone_handle.width
+			vnum = zone_handle.height
+	if metaprofile['tiled']:
+		blocksize = metaprofile['blockxsize'] * int(block_scale_factor)
+	else:
+		log.warning(f"Input raster {data_raster} is not tiled!")
+		blocksize = int(default_block_size) * int(block_scale_factor)
+
+	return getWindows(hnum, vnum, blocksize)
+
+
+def _zone_index_worker(args):
+	"""A function for use with the multiprocessing
+	package, passed to each worker.
+
+	Returns a tuple of (window, {zone_code:pixel_count,...}).
+	The dictionary is empty if the window has no zone pixels
+
+	Parameters
+	----------
+	args:tuple
+		Tuple containing the following (in order):
+			targetwindow
+			shape_path
+	"""
+	targetwindow, shape_path = args
+
+	shape_data, shape_noDataVal = read_layer(shape_path, targetwindow)
+
+	uniquezones, counts = np.unique(shape_data[shape_data != shape_noDataVal], return_counts=True)
+	return targetwindow, {zone_code:int(count) for zone_code, count in zip(uniquezones, counts)}
+
+
+def build_zone_index(zone_raster:str, windows:list, n_cores:int = 1, pool = None) -> list:
+	"""Finds which windows of a zone raster contain zone pixels
+
+	The index only needs to be built once per zone raster, after
+	which only the listed windows need to be read for any data
+	raster on the same grid.
+
+	***
+
+	Parameters
+	----------
+	zone_raster: str
+		Path to input zone raster file
+	windows: list
+		List of rasterio.windows.Window objects, as returned
+		by get_windows
+	n_cores: int
+		How many cores to use for parallel processing. Ignored
+		if pool is set. Default 1
+	pool: multiprocessing.Pool
+		Existing pool, or executor.make_executor executor,
+		to run on. If None, a new pool is
+		created. Default None
+
+	Returns
+	-------
+	List of (window, {zone_code:pixel_count}) tuples, in the order
+	of windows, for only those windows that contain zone pixels
+	"""
+	parallel_args = [(w, zone_raster) for w in windows]
+	with span("zone_index", zone_raster = os.path.basename(zone_raster)) as args:
+		if pool is None:
+			with Pool(processes = int(n_cores)) as p:
+				index = p.map(_zone_index_worker, parallel_args)
+		else:
+			index = pool.map(_zone_index_worker, parallel_args)
+		index = [(w, counts) for w, counts in index if len(counts) > 0]
+		args["pixels"] = sum(int(w.width) * int(w.height) for w in windows)
+		args["zones"] = len(zone_pixel_counts(index))
+	log.debug(f"{len(index)} of {len(windows)} windows contain zone pixels")
+	return index
+
+
+def zone_pixel_counts(zone_index:list) -> dict:
+	"""Returns {zone:pixels} totalled over the output of build_zone_index"""
+	totals = {}
+	for window, counts in zone_index:
+		for zone, count in counts.items():
+			totals[zone] = totals.get(zone, 0) + count
+	return totals
+
+
+def restrict_zone_index(zone_index:list, zones) -> list:
+	"""Returns the entries of the output of build_zone_index whose
+	windows contain any of zones"""
+	zones = set(zones)
+	return [(window, counts) for window, counts in zone_index if not zones.isdisjoint(counts)]
+
+
+def _preload_layers(jobs:list) -> dict:
+	"""Preloads the zone and mask rasters of every job over its zone
+	raster's extent
+
+	Returns {raster_path:layer} for datasets.init_worker, which is
+	empty if the layers would take more than PRELOAD_MAX_BYTES
+	"""
+	from rasterio.windows import Window
+	regions = {}
+	for job in jobs:
+		with open_raster(job["zone_raster"]) as zone_handle:
+			zone_window = Window(0, 0, zone_handle.width, zone_handle.height)
+		regions.setdefault(job["zone_raster"], zone_window)
+		mask_window = offset_window(zone_window, job["offset"])
+		for mask_path in job["mask_paths"]:
+			if mask_path is None:
+				continue
+			# a mask can only be preloaded for one zone grid
+			if regions.setdefault(mask_path, mask_window) != mask_window:
+				log.warning(f"{mask_path} is used with more than one zone grid; it will be read per window")
+				regions[mask_path] = None
+
+	total_bytes = 0
+	for path, window in regions.items():
+		if window is not None:
+			with open_raster(path) as handle:
+				total_bytes += int(window.width) * int(window.height) * np.dtype(handle.dtypes[0]).itemsize
+	if total_bytes > PRELOAD_MAX_BYTES:
+		log.info(f"Zone and mask layers need {total_bytes} bytes, over PRELOAD_MAX_BYTES; reading them per window instead")
+		return {}
+
+	return {path:preload_layer(path, window) for path, window in regions.items() if window is not None}
+
+
+def _tune_jobs(jobs:list, n_cores, block_scale_factor, default_block_size:int, memory_budget, prefetch_depth:int, executor:str) -> int:
+	"""Sets the "block_scale_factor" of each job, tuning it if
+	block_scale_factor is "auto", and returns the number of
+	workers, tuned if n_cores is "auto"
+
+	Every job that still needs a zone index is tuned on its own.
+	The pool is shared, so it gets as many workers as the
+	busiest job wants, but no more than the most memory-hungry
+	job allows.
+	"""
+	decisions = []
+	for job in jobs:
+		job["block_scale_factor"] = block_scale_factor
+		if (job["zone_index"] is None) and (len(job["todo"]) > 0) and (AUTO in (block_scale_factor, n_cores)):
+			decision = tune(job["model_raster"], job["zone_raster"], len(job["todo"]), sum(mask_path is not None for mask_path in job["mask_paths"]), memory_budget, block_scale_factor, n_cores, default_block_size, job["overview_level"], prefetch_depth, executor)
+			job["block_scale_factor"] = decision["block_scale_factor"]
+			decisions.append(decision)
+		elif job["block_scale_factor"] == AUTO:
+			# nothing to calculate, so any plan will do
+			job["block_scale_factor"] = 8
+	if n_cores != AUTO:
+		return int(n_cores)
+	if len(decisions) == 0:
+		# every job came with its windows planned already
+		n_tasks = sum(len(job["todo"]) * len(job["zone_index"]) for job in jobs)
+		return max(1, min(available_cores(), n_tasks // TASKS_PER_WORKER))
+	workers = max(decision["n_cores"] for decision in decisions)
+	limits = [decision["max_workers_memory"] for decision in decisions if decision["max_workers_memory"] is not None]
+	if limits:
+		workers = min(workers, max(1, min(limits)))
+	return workers
+
+
+def _task_stream(jobs:list, statistics:list):
+	"""Yields ((job_number, key), worker_args) for every window of every
+	key still to be calculated, interleaving jobs key by key"""
+	keys = [job["todo"] for job in jobs]
+	for i in range(max(len(job_keys) for job_keys in keys)):
+		for j, job in enumerate(jobs):
+			if i >= len(keys[j]):
+				continue
+			key = keys[j][i]
+			for w in job["windows"]:
+				yield (j, key), (w, job["data_rasters"][key], job["zone_raster"], job["mask_paths"], statistics, job["histogram"], job["offset"], job["overview_level"])
+
+
+def run_zonal_jobs(jobs:list, n_cores:int = 1, block_scale_factor: int = 8, default_block_size: int = 256, time:bool = False, statistics = None, histogram_range = None, histogram_bins:int = DEFAULT_HISTOGRAM_BINS, max_handles:int = DEFAULT_MAX_HANDLES, preload:bool = True, result_cache = None, executor:str = "process", executor_options:dict = None, prefetch_depth:int = 0, io_threads:int = 2, memory_budget = None, *args, **kwargs) -> list:
+	"""Generates zonal statistics for several jobs in one pool of
+	workers
+
+	A job is a set of data rasters that share one zone raster,
+	grid and set of masks, e.g. one product. Every (data raster,
+	window) pair of every job is submitted to the pool as one
+	stream of tasks, with jobs interleaved key by key, so workers
+	never wait for a whole date or product to finish before
+	starting on the next. Window results are merged into their key
+	as they arrive. Within a job, all data rasters must share the
+	grid of the first one, which is used to plan the windows, and
+	only windows that contain zone pixels are ever read. The zone
+	raster may cover just part of that grid (see
+	util.shapefile_toRaster), in which case only that part is
+	read. Jobs that share a zone raster and window plan share one
+	zone index. A job may have several masks, in which case
+	every window is read once and reduced under each of them.
+	Unless preload is False, zone and mask rasters
+	are decoded only once per call; after that, workers only read
+	the data rasters.
+
+	***
+
+	Parameters
+	----------
+	jobs: list
+		List of dictionaries, each with keys:
+			"zone_raster": path to zone raster file
+			"data_rasters": dictionary of {key:path}, e.g.
+				{date:data_raster}
+			"mask_raster": path to mask raster file, or None
+			"mask_rasters": dictionary of {mask_name:path},
+				used instead of mask_raster to calculate
+				statistics under several masks at once
+			"zone_index": output of build_zone_index for
+				zone_raster, or None to build it here
+			"callback": if set, called as
+				callback(key, zonal_stats_output) as soon as
+				each key is complete, in the order of
+				data_rasters, after which its output is
+				discarded. Or None
+			"overview_level": overview level of the data
+				rasters to read instead of full resolution;
+				zone_raster and masks must be on that
+				overview's grid. Or None
+			"result_keys": dictionary of {key:cache_key}
+				under which each key's output is looked up
+				in, and stored to, result_cache
+			"cube": if True, the job's output is a
+				cube.StatsCube of dense key by zone arrays
+				instead of dictionaries; if a directory
+				path, the cube's arrays are memory-mapped
+				files there (in a subdirectory per mask for
+				jobs with mask_rasters). Cannot be combined
+				with a callback. Or None
+		Only "zone_raster" and "data_rasters" are required
+	n_cores: int or str
+		How many cores to use for parallel processing, or
+		"auto" to choose from the available cores, the number
+		of tasks and memory_budget (see tuning.tune). Default 1
+	block_scale_factor: int or str
+		Factor by which to scale default raster block size for
+		the purposes of windowed reads, or "auto" to choose it
+		for each job from its tiling, zone coverage and
+		memory_budget. Default 8
+	default_block_size: int
+		Inferred block size for untiled data raster.
+		Default 256
 	time: bool
 		Whether to log time it takes to execute this function.
 		Default False
+	statistics: list
+		Names of statistics to calculate; see
+		stats.validate_statistics. Default ["mean", "pixels"]
+	histogram_range: tuple
+		(low, high) range of the fixed-bin histogram used to
+		estimate percentiles. If None, the full range of each
+		job's integer data type is used. Default None
+	histogram_bins: int
+		Number of histogram bins. Default 1000
+	max_handles: int
+		Number of open datasets each worker keeps cached
+		between windows. Default 32
+	preload: bool
+		Whether to decode zone rasters, and the matching
+		regions of mask rasters, once into memory-mapped
+		scratch files shared by all workers. Skipped if they
+		would take more than PRELOAD_MAX_BYTES. Default True
+	result_cache: cache.ResultCache
+		If set, keys of jobs with result_keys are read from
+		this cache instead of being calculated, and stored to
+		it as soon as they are finished. Default None
+	executor: str
+		Kind of worker pool to run on; see
+		executor.make_executor. With "distributed", tasks are
+		sent to the workers in shards, and their partial
+		accumulators merged here as they come back. Default
+		"process"
+	executor_options: dict
+		Keyword arguments of executor.make_executor, e.g.
+		{"queue_dir":path} for a distributed run whose
+		workers are started on other nodes. Default None
+	prefetch_depth: int
+		If above 0, workers take tasks in batches and read up
+		to this many windows ahead on io_threads threads while
+		reducing the current one, so that reads overlap with
+		computation. Default 0
+	io_threads: int
+		Number of read-ahead threads per worker process.
+		Ignored if prefetch_depth is 0. Default 2
+	memory_budget: int or str
+		Memory the run may use, in bytes or as e.g. "8G", when
+		n_cores or block_scale_factor is "auto". Default None,
+		for most of the available memory
 
 	Returns
 	-------
-	A nested dictionary. Outer-level keys are zone id numbers, each
-	of which corresponds to an inner dictionary with keys "value"
-	(the mean for that zone) and "pixels" (the number of pixels in
-	that zone).
+	List with one dictionary per job, of {key:zonal_stats_output},
+	with keys in the same order as the job's data_rasters, or of
+	{key:{mask_name:zonal_stats_output}} for jobs with
+	mask_rasters. The dictionary is empty for jobs with a
+	callback. See zonal_stats for the format of zonal_stats_output.
+	Jobs with a cube get a StatsCube, or {mask_name:StatsCube},
+	instead.
 	"""
 
 	# start timer
 	startTime = datetime.now()
 
-	# coerce integer arguments to proper type
-	n_cores = int(n_cores)
-	block_scale_factor = int(block_scale_factor)
-	default_block_size = int(default_block_size)
+	statistics = validate_statistics(statistics)
+	jobs = [dict(job) for job in jobs if len(job["data_rasters"]) > 0]
+	if len(jobs) == 0:
+		return []
+	for job in jobs:
+		if "mask_rasters" in job:
+			job["mask_names"] = list(job["mask_rasters"])
+			job["mask_paths"] = tuple(job["mask_rasters"].values())
+		else:
+			job["mask_names"] = None
+			job["mask_paths"] = (job.get("mask_raster"),)
+		job.setdefault("zone_index", None)
+		job.setdefault("callback", None)
+		job.setdefault("overview_level", None)
+		job.setdefault("cube", None)
+		if (job["cube"] is not None) and (job["cube"] is not False) and (job["callback"] is not None):
+			raise BadInputError("A job cannot have both a cube and a callback")
+		if job["cube"] is False:
+			job["cube"] = None
+		job["model_raster"] = list(job["data_rasters"].values())[0]
+		job["offset"] = grid_offset(job["zone_raster"], job["model_raster"], job["overview_level"])
+		job["histogram"] = _histogram(job["model_raster"], statistics, histogram_range, histogram_bins)
 
-	# get raster metadata
-	with rasterio.open(data_raster,'r') as meta_handle:
-		metaprofile = meta_handle.profile
-		hnum = meta_handle.width
-		vnum = meta_handle.height
-	if metaprofile['tiled']:
-		blocksize = metaprofile['blockxsize'] * block_scale_factor
-	else:
-		log.warning(f"Input raster {data_raster} is not tiled!")
-		blocksize = default_block_size * block_scale_factor
+	# reuse finished results of earlier runs
+	finished = [{} for job in jobs]
+	for j, job in enumerate(jobs):
+		if result_cache is not None:
+			for key, cache_key in job.get("result_keys", {}).items():
+				cached = result_cache.get(cache_key)
+				if cached is not None:
+					finished[j][key] = cached
+		job["todo"] = [key for key in job["data_rasters"] if key not in finished[j]]
+	n_cached = sum(len(f) for f in finished)
+	if n_cached > 0:
+		log.info(f"Reusing {n_cached} cached results")
+	pending = [list(job["data_rasters"]) for job in jobs]
+
+	def complete(j, key):
+		# finalize a key as soon as its last window is in, and store it
+		job = jobs[j]
+		with span("finalize", "task", job = j, key = str(key)):
+			mask_values = _finalize_job(job, output_data[j].pop(key), statistics)
+			cached = (result_cache is not None) and (key in job.get("result_keys", {}))
+			output = _job_output(job, mask_values) if (job["cube"] is None) or cached else None
+			if cached:
+				result_cache.put(job["result_keys"][key], output, job["mask_names"] is not None)
+			if job["cube"] is not None:
+				for cube, values in zip(job["cubes"], mask_values):
+					if values is not None:
+						cube.set(key, values)
+				output = None
+			finished[j][key] = output
+
+	def flush(j):
+		# hand finished keys to the callback in the order of data_rasters
+		callback = jobs[j]["callback"]
+		while (callback is not None) and pending[j] and (pending[j][0] in finished[j]):
+			done = pending[j].pop(0)
+			with span("write", "task", job = j, key = str(done)):
+				callback(done, finished[j].pop(done))
+
+	for j in range(len(jobs)):
+		flush(j)
+
+	# merged accumulator arrays over each job's zones, per key and mask
+	output_data = [{key:[None for mask_path in job["mask_paths"]] for key in job["todo"]} for job in jobs]
+	worker_handle_stats = {}
+	# seconds spent on reads (or, with prefetch_depth, waiting for them) and on reductions, summed over workers
+	pipeline_seconds = [0.0, 0.0]
+	# product windows calculated, and those of them skipped as empty
+	window_counts = [0, 0]
+	if any(len(job["todo"]) > 0 for job in jobs):
+		with span("tune"):
+			n_cores = _tune_jobs(jobs, n_cores, block_scale_factor, default_block_size, memory_budget, prefetch_depth, executor)
+
+		# decode layers that are the same for every key once, up front
+		executor_options = dict(executor_options or {})
+		layers = {}
+		if preload and (executor == "distributed") and (executor_options.get("queue_dir") is not None):
+			# scratch files in TEMP_DIR may not be visible from other nodes
+			log.debug("Not preloading layers for workers on other nodes")
+		elif preload:
+			with span("preload"):
+				layers = _preload_layers(jobs)
+		try:
+			with make_executor(executor, n_cores, init_worker, (max_handles, layers, profiling_enabled()), **executor_options) as p, span("zonal") as zonal_args:
+				try:
+					# plan windows from each job's first raster; the rest share its grid
+					zone_indices = {}
+					for job in jobs:
+						if job["zone_index"] is None:
+							windows = get_windows(job["model_raster"], job["block_scale_factor"], default_block_size, job["zone_raster"], job["overview_level"])
+							index_key = (job["zone_raster"], tuple((w.col_off, w.row_off, w.width, w.height) for w in windows))
+							if index_key not in zone_indices:
+								zone_indices[index_key] = build_zone_index(job["zone_raster"], windows, pool = p)
+							job["zone_index"] = zone_indices[index_key]
+						job["windows"] = [w for w, counts in job["zone_index"]]
+						job["zones"] = np.array(sorted(zone_pixel_counts(job["zone_index"])))
+					for j, job in enumerate(jobs):
+						if job["cube"] is not None:
+							job["cubes"] = _create_cubes(job, statistics, finished[j])
+					remaining = [{key:len(job["windows"]) for key in job["todo"]} for job in jobs]
 
-	# get windows
-	windows = getWindows(hnum, vnum, blocksize)
+					# keys without any zone windows are never reached by the task stream
+					for j, job in enumerate(jobs):
+						if len(job["windows"]) == 0:
+							for key in job["todo"]:
+								complete(j, key)
+							flush(j)
 
-	# generate arguments to pass into _zonal_worker
-	parallel_args = [(w, data_raster, zone_raster, mask_raster) for w in windows]
+					# generate arguments to pass into the workers, one stream for all jobs and keys
+					n_tasks = sum(len(job["todo"]) * len(job["windows"]) for job in jobs)
+					chunksize = max(1, n_tasks // (int(n_cores) * 16))
+					if prefetch_depth > 0:
+						# a batch is one task of the pool, so reads can run ahead within it
+						batch_size = max(chunksize, 4 * int(prefetch_depth))
+						task_results = p.imap_unordered(_prefetched_zonal_worker, ((batch, prefetch_depth, io_threads) for batch in _batches(_task_stream(jobs, statistics), batch_size)))
+					else:
+						task_results = p.imap_unordered(_tagged_zonal_worker, _task_stream(jobs, statistics), chunksize = chunksize)
 
-	# do the multiprocessing
-	output_data = {}
-	with Pool(processes = n_cores) as p:
-		for window_data in p.map(_zonal_worker, parallel_args):
-			output_data = _update(output_data, window_data)
+					# do the multiprocessing; finished keys are handed to callbacks in order
+					for batch_results, (handle_stats, io_seconds, compute_seconds, n_empty, spans) in task_results:
+						add_spans(spans)
+						for stats in handle_stats:
+							worker_handle_stats[stats[0]] = stats
+						pipeline_seconds[0] += io_seconds
+						pipeline_seconds[1] += compute_seconds
+						window_counts[0] += len(batch_results)
+						window_counts[1] += n_empty
+						for (j, key), (zones, mask_columns) in batch_results:
+							with span("merge", "task", job = j, key = str(key), zones = len(zones)):
+								if len(zones) > 0:
+									# window zones are sorted, so they map onto the job's zones in one pass
+									positions = np.searchsorted(jobs[j]["zones"], zones)
+									stored = output_data[j][key]
+									for m, columns in enumerate(mask_columns):
+										if stored[m] is None:
+											stored[m] = empty_columns(jobs[j]["zones"].size, columns)
+										merge_columns(stored[m], columns, positions)
+							remaining[j][key] -= 1
+							if remaining[j][key] == 0:
+								complete(j, key)
+								flush(j)
+					zonal_args["pixels"] = sum(int(w.width) * int(w.height) * len(job["todo"]) for job in jobs for w in job["windows"])
+				finally:
+					if executor == "thread":
+						# the pool's threads, and their read-ahead threads, outlive their
+						# handles otherwise; after a failure, queued tasks are dropped
+						p.terminate()
+						p.join()
+						release_exited_threads()
+						shutdown_io_pool()
+		finally:
+			for layer in layers.values():
+				release_layer(layer)
 
-	for zone in output_data:
-		if output_data[zone]['pixels'] == 0:
-			output_data[zone]['value'] = np.NaN
+	# jobs with a callback have handed everything over already
+	output_data = [(_job_cubes(job, statistics, finished[j]) if job["cube"] is not None else {} if job["callback"] is not None else {key:finished[j][key] for key in job["data_rasters"]}) for j, job in enumerate(jobs)]
 
 	if time:
+		log.info(summarize_handle_stats(worker_handle_stats))
+		log.info(_summarize_pipeline(pipeline_seconds, prefetch_depth))
+		log.info(f"{window_counts[1]} of {window_counts[0]} data windows were empty in their files and not read")
 		log.info(f"Finished in {datetime.now() - startTime}")
+	else:
+		log.debug(summarize_handle_stats(worker_handle_stats))
+		log.debug(_summarize_pipeline(pipeline_seconds, prefetch_depth))
+		log.debug(f"{window_counts[1]} of {window_counts[0]} data windows were empty in their files and not read")
 
 	return output_data
+
+
+def multi_date_zonal_stats(zone_raster:str, data_rasters:dict, mask_raster = None, n_cores:int = 1, block_scale_factor: int = 8, default_block_size: int = 256, time:bool = False, zone_index:list = None, callback = None, statistics = None, histogram_range = None, histogram_bins:int = DEFAULT_HISTOGRAM_BINS, executor:str = "process", cube = None, *args, **kwargs) -> dict:
+	"""Generates zonal statistics for many data rasters that share
+	one zone raster, using a single pool of workers
+
+	This is run_zonal_jobs with a single job; other keyword
+	arguments are passed on to it.
+
+	***
+
+	Parameters
+	----------
+	zone_raster: str
+		Path to input zone raster file
+	data_rasters: dict
+		Dictionary of {key:path}, e.g. {date:data_raster}
+	mask_raster: str or dict
+		Path to mask raster file, or dictionary of
+		{mask_name:path} to calculate statistics under
+		several masks in one pass. Default None
+	n_cores: int
+		How many cores to use for parallel processing. Default
+		1
+	block_scale_factor: int
+		Factor by which to scale default raster block size for
+		the purposes of windowed reads. Default 8
+	default_block_size: int
+		Inferred block size for untiled data raster.
+		Default 256
+	time: bool
+		Whether to log time it takes to execute this function.
+		Default False
+	zone_index: list
+		Output of build_zone_index for zone_raster. If None,
+		it is built here. Default None
+	callback: function
+		If set, called as callback(key, zonal_stats_output) as
+		soon as each key is complete, after which its output
+		is discarded. Default None
+	statistics: list
+		Names of statistics to calculate; see
+		stats.validate_statistics. Default ["mean", "pixels"]
+	histogram_range: tuple
+		(low, high) range of the fixed-bin histogram used to
+		estimate percentiles. If None, the full range of the
+		data raster's integer data type is used. Default None
+	histogram_bins: int
+		Number of histogram bins. Default 1000
+	executor: str
+		"process" to run on a pool of n_cores processes,
+		"thread" to run on n_cores threads of this process,
+		which share dataset decoding caches and need no
+		pickling of results, or "distributed"; see
+		executor.make_executor. Default "process"
+	cube: bool or str
+		If True, return a cube.StatsCube of key by zone arrays
+		instead of dictionaries; if a directory path, memory-map
+		the cube's arrays there. Cannot be combined with
+		callback. Default None
+
+	Returns
+	-------
+	A dictionary of {key:zonal_stats_output}, with keys in the
+	same order as data_rasters, or an empty dictionary if
+	callback is set. If mask_raster is a dictionary, each value
+	is instead {mask_name:zonal_stats_output}. See zonal_stats
+	for the format of zonal_stats_output. If cube is set, a
+	StatsCube, or {mask_name:StatsCube}, instead.
+	"""
+	job = {"zone_raster":zone_raster, "data_rasters":data_rasters, "zone_index":zone_index, "callback":callback, "cube":cube}
+	if isinstance(mask_raster, dict):
+		job["mask_rasters"] = mask_raster
+	else:
+		job["mask_raster"] = mask_raster
+	output_data = run_zonal_jobs([job], n_cores = n_cores, block_scale_factor = block_scale_factor, default_block_size = default_block_size, time = time, statistics = statistics, histogram_range = histogram_range, histogram_bins = histogram_bins, executor = executor, **kwargs)
+	return output_data[0] if output_data else {}
+
+
+def zonal_stats(zone_raster:str, data_raster:str, mask_raster = None, n_cores:int = 1, block_scale_factor: int = 8, default_block_size: int = 256, time:bool = False, zone_index:list = None, statistics = None, histogram_range = None, histogram_bins:int = DEFAULT_HISTOGRAM_BINS, executor:str = "process", *args, **kwargs) -> dict:
+	"""Generates zonal statistics based on input data and zone rasters
+
+	This is multi_date_zonal_stats for a single data raster;
+	other keyword arguments are passed on to it.
+
+	***
+
+	Parameters
+	----------
+	zone_raster: str
+		Path to input zone raster file
+	data_raster: str
+		Path to raster file
+	mask_raster: str or dict
+		Path to mask raster file, or dictionary of
+		{mask_name:path}. Default None
+	n_cores: int
+		How many cores to use for parallel processing. Default
+		1
+	block_scale_factor: int
+		Factor by which to scale default raster block size for
+		the purposes of windowed reads. Default 8
+	default_block_size: int
+		Inferred block size for untiled data raster.
+		Default 256
+	time: bool
+		Whether to log time it takes to execute this function.
+		Default False
+	zone_index: list
+		Output of build_zone_index for zone_raster. If None,
+		it is built here. Default None
+	statistics: list
+		Names of statistics to calculate; see
+		stats.validate_statistics. Default ["mean", "pixels"]
+	histogram_range: tuple
+		(low, high) range of the fixed-bin histogram used to
+		estimate percentiles. If None, the full range of the
+		data raster's integer data type is used. Default None
+	histogram_bins: int
+		Number of histogram bins. Default 1000
+	executor: str
+		"process", "thread" or "distributed"; see
+		multi_date_zonal_stats. Default "process"
+
+	Returns
+	-------
+	A nested dictionary. Outer-level keys are zone id numbers, each
+	of which corresponds to an inner dictionary with keys "value"
+	(the mean for that zone), "pixels" (the number of pixels in
+	that zone) and any other requested statistics, by name. If
+	mask_raster is a dictionary, this is nested under an outer
+	level keyed by mask name.
+	"""
+	output_data = multi_date_zonal_stats(zone_raster, {data_raster:data_raster}, mask_raster, n_cores = n_cores, block_scale_factor = block_scale_factor, default_block_size = default_block_size, time = time, zone_index = zone_index, statistics = statistics, histogram_range = histogram_range, histogram_bins = histogram_bins, executor = executor, **kwargs)
+	return output_data[data_raster]